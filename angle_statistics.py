@@ -0,0 +1,246 @@
+import json
+import math
+import numpy
+
+# Per scan angle statistics of the difference ratios that can be built up batch by batch and merged
+# exactly, e.g. per pair, per worker or per day:
+#
+#   statistics = AngleStatistics(bin_width=.5)
+#   for matches in batches:
+#       statistics.add(matches)
+#   total.merge(statistics)
+#
+# For every angle bin this keeps the count, mean and sum of squared differences from the mean (merged
+# with Chan et al.'s update), a histogram of the ratios between low and high and, optionally, a
+# relative-error quantile sketch. Only ratios between low and high are counted, as in aggregate_by_angle.
+
+DEFAULT_HISTOGRAM_BINS = 20
+
+
+def merge_moments(moments1, moments2):
+    # Chan et al. pairwise update of (count, mean, m2)
+    count = moments1[0] + moments2[0]
+    if count == 0:
+        return 0, 0.0, 0.0
+    delta = moments2[1] - moments1[1]
+    mean = moments1[1] + delta * moments2[0] / count
+    m2 = moments1[2] + moments2[2] + delta ** 2 * moments1[0] * moments2[0] / count
+    return count, mean, m2
+
+
+def aggregates_from_moments(moments):
+    # [(angle, average ratio, standard deviation)] as aggregate_by_angle gives them, from {angle: moments}
+    return [(angle, moments[angle][1], math.sqrt(moments[angle][2] / moments[angle][0])) for angle in sorted(moments)]
+
+
+class QuantileSketch(object):
+    # Counts of values in logarithmic buckets, so any quantile is known to within relative_accuracy
+    # of a value actually added (as in DDSketch). Merging adds the counts, so it is exact.
+
+    def __init__(self, relative_accuracy=.001):
+        if not 0 < relative_accuracy < 1:
+            raise Exception("The relative accuracy of a QuantileSketch must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        # bucket index -> count; bucket i holds values in (gamma ** (i - 1), gamma ** i]
+        self.buckets = {}
+        # Values of zero or less have no logarithm and are counted apart.
+        self.non_positive = 0
+
+    def __len__(self):
+        return sum(self.buckets.values()) + self.non_positive
+
+    def add(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        positive = values[values > 0]
+        self.non_positive += len(values) - len(positive)
+        indices = numpy.ceil(numpy.log(positive) / math.log(self.gamma)).astype(numpy.int64)
+        for index, count in zip(*numpy.unique(indices, return_counts=True)):
+            self.buckets[int(index)] = self.buckets.get(int(index), 0) + int(count)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise Exception("Only QuantileSketches with the same relative accuracy can be merged")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.non_positive += other.non_positive
+        return self
+
+    def quantile(self, q):
+        total = len(self)
+        if total == 0:
+            return float("nan")
+        rank = q * (total - 1)
+        seen = self.non_positive
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {"relative_accuracy": self.relative_accuracy,
+                "buckets": sorted(self.buckets.items()),
+                "non_positive": self.non_positive}
+
+
+def sketch_from_dict(state):
+    sketch = QuantileSketch(state["relative_accuracy"])
+    sketch.buckets = dict((int(index), int(count)) for index, count in state["buckets"])
+    sketch.non_positive = int(state["non_positive"])
+    return sketch
+
+
+class AngleStatistics(object):
+    # bin_width=None keeps every distinct scan angle apart, which is what aggregate_by_angle does;
+    # otherwise angles are grouped into bins of that many degrees, keyed by the start of the bin.
+    # quantile_accuracy=None leaves out the quantile sketches.
+
+    def __init__(self, bin_width=None, low=.9, high=1.1, histogram_bins=DEFAULT_HISTOGRAM_BINS,
+                 quantile_accuracy=None):
+        if bin_width is not None and bin_width <= 0:
+            raise Exception("The angle bin width must be positive")
+        if not low < high:
+            raise Exception("The low end of the ratio range must be below the high end")
+        self.bin_width = bin_width
+        self.low = low
+        self.high = high
+        self.histogram_bins = int(histogram_bins)
+        self.quantile_accuracy = quantile_accuracy
+        # angle bin -> (count, mean, m2)
+        self.moments = {}
+        # angle bin -> int64 array of histogram_bins counts over [low, high]
+        self.histograms = {}
+        # angle bin -> QuantileSketch
+        self.sketches = {}
+
+    def __len__(self):
+        return sum(moments[0] for moments in self.moments.values())
+
+    def get_settings(self):
+        return (self.bin_width, self.low, self.high, self.histogram_bins, self.quantile_accuracy)
+
+    def get_bins(self, angles):
+        if self.bin_width is None:
+            return angles
+        return numpy.floor(angles / self.bin_width) * self.bin_width
+
+    def add(self, matches):
+        # matches is a MatchTable
+        self.add_values(matches.get_angles(), matches.get_ratios())
+        return self
+
+    def add_values(self, angles, ratios):
+        angles = numpy.asarray(angles, dtype=numpy.float64)
+        ratios = numpy.asarray(ratios, dtype=numpy.float64)
+        keep = (self.low <= ratios) & (ratios <= self.high)
+        angles = angles[keep]
+        ratios = ratios[keep]
+        if len(ratios) == 0:
+            return self
+        bins, groups = numpy.unique(self.get_bins(angles), return_inverse=True)
+        counts = numpy.bincount(groups)
+        means = numpy.bincount(groups, weights=ratios) / counts
+        m2s = numpy.bincount(groups, weights=(ratios - means[groups]) ** 2)
+        # ratio == high goes in the last histogram bin
+        positions = ((ratios - self.low) / (self.high - self.low) * self.histogram_bins).astype(numpy.int64)
+        positions = numpy.minimum(positions, self.histogram_bins - 1)
+        histograms = numpy.bincount(groups * self.histogram_bins + positions,
+                                    minlength=len(bins) * self.histogram_bins).reshape(len(bins), self.histogram_bins)
+        if self.quantile_accuracy is not None:
+            order = numpy.argsort(groups, kind="stable")
+            grouped_ratios = numpy.split(ratios[order], numpy.cumsum(counts)[:-1])
+        for i, key in enumerate(bins.tolist()):
+            self.moments[key] = merge_moments(self.moments.get(key, (0, 0.0, 0.0)),
+                                              (int(counts[i]), float(means[i]), float(m2s[i])))
+            if key in self.histograms:
+                self.histograms[key] = self.histograms[key] + histograms[i]
+            else:
+                self.histograms[key] = histograms[i].copy()
+            if self.quantile_accuracy is not None:
+                self.sketches.setdefault(key, QuantileSketch(self.quantile_accuracy)).add(grouped_ratios[i])
+        return self
+
+    def merge(self, other):
+        if other.get_settings() != self.get_settings():
+            raise Exception("Only AngleStatistics with the same bins, ratio range and sketches can be merged")
+        for key, moments in other.moments.items():
+            self.moments[key] = merge_moments(self.moments.get(key, (0, 0.0, 0.0)), moments)
+            if key in self.histograms:
+                self.histograms[key] = self.histograms[key] + other.histograms[key]
+            else:
+                self.histograms[key] = other.histograms[key].copy()
+            if key in other.sketches:
+                self.sketches.setdefault(key, QuantileSketch(self.quantile_accuracy)).merge(other.sketches[key])
+        return self
+
+    def get_moments(self):
+        return dict(self.moments)
+
+    def get_aggregates(self):
+        # [(angle, average ratio, standard deviation)], like aggregate_by_angle
+        return aggregates_from_moments(self.moments)
+
+    def get_histogram(self, key):
+        # (counts, bin edges) of the ratios in one angle bin
+        return self.histograms[key], numpy.linspace(self.low, self.high, self.histogram_bins + 1)
+
+    def get_quantiles(self, quantiles=(.05, .5, .95)):
+        # [(angle, [ratio at each quantile])]
+        if self.quantile_accuracy is None:
+            raise Exception("Quantiles need AngleStatistics made with a quantile_accuracy")
+        return [(key, [self.sketches[key].quantile(q) for q in quantiles]) for key in sorted(self.sketches)]
+
+    def to_dict(self):
+        # Plain values only, so the state can be written as JSON and read back with from_dict
+        return {"bin_width": self.bin_width,
+                "low": self.low,
+                "high": self.high,
+                "histogram_bins": self.histogram_bins,
+                "quantile_accuracy": self.quantile_accuracy,
+                "bins": [{"angle": key,
+                          "moments": list(self.moments[key]),
+                          "histogram": self.histograms[key].tolist(),
+                          "sketch": self.sketches[key].to_dict() if key in self.sketches else None}
+                         for key in sorted(self.moments)]}
+
+    def to_json(self, file_name=None):
+        text = json.dumps(self.to_dict())
+        if file_name is not None:
+            with open(file_name, "w") as file:
+                file.write(text)
+        return text
+
+
+def from_dict(state):
+    statistics = AngleStatistics(state["bin_width"], state["low"], state["high"], state["histogram_bins"],
+                                 state["quantile_accuracy"])
+    for angle_bin in state["bins"]:
+        key = angle_bin["angle"]
+        count, mean, m2 = angle_bin["moments"]
+        statistics.moments[key] = (int(count), mean, m2)
+        statistics.histograms[key] = numpy.array(angle_bin["histogram"], dtype=numpy.int64)
+        if angle_bin["sketch"] is not None:
+            statistics.sketches[key] = sketch_from_dict(angle_bin["sketch"])
+    return statistics
+
+
+def from_json(text):
+    return from_dict(json.loads(text))
+
+
+def load_json(file_name):
+    with open(file_name) as file:
+        return from_json(file.read())
+
+
+def merge_all(statistics_list):
+    # One AngleStatistics holding everything in the given ones, which must share their settings
+    merged = None
+    for statistics in statistics_list:
+        if merged is None:
+            merged = AngleStatistics(*statistics.get_settings())
+        merged.merge(statistics)
+    return merged
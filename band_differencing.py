@@ -0,0 +1,83 @@
+import numpy
+from data_sets import viirs_fill_mask
+
+# Weight applied to M5 in the I1 - 0.93*M5 trace
+M5_WEIGHT = .93
+
+
+def aggregate_i_band(i_values):
+    # Mean of every 2x2 block of I-band pixels, which puts I-band data on the M-band grid.
+    rows = i_values.shape[0] // 2 * 2
+    columns = i_values.shape[1] // 2 * 2
+    blocks = i_values[:rows, :columns].reshape(rows // 2, 2, columns // 2, 2)
+    return blocks.mean(axis=(1, 3), dtype=numpy.float64)
+
+
+def scale_rows(values, gain, offset):
+    # gain/offset may be scalars or one value per row
+    return values * numpy.asarray(gain, dtype=numpy.float64).reshape(-1, 1) + \
+        numpy.asarray(offset, dtype=numpy.float64).reshape(-1, 1)
+
+
+def granule_factors(factors, number_of_rows):
+    # Expands per-granule scale factors to one per row; rows are split evenly across the granules.
+    factors = numpy.asarray(factors, dtype=numpy.float64)
+    rows_per_granule = max(number_of_rows // len(factors), 1)
+    return factors[numpy.minimum(numpy.arange(number_of_rows) // rows_per_granule, len(factors) - 1)]
+
+
+def scaled_reflectance(raw, gain, offset):
+    # Fill values become NaN so they show up blank in the heatmaps instead of as huge reflectances.
+    values = scale_rows(raw, gain, offset)
+    values[viirs_fill_mask(raw)] = numpy.nan
+    return values
+
+
+def ivm_tile(i_raw, m_raw, i_gain, i_offset, m_gain, m_offset):
+    # i_raw covers exactly twice the rows and columns of m_raw. Returns (trace, i1, m5) on the M grid.
+    i_values = aggregate_i_band(scaled_reflectance(i_raw, i_gain, i_offset))
+    m_values = scaled_reflectance(m_raw, m_gain, m_offset)
+    rows = min(i_values.shape[0], m_values.shape[0])
+    columns = min(i_values.shape[1], m_values.shape[1])
+    i_values = i_values[:rows, :columns]
+    m_values = m_values[:rows, :columns]
+    return i_values - M5_WEIGHT * m_values, i_values, m_values
+
+
+def compute_ivm(i_file, m_file, tiled=False, dtype=numpy.float32):
+    # Returns the I1 - .93*M5 trace, I1 (2x2 aggregated) and M5 reflectances as arrays on the M-band
+    # grid, for however many granules the files hold. With tiled=True only one granule of rows is read
+    # and processed at a time, which bounds memory to roughly one granule of each file.
+    i_set = i_file.get_specific_sdr_data_set("Reflectance")
+    m_set = m_file.get_specific_sdr_data_set("Reflectance")
+    i_gains, i_offsets = i_file.get_reflectance_factors()
+    m_gains, m_offsets = m_file.get_reflectance_factors()
+    m_rows, m_columns = m_set.get_dimensions()
+    i_rows, i_columns = i_set.get_dimensions()
+    rows = min(m_rows, i_rows // 2)
+    columns = min(m_columns, i_columns // 2)
+    if not tiled:
+        i_raw = i_set.data[:rows * 2, :columns * 2]
+        m_raw = m_set.data[:rows, :columns]
+        trace, i_values, m_values = ivm_tile(i_raw, m_raw,
+                                             granule_factors(i_gains, i_rows)[:rows * 2],
+                                             granule_factors(i_offsets, i_rows)[:rows * 2],
+                                             granule_factors(m_gains, m_rows)[:rows],
+                                             granule_factors(m_offsets, m_rows)[:rows])
+        return trace.astype(dtype), i_values.astype(dtype), m_values.astype(dtype)
+    trace = numpy.empty((rows, columns), dtype=dtype)
+    i_values = numpy.empty((rows, columns), dtype=dtype)
+    m_values = numpy.empty((rows, columns), dtype=dtype)
+    granules = len(m_gains)
+    rows_per_granule = max(m_rows // granules, 1)
+    for start in range(0, rows, rows_per_granule):
+        end = min(start + rows_per_granule, rows)
+        g = min(start // rows_per_granule, granules - 1)
+        i_granule = min((start * 2) // max(i_rows // len(i_gains), 1), len(i_gains) - 1)
+        # h5py reads only this hyperslab from disk
+        i_raw = i_set.ref_data[start * 2:end * 2, :columns * 2]
+        m_raw = m_set.ref_data[start:end, :columns]
+        trace[start:end], i_values[start:end], m_values[start:end] = ivm_tile(i_raw, m_raw,
+                                                                             i_gains[i_granule], i_offsets[i_granule],
+                                                                             m_gains[g], m_offsets[g])
+    return trace, i_values, m_values
@@ -0,0 +1,318 @@
+import argparse
+import configparser
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from granule_catalog import GranuleCatalog, DEFAULT_CATALOG_FILE
+from parallel_runner import run_pair_tasks, add_reverse_tasks
+from file_handler import DEFAULT_BAND_PAIR
+from product_cache import ProductCache, DEFAULT_CACHE_DIRECTORY
+from collocation import DEFAULT_BATCH_SIZE
+from geolocation_pyramid import DEFAULT_FRAME_INTERVAL
+from prefetch import DEFAULT_LOOKAHEAD
+from angle_statistics import AngleStatistics, from_json, merge_all
+from database_sink import PostgresSink, SQLiteSink
+import instrumentation
+
+# Non-interactive counterpart of main.run_program for scheduled runs, e.g.
+#   python batch.py --nadir /data/modis --off-nadir /data/viirs --reverse --workers 4
+# or with the same settings in the [batch] section of an INI file given with --config. Each run only
+# compares the pairs that are not yet in the manifest (or whose files changed since), and merges their
+# results into the running per-angle aggregates kept there. Several bands can be compared in one pass
+# with e.g. --bands 8:Radiance,9:VIIRS-M15-SDR_All/Radiance (MODIS emissive band index : VIIRS data set).
+
+DEFAULT_MANIFEST_FILE = 'manifest.db'
+# setting -> (default, type) for everything that can come from the command line or the config file
+SETTINGS = {"nadir": (None, str),
+            "off_nadir": (None, str),
+            "reverse": (False, bool),
+            "workers": (1, int),
+            "batch_size": (DEFAULT_BATCH_SIZE, int),
+            "bands": (None, str),
+            "frame_interval": (DEFAULT_FRAME_INTERVAL, int),
+            "tile_budget": (None, int),
+            "prefetch": (DEFAULT_LOOKAHEAD, int),
+            "bin_width": (None, float),
+            "quantile_accuracy": (None, float),
+            "manifest": (DEFAULT_MANIFEST_FILE, str),
+            "catalog": (DEFAULT_CATALOG_FILE, str),
+            "cache": (DEFAULT_CACHE_DIRECTORY, str),
+            "sqlite": (None, str),
+            "db_name": (None, str),
+            "db_user": (None, str),
+            "db_password": (None, str),
+            "table": (None, str),
+            "store_matches": (False, bool),
+            "export": (None, str),
+            "metrics_json": (None, str),
+            "metrics_prometheus": (None, str)}
+# Settings the manifest's statistics were made with. Statistics can only be merged with others made the
+# same way, so every run on a manifest has to use the same values.
+STATISTICS_SETTINGS = ("bin_width", "quantile_accuracy")
+
+
+class PairManifest(object):
+    # SQLite record of every file pair already compared (with the size and modification time both files
+    # had then) and the AngleStatistics each pair contributed per band, kept as JSON. A pair whose files
+    # changed is compared again and its statistics replaced; totals are merged from the pairs when asked for.
+
+    def __init__(self, database_file=DEFAULT_MANIFEST_FILE):
+        self.connection = sqlite3.connect(database_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pairs (nadir_path TEXT, off_nadir_path TEXT, "
+                                "nadir_size INTEGER, nadir_modified REAL, off_nadir_size INTEGER, "
+                                "off_nadir_modified REAL, matches INTEGER, processed REAL, "
+                                "PRIMARY KEY (nadir_path, off_nadir_path))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pair_statistics (nadir_path TEXT, off_nadir_path TEXT, "
+                                "band TEXT, off_nadir_type TEXT, statistics TEXT, "
+                                "PRIMARY KEY (nadir_path, off_nadir_path, band))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+    def check_settings(self, settings):
+        # Records the STATISTICS_SETTINGS of the first run, and refuses a run whose settings differ, as its
+        # statistics could not be merged with those already recorded. Manifests from before the settings
+        # were recorded take them from their statistics.
+        recorded = dict((name, json.loads(value)) for name, value in
+                        self.connection.execute("SELECT name, value FROM settings").fetchall())
+        if not recorded:
+            row = self.connection.execute("SELECT statistics FROM pair_statistics LIMIT 1").fetchone()
+            if row is not None:
+                state = json.loads(row[0])
+                recorded = dict((name, state[name]) for name in STATISTICS_SETTINGS)
+        for name in STATISTICS_SETTINGS:
+            if name in recorded and recorded[name] != settings[name]:
+                raise Exception("The manifest's statistics were made with " + name + " = " + str(recorded[name]) +
+                                ", not " + str(settings[name]) + ". Use the same setting or another manifest.")
+        self.connection.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                                    [(name, json.dumps(settings[name])) for name in STATISTICS_SETTINGS])
+        self.connection.commit()
+
+    def is_processed(self, nadir_path, off_nadir_path):
+        row = self.connection.execute("SELECT nadir_size, nadir_modified, off_nadir_size, off_nadir_modified "
+                                      "FROM pairs WHERE nadir_path = ? AND off_nadir_path = ?",
+                                      (nadir_path, off_nadir_path)).fetchone()
+        if row is None:
+            return False
+        nadir_stat = os.stat(nadir_path)
+        off_nadir_stat = os.stat(off_nadir_path)
+        return row == (nadir_stat.st_size, nadir_stat.st_mtime, off_nadir_stat.st_size, off_nadir_stat.st_mtime)
+
+    def record(self, result, statistics, number_of_matches):
+        # result is a parallel_runner.PairResult without an error, statistics {band label: AngleStatistics}
+        nadir_path, off_nadir_path = result.nadir_path, result.off_nadir_path
+        self.connection.execute("DELETE FROM pair_statistics WHERE nadir_path = ? AND off_nadir_path = ?",
+                                (nadir_path, off_nadir_path))
+        self.connection.executemany("INSERT INTO pair_statistics VALUES (?, ?, ?, ?, ?)",
+                                    [(nadir_path, off_nadir_path, band, get_instrument(off_nadir_path),
+                                      statistics[band].to_json()) for band in statistics])
+        nadir_stat = os.stat(nadir_path)
+        off_nadir_stat = os.stat(off_nadir_path)
+        self.connection.execute("INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (nadir_path, off_nadir_path, nadir_stat.st_size, nadir_stat.st_mtime,
+                                 off_nadir_stat.st_size, off_nadir_stat.st_mtime, number_of_matches, time.time()))
+        self.connection.commit()
+
+    def get_bands(self):
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT band FROM pair_statistics ORDER BY band")]
+
+    def get_statistics(self, off_nadir_type, band=None):
+        # AngleStatistics of one band over every pair recorded so far, or None if there are none
+        if band is None:
+            band = format_band_pair(DEFAULT_BAND_PAIR)
+        rows = self.connection.execute("SELECT statistics FROM pair_statistics WHERE off_nadir_type = ? AND band = ?",
+                                       (off_nadir_type, band)).fetchall()
+        return merge_all(from_json(row[0]) for row in rows)
+
+    def get_aggregates(self, off_nadir_type, band=None):
+        # [(angle, average ratio, standard deviation)] over every pair recorded so far, as aggregate_by_angle
+        # would give for all of their matches together
+        statistics = self.get_statistics(off_nadir_type, band)
+        return [] if statistics is None else statistics.get_aggregates()
+
+    def close(self):
+        self.connection.close()
+
+
+def get_instrument(path):
+    return "MODIS" if path[-3:] == "hdf" else "VIIRS"
+
+
+def list_data_files(directory):
+    return sorted(os.path.abspath(os.path.join(directory, filename)) for filename in os.listdir(directory)
+                  if filename.endswith(".h5") or filename.endswith("hdf"))
+
+
+def parse_band_pairs(text):
+    # "8:Radiance,9:VIIRS-M15-SDR_All/Radiance" -> [(8, "Radiance"), (9, "VIIRS-M15-SDR_All/Radiance")]
+    band_pairs = []
+    for item in text.split(","):
+        modis_band, separator, viirs_data_set = item.strip().partition(":")
+        if not separator or not modis_band.strip().isdigit() or not viirs_data_set.strip():
+            raise Exception("Bands must be given as <MODIS band index>:<VIIRS data set>, not " + item)
+        band_pairs.append((int(modis_band), viirs_data_set.strip()))
+    return band_pairs
+
+
+def format_band_pair(band_pair):
+    return str(band_pair[0]) + ":" + band_pair[1]
+
+
+def parse_settings(arguments=None):
+    parser = argparse.ArgumentParser(description="Compare new nadir/off-nadir granule pairs without prompting.")
+    parser.add_argument("--config", help="INI file with a [batch] section holding any of the settings below")
+    for name, (default, kind) in SETTINGS.items():
+        flag = "--" + name.replace("_", "-")
+        if kind is bool:
+            parser.add_argument(flag, action="store_const", const=True, default=None)
+        else:
+            parser.add_argument(flag, type=kind, default=None)
+    parsed = vars(parser.parse_args(arguments))
+    # Command line flags win over the config file, which wins over the defaults.
+    config = configparser.ConfigParser()
+    if parsed["config"] is not None:
+        if not config.read(parsed["config"]):
+            raise Exception("Could not read config file " + parsed["config"])
+    section = config["batch"] if config.has_section("batch") else {}
+    settings = {}
+    for name, (default, kind) in SETTINGS.items():
+        if parsed[name] is not None:
+            settings[name] = parsed[name]
+        elif name in section:
+            settings[name] = config.getboolean("batch", name) if kind is bool else kind(section[name])
+        else:
+            settings[name] = default
+    if settings["nadir"] is None or settings["off_nadir"] is None:
+        parser.error("--nadir and --off-nadir (or the same keys in the config file) are required")
+    return settings
+
+
+def open_sink(settings):
+    if settings["table"] is None:
+        return None
+    if settings["sqlite"] is not None:
+        return SQLiteSink(settings["sqlite"], settings["table"], store_matches=settings["store_matches"])
+    if settings["db_name"] is not None:
+        db_info = [settings["db_name"], settings["db_user"] or "", settings["db_password"] or ""]
+        return PostgresSink(db_info, settings["table"], store_matches=settings["store_matches"])
+    raise Exception("A table was given without a database (--sqlite or --db-name)")
+
+
+def get_band_tables(settings, band_pairs):
+    # {is reverse: {band pair: table}}. With more than one band each gets its own table,
+    # <table>_<band>_<data set>, with every character of the data set's full name other than a letter or
+    # digit turned into "_". Reverse results go to the same names with "_reverse" appended, so the two
+    # directions are kept apart as main.py keeps them.
+    names = {}
+    for band_pair in band_pairs:
+        names[band_pair] = settings["table"]
+        if len(band_pairs) > 1:
+            names[band_pair] += "_" + re.sub("[^a-zA-Z0-9]", "_", str(band_pair[0]) + "_" + band_pair[1])
+    tables = {False: names, True: dict((band_pair, names[band_pair] + "_reverse") for band_pair in band_pairs)}
+    used = {}
+    for is_reverse in (False, True):
+        for band_pair, table in tables[is_reverse].items():
+            if table in used and used[table] != (is_reverse, band_pair):
+                raise Exception("Band pairs " + format_band_pair(used[table][1]) + " and " +
+                                format_band_pair(band_pair) + " would both be written to table " + table)
+            used[table] = (is_reverse, band_pair)
+    return tables
+
+
+def run_batch(settings):
+    start = time.time()
+    # Stage timings and counters are only collected when they are going to be written somewhere.
+    if settings["metrics_json"] is not None or settings["metrics_prometheus"] is not None:
+        instrumentation.enable()
+    nadir_paths = list_data_files(settings["nadir"])
+    off_nadir_paths = list_data_files(settings["off_nadir"])
+    catalog = GranuleCatalog(settings["catalog"])
+    manifest = PairManifest(settings["manifest"])
+    manifest.check_settings(settings)
+    product_cache = ProductCache(settings["cache"])
+    tasks = catalog.plan_pairs(nadir_paths, off_nadir_paths)
+    forward_pairs = set((task[2], task[3]) for task in tasks)
+    if settings["reverse"]:
+        # Each reverse pair runs right after its forward pair, so both share the files' derived values.
+        tasks = add_reverse_tasks(tasks, catalog.plan_pairs(off_nadir_paths, nadir_paths))
+    catalog.close()
+    planned = len(tasks)
+    tasks = [task for task in tasks if not manifest.is_processed(task[2], task[3])]
+    print("Planned " + str(planned) + " pairs, " + str(len(tasks)) + " not yet processed.")
+    band_pairs = parse_band_pairs(settings["bands"]) if settings["bands"] else [DEFAULT_BAND_PAIR]
+    sink = open_sink(settings)
+    tables = get_band_tables(settings, band_pairs) if sink is not None else None
+    failures = 0
+    for result in run_pair_tasks(tasks, settings["workers"], product_cache, settings["batch_size"], band_pairs,
+                                 settings["frame_interval"], settings["tile_budget"], settings["prefetch"]):
+        # Each batch goes to the sinks and into the pair's statistics, then is dropped.
+        is_reverse = (result.nadir_path, result.off_nadir_path) not in forward_pairs
+        number_of_matches = 0
+        statistics = dict((band_pair, AngleStatistics(settings["bin_width"],
+                                                      quantile_accuracy=settings["quantile_accuracy"]))
+                          for band_pair in band_pairs)
+        if sink is not None:
+            sink.begin_pair()
+        for band_matches in result.iter_batches():
+            number_of_matches += len(band_matches[band_pairs[0]])
+            for band_pair, matches in band_matches.items():
+                statistics[band_pair].add(matches)
+                if sink is not None:
+                    sink.write_matches(matches, tables[is_reverse][band_pair])
+        if result.error is not None:
+            # Not recorded, so the pair is tried again on the next run. Raw matches from batches written
+            # before the failure are rolled back, so the retry does not add them twice.
+            if sink is not None:
+                sink.end_pair(succeeded=False)
+            failures += 1
+            instrumentation.increment("pairs_failed")
+            print("Comparing " + result.off_nadir_name + " to " + result.nadir_name + " failed:\n" + result.error)
+            continue
+        if sink is not None:
+            for band_pair in band_pairs:
+                sink.write_aggregates(statistics[band_pair].get_aggregates(), tables[is_reverse][band_pair])
+            sink.end_pair()
+        manifest.record(result, dict((format_band_pair(band_pair), statistics[band_pair]) for band_pair in band_pairs),
+                        number_of_matches)
+        instrumentation.increment("pairs_compared")
+        print("Compared off-nadir " + result.off_nadir_name + " to nadir values of " + result.nadir_name +
+              ": " + str(number_of_matches) + " matches.")
+    if sink is not None:
+        sink.close()
+    if settings["export"] is not None:
+        export_aggregates(manifest, settings["export"])
+    manifest.close()
+    instrumentation.set_gauge("batch_seconds", time.time() - start)
+    if settings["metrics_json"] is not None:
+        instrumentation.registry.to_json(settings["metrics_json"])
+    if settings["metrics_prometheus"] is not None:
+        instrumentation.registry.to_prometheus(settings["metrics_prometheus"])
+    print("Finished " + str(len(tasks) - failures) + " pairs (" + str(failures) + " failed) in " +
+          str(time.time() - start) + " seconds.")
+    return failures
+
+
+def export_aggregates(manifest, file_name):
+    # CSV of the merged per-angle aggregates for each band and off-nadir instrument, with the 5th, 50th
+    # and 95th percentile ratios when quantile sketches were kept
+    with open(file_name, "w") as file:
+        file.write("band,off_nadir,angle,count,avgv,std,p05,p50,p95\n")
+        for band in manifest.get_bands():
+            for instrument in ("VIIRS", "MODIS"):
+                statistics = manifest.get_statistics(instrument, band)
+                if statistics is None:
+                    continue
+                quantiles = {}
+                if statistics.quantile_accuracy is not None:
+                    quantiles = dict(statistics.get_quantiles())
+                for angle, average, deviation in statistics.get_aggregates():
+                    row = [band, instrument, repr(angle), str(statistics.moments[angle][0]), repr(average),
+                           repr(deviation)]
+                    row += [repr(value) for value in quantiles.get(angle, [])] or ["", "", ""]
+                    file.write(",".join(row) + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(1 if run_batch(parse_settings()) else 0)
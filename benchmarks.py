@@ -0,0 +1,205 @@
+from math import radians, sin, cos, asin, sqrt, atan2, degrees
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import tempfile
+import time
+import numpy
+import geometry
+from database_sink import SQLiteSink
+from file_handler import open_data_file
+from match_table import aggregate_by_angle, concatenate
+import instrumentation
+from synthetic_granules import make_granule_set
+
+# Stages timed by benchmark_stages, in pipeline order
+STAGES = ("file_open", "box_generation", "nadir_extraction", "zone_finding", "coordinate_generation", "matching",
+          "value_extraction", "db_write")
+# The stages iter_off_nadir_matches times itself, under compare_to_off_nadir
+MATCHING_STAGES = ("zone_finding", "coordinate_generation", "matching", "value_extraction")
+
+
+# Scalar versions of the great-circle math GeospatialScanBox used before geometry.py, kept as the
+# reference the array functions are checked and timed against.
+def scalar_brng_d(lat1, lon1, lat2, lon2):
+    lat1 = radians(lat1)
+    lon1 = radians(lon1)
+    lat2 = radians(lat2)
+    lon2 = radians(lon2)
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
+    d = 2 * asin(sqrt(a)) * 6371
+    y = sin(dlon) * cos(lat2)
+    x = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dlon)
+    return d, atan2(y, x)
+
+
+def scalar_new_point(lat1, lon1, d, brng):
+    R = 6371
+    lat1 = radians(lat1)
+    lon1 = radians(lon1)
+    lat2 = asin(sin(lat1) * cos(d / R) + cos(lat1) * sin(d / R) * cos(brng))
+    lon2 = lon1 + atan2(sin(brng) * sin(d / R) * cos(lat1), cos(d / R) - sin(lat1) * sin(lat2))
+    return degrees(lat2), degrees(lon2)
+
+
+def random_points(number_of_points, seed=0):
+    rng = numpy.random.RandomState(seed)
+    lat1 = rng.uniform(-85, 85, number_of_points)
+    lon1 = rng.uniform(-180, 180, number_of_points)
+    lat2 = numpy.clip(lat1 + rng.uniform(-5, 5, number_of_points), -89, 89)
+    lon2 = lon1 + rng.uniform(-5, 5, number_of_points)
+    return lat1, lon1, lat2, lon2
+
+
+def check_geometry_accuracy(number_of_points=10000):
+    # Largest absolute difference between the array functions and the scalar reference (see
+    # tests/test_geometry.py for the tolerance).
+    lat1, lon1, lat2, lon2 = random_points(number_of_points)
+    expected = [scalar_brng_d(*p) for p in zip(lat1, lon1, lat2, lon2)]
+    d = numpy.array([e[0] for e in expected])
+    brng = numpy.array([e[1] for e in expected])
+    expected_points = numpy.array([scalar_new_point(*p) for p in zip(lat1, lon1, d, brng)])
+    new_lat, new_lon = geometry.destination(lat1, lon1, d, brng)
+    errors = {"distance_km": float(numpy.max(numpy.abs(geometry.distance(lat1, lon1, lat2, lon2) - d))),
+              "bearing_rad": float(numpy.max(numpy.abs(geometry.bearing(lat1, lon1, lat2, lon2) - brng))),
+              "destination_lat_deg": float(numpy.max(numpy.abs(new_lat - expected_points[:, 0]))),
+              "destination_lon_deg": float(numpy.max(numpy.abs(new_lon - expected_points[:, 1])))}
+    return errors
+
+
+def benchmark_geometry(sizes=(10 ** 3, 10 ** 5, 10 ** 7), max_scalar_points=10 ** 5):
+    # Scalar timings are taken on at most max_scalar_points points and scaled up linearly beyond that.
+    results = []
+    for size in sizes:
+        lat1, lon1, lat2, lon2 = random_points(size)
+        start = time.time()
+        d = geometry.distance(lat1, lon1, lat2, lon2)
+        brng = geometry.bearing(lat1, lon1, lat2, lon2)
+        geometry.destination(lat1, lon1, d, brng)
+        array_seconds = time.time() - start
+        scalar_points = min(size, max_scalar_points)
+        start = time.time()
+        for i in range(scalar_points):
+            scalar_d, scalar_brng = scalar_brng_d(lat1[i], lon1[i], lat2[i], lon2[i])
+            scalar_new_point(lat1[i], lon1[i], scalar_d, scalar_brng)
+        scalar_seconds = (time.time() - start) * size / scalar_points
+        results.append({"points": size,
+                        "array_seconds": array_seconds,
+                        "scalar_seconds": scalar_seconds,
+                        "scalar_points_timed": scalar_points,
+                        "speedup": scalar_seconds / array_seconds if array_seconds else float("inf")})
+    return results
+
+
+def timed(timings, stage, function, *args):
+    start = time.time()
+    result = function(*args)
+    timings[stage] = time.time() - start
+    return result
+
+
+def benchmark_pair(nadir_path, off_nadir_path, database_file):
+    # {stage: seconds} for one nadir -> off-nadir comparison, starting from unopened files, and the number
+    # of matches found.
+    timings = {}
+    nadir_file, off_nadir_file = timed(timings, "file_open", lambda: (open_data_file(nadir_path),
+                                                                      open_data_file(off_nadir_path)))
+    try:
+        timed(timings, "box_generation", lambda: off_nadir_file.box_set)
+        nadir_points, nadir_radiances = timed(timings, "nadir_extraction",
+                                              lambda: (nadir_file.generate_nadir_data_points(),
+                                                       nadir_file.get_nadir_radiances()))
+        # Matched the way a run matches, batch by batch; the stage times come from its own instrumentation.
+        was_enabled = instrumentation.is_enabled()
+        instrumentation.enable()
+        instrumentation.registry.reset()
+        try:
+            matches = concatenate(off_nadir_file.iter_off_nadir_matches(nadir_points, nadir_radiances))
+            timers = instrumentation.registry.snapshot()["timers"]
+        finally:
+            if not was_enabled:
+                instrumentation.disable()
+        for stage in MATCHING_STAGES:
+            timings[stage] = timers.get("compare_to_off_nadir/" + stage, [0, 0.0])[1]
+    finally:
+        nadir_file.close_file()
+        off_nadir_file.close_file()
+
+    def write():
+        sink = SQLiteSink(database_file, "benchmark", store_matches=True)
+        sink.write_aggregates(aggregate_by_angle(matches))
+        sink.write_matches(matches)
+        sink.close()
+    timed(timings, "db_write", write)
+    return timings, len(matches)
+
+
+def benchmark_stages(directory=None, modis_granules=1, viirs_granules=4, overlap=1.0, repeats=3):
+    # Generates a synthetic granule set and times every stage for each pair in both directions. The
+    # fastest of the repeats is kept for each stage.
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="overpass_benchmark_")
+    modis_paths, viirs_paths = make_granule_set(directory, modis_granules, viirs_granules, overlap)
+    database_file = os.path.join(directory, "benchmark.db")
+    pairs = [(v, m) for v in viirs_paths for m in modis_paths] + [(m, v) for m in modis_paths for v in viirs_paths]
+    results = []
+    totals = dict((stage, 0.0) for stage in STAGES)
+    for nadir_path, off_nadir_path in pairs:
+        best = None
+        for repeat in range(repeats):
+            if os.path.exists(database_file):
+                os.remove(database_file)
+            timings, number_of_matches = benchmark_pair(nadir_path, off_nadir_path, database_file)
+            best = timings if best is None else dict((stage, min(best[stage], timings[stage])) for stage in STAGES)
+        for stage in STAGES:
+            totals[stage] += best[stage]
+        results.append({"nadir": os.path.basename(nadir_path),
+                        "off_nadir": os.path.basename(off_nadir_path),
+                        "matches": number_of_matches,
+                        "stages": best,
+                        "total_seconds": sum(best.values())})
+    return {"parameters": {"modis_granules": modis_granules, "viirs_granules": viirs_granules,
+                           "overlap": overlap, "repeats": repeats},
+            "pairs": results,
+            "stage_totals": totals,
+            "total_seconds": sum(totals.values())}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Geometry and per-stage pipeline benchmarks on synthetic granules.")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--directory", help="where to write the synthetic granules (default: a temporary directory)")
+    parser.add_argument("--modis-granules", type=int, default=1)
+    parser.add_argument("--viirs-granules", type=int, default=4)
+    parser.add_argument("--overlap", type=float, default=1.0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--skip-geometry", action="store_true")
+    arguments = parser.parse_args()
+    report = {"commit": get_commit(), "created": datetime.datetime.now().isoformat()}
+    if not arguments.skip_geometry:
+        report["geometry_accuracy"] = check_geometry_accuracy()
+        report["geometry"] = benchmark_geometry()
+        print("Geometry accuracy (max abs error): " + str(report["geometry_accuracy"]))
+        for result in report["geometry"]:
+            print(str(result["points"]) + " points: array " + str(round(result["array_seconds"], 4)) + "s, scalar " +
+                  str(round(result["scalar_seconds"], 4)) + "s, speedup " + str(round(result["speedup"], 1)) + "x")
+    report["stages"] = benchmark_stages(arguments.directory, arguments.modis_granules, arguments.viirs_granules,
+                                        arguments.overlap, arguments.repeats)
+    for pair in report["stages"]["pairs"]:
+        print(pair["off_nadir"] + " vs nadir " + pair["nadir"] + ": " + str(pair["matches"]) + " matches, " +
+              ", ".join(stage + " " + str(round(pair["stages"][stage], 4)) + "s" for stage in STAGES))
+    if arguments.output is not None:
+        with open(arguments.output, "w") as file:
+            json.dump(report, file, indent=2)
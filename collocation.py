@@ -0,0 +1,126 @@
+import datetime
+from math import cos
+import numpy
+from spatial_index import GeolocationGridIndex
+import instrumentation
+
+# Matches per batch when matching is streamed
+DEFAULT_BATCH_SIZE = 65536
+# All times are converted to seconds from the IET epoch used by the VIIRS MidTime data sets.
+REFERENCE_TIME = datetime.datetime(1958, 1, 1)
+
+
+def times_to_seconds(times, reference=REFERENCE_TIME):
+    return numpy.array([(t - reference).total_seconds() for t in times], dtype=numpy.float64)
+
+
+class NadirTrack(object):
+
+    def __init__(self, nadir_points):
+        self.latitudes = numpy.array([p.get_coordinates()[0] for p in nadir_points])
+        self.longitudes = numpy.array([p.get_coordinates()[1] for p in nadir_points])
+        self.times = times_to_seconds([p.get_time() for p in nadir_points])
+        self.positions = numpy.array([p.get_nadir_pos() for p in nadir_points], dtype=numpy.int64)
+        self.max_coordinate_differences = numpy.array([p.max_coordinate_difference for p in nadir_points],
+                                                      dtype=numpy.float64)
+        self.max_time_differences = numpy.array([p.max_time_difference.total_seconds() for p in nadir_points],
+                                                dtype=numpy.float64)
+        # Longitude tolerance widens with latitude, mirroring NadirPoint.within_geospatial_range
+        self.max_longitude_differences = numpy.array(
+            [r + r * (1 - cos(lat)) for r, lat in zip(self.max_coordinate_differences, self.latitudes)],
+            dtype=numpy.float64)
+
+    def __len__(self):
+        return len(self.latitudes)
+
+
+class OffNadirGeolocation(object):
+
+    def __init__(self, coordinates, scans, time_axis, cell_size=0.25, frame_interval=5, frame_offset=0):
+        coordinates = numpy.asarray(coordinates)
+        if coordinates.size == 0:
+            coordinates = numpy.empty((0, 0, 2))
+        # coordinates = [scan][along frame index] -> (lat, lon)
+        self.latitudes = coordinates[:, :, 0]
+        self.longitudes = coordinates[:, :, 1]
+        self.scans = numpy.asarray(scans, dtype=numpy.int64)
+        self.time_axis = time_axis
+        # Scans are counted from one, so 1 is subtracted to index the time axis.
+        self.times = time_axis.times[self.scans - 1]
+        self.cell_size = cell_size
+        # Along frame index c of the coordinates stands for data frame c * frame_interval + frame_offset.
+        self.frame_interval = frame_interval
+        self.frame_offset = frame_offset
+        self.index = None
+
+    def __len__(self):
+        return len(self.scans)
+
+    def get_index(self):
+        if self.index is None:
+            self.index = GeolocationGridIndex(self.latitudes, self.longitudes, self.cell_size)
+        return self.index
+
+    def get_coordinate(self, row, frame):
+        return self.latitudes[row, frame], self.longitudes[row, frame]
+
+    def get_frame_positions(self, frames):
+        return frames * self.frame_interval + self.frame_offset
+
+
+def find_candidate_matches(track, geolocation, allowed_scans=None):
+    # Returns (nadir index, geolocation row, frame index) triples ordered exactly as nested
+    # nadir -> scan -> frame loops would visit them. Only off-nadir pixels near each nadir point are
+    # ever looked at, so the cost follows the number of matches rather than the swath size.
+    batches = list(iter_candidate_matches(track, geolocation, allowed_scans, batch_size=None))
+    if not batches:
+        empty = numpy.empty(0, dtype=numpy.int64)
+        return empty, empty, empty
+    return tuple(numpy.concatenate([batch[i] for batch in batches]) for i in range(3))
+
+
+def iter_candidate_matches(track, geolocation, allowed_scans=None, batch_size=DEFAULT_BATCH_SIZE):
+    # Same triples as find_candidate_matches, yielded in order as (n, o, c) arrays of batch_size
+    # matches (the last batch may be shorter). batch_size=None yields everything in one batch.
+    if len(track) == 0 or len(geolocation) == 0:
+        return
+    allowed_rows = numpy.ones(len(geolocation), dtype=bool)
+    if allowed_scans is not None:
+        allowed_rows = numpy.isin(geolocation.scans, numpy.asarray(allowed_scans, dtype=numpy.int64))
+    index = geolocation.get_index()
+    time_axis = geolocation.time_axis
+    starts, ends = time_axis.join(track.times, track.max_time_differences)
+    instrumentation.increment("nadir_points", len(track))
+    nadir_indices = []
+    row_indices = []
+    frame_indices = []
+    pending = 0
+    for n in numpy.nonzero(starts < ends)[0]:
+        rows, frames = index.query_scans_and_frames(track.latitudes[n], track.longitudes[n],
+                                                    track.max_coordinate_differences[n],
+                                                    track.max_longitude_differences[n])
+        keep = allowed_rows[rows] & time_axis.in_range(geolocation.scans[rows] - 1, starts[n], ends[n])
+        instrumentation.increment("candidates_tested", len(rows))
+        rows = rows[keep]
+        if len(rows) == 0:
+            continue
+        nadir_indices.append(numpy.full(len(rows), n, dtype=numpy.int64))
+        row_indices.append(rows)
+        frame_indices.append(frames[keep])
+        pending += len(rows)
+        while batch_size is not None and pending >= batch_size:
+            batch = split_batch(nadir_indices, row_indices, frame_indices, batch_size)
+            pending -= batch_size
+            yield batch
+    if pending:
+        yield tuple(numpy.concatenate(columns) for columns in (nadir_indices, row_indices, frame_indices))
+
+
+def split_batch(nadir_indices, row_indices, frame_indices, batch_size):
+    # Takes the first batch_size entries off the pending chunk lists (in place) and returns them.
+    batch = []
+    for columns in (nadir_indices, row_indices, frame_indices):
+        joined = numpy.concatenate(columns)
+        batch.append(joined[:batch_size])
+        columns[:] = [joined[batch_size:]]
+    return tuple(batch)
@@ -4,6 +4,41 @@ from pyhdf.HDF import *
 import datetime
 import numpy
 from data_structures import NadirPoint
+import instrumentation
+
+
+def average_detectors(block, number_of_values_per_scan, fill_mask=None):
+    # Averages every group of number_of_values_per_scan rows (the detectors of one scan) column by
+    # column. Rows after the last complete scan are dropped. Returns a float64 array of shape
+    # (scans, columns). Values flagged in fill_mask are left out of the mean; a column whose
+    # detectors are all fill values comes back as NaN.
+    block = numpy.asarray(block)
+    scans = block.shape[0] // number_of_values_per_scan
+    block = block[:scans * number_of_values_per_scan].reshape(scans, number_of_values_per_scan, block.shape[1])
+    if fill_mask is None:
+        return block.mean(axis=1, dtype=numpy.float64)
+    fill_mask = numpy.asarray(fill_mask)[:scans * number_of_values_per_scan].reshape(block.shape)
+    counts = numpy.count_nonzero(~fill_mask, axis=1)
+    sums = numpy.where(fill_mask, 0, block).sum(axis=1, dtype=numpy.float64)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.where(counts > 0, sums / counts, numpy.nan)
+
+
+def average_gathered_detectors(values, fill_mask=None):
+    # values = [pixel][detector], as gathered for matches. Averaged like average_detectors: fill values
+    # are left out and a pixel with nothing but fill values comes back as NaN.
+    fill_mask = None if fill_mask is None else numpy.asarray(fill_mask).T
+    return average_detectors(numpy.asarray(values).T, numpy.shape(values)[1], fill_mask)[0]
+
+
+def viirs_fill_mask(values):
+    # VIIRS SDR/GEO fill values: -999.x for floating point sets, 65528-65535 for 16-bit integer sets.
+    values = numpy.asarray(values)
+    if values.dtype.kind == "f":
+        return values <= -999.0
+    if values.dtype == numpy.uint16:
+        return values >= 65528
+    return numpy.zeros(values.shape, dtype=bool)
 
 
 class AquaVDataSet(object):
@@ -13,23 +48,32 @@ class AquaVDataSet(object):
         else:
             raise Exception("Invalid data set type for AquaVDataSet")
 
-    def generate_nadir_point_search_boxes(self, scan_start_time, search_box_duration, search_box_space):
-        point_list = []
-        scan_time = scan_start_time
+    def read_nadir_records(self):
+        # [record] -> (scan number, nadir along-swath frame, latitude, longitude)
+        records = []
         while 1:
             try:
                 record = self.data.read()
-                latitude = record[0][7]
-                longitude = record[0][8]
-                scan_number = record[0][0]
-                nadir_along_swath_frame = record[0][6]
-                nadir_point = NadirPoint(latitude, longitude, scan_time, scan_number, search_box_space,
-                                         search_box_duration, nadir_along_swath_frame)
-                point_list.append(nadir_point)
-                scan_time += datetime.timedelta(seconds=1.4771)
+                records.append((record[0][0], record[0][6], record[0][7], record[0][8]))
             except HDF4Error:
                 break
-        return point_list
+        return numpy.array(records, dtype=numpy.float64).reshape(-1, 4)
+
+    def generate_nadir_point_search_boxes(self, scan_start_time, search_box_duration, search_box_space):
+        return nadir_points_from_records(self.read_nadir_records(), scan_start_time, search_box_duration,
+                                         search_box_space)
+
+
+def nadir_points_from_records(records, scan_start_time, search_box_duration, search_box_space):
+    # records as returned by AquaVDataSet.read_nadir_records; scans are 1.4771 seconds apart.
+    point_list = []
+    scan_time = scan_start_time
+    for scan_number, nadir_along_swath_frame, latitude, longitude in numpy.asarray(records).tolist():
+        nadir_point = NadirPoint(latitude, longitude, scan_time, int(scan_number), search_box_space,
+                                 search_box_duration, int(nadir_along_swath_frame))
+        point_list.append(nadir_point)
+        scan_time += datetime.timedelta(seconds=1.4771)
+    return point_list
 
 
 class AquaSDSDataSet(object):
@@ -41,6 +85,7 @@ class AquaSDSDataSet(object):
             self.info = data_set.info()
             self.rank = self.info[1]
             self.name = self.info[0]
+            self.band_planes = {}
             if "KM" in self.info[0]:
                 # dictionary describing types of MODIS files -> number of detectors
                 detectors = {"1KM": 10, "QKM": 40, "HKM": 20}
@@ -61,54 +106,47 @@ class AquaSDSDataSet(object):
     def get_specific_data_point(self, x, y):
         return float(self.data.get([x, y], [1, 1]))
 
-    def compare_values(self, match, viirs_value, s0=1, s1=1):
-        scan_value = match.get_modis_scan()
-        swath_pos = match.get_modis_swath_pos()
+    def get_band_plane(self, band):
+        # Kept once read, so values can be gathered batch by batch without reading the band again
+        if band not in self.band_planes:
+            self.band_planes[band] = numpy.asarray(self.data[band])
+            instrumentation.increment("bytes_read", self.band_planes[band].nbytes, data_set=self.name)
+        return self.band_planes[band]
+
+    def gather_calibrated_values(self, scan_values, swath_positions, s0=1, s1=1, band=8):
+        # Detector-averaged, calibrated values for every (scan, swath position) pair. The band plane
+        # is read once for all of them. 8 = MODIS Band 28.
+        scan_values = numpy.asarray(scan_values, dtype=numpy.int64)
+        swath_positions = numpy.asarray(swath_positions, dtype=numpy.int64)
+        band_plane = self.get_band_plane(band)
         # Scan value is NOT scaled from zero, so one must be subtracted.
-        modis_base = self.get_data_chunk_3d(8,
-                                            (scan_value - 1) * self.num_of_detectors,
-                                            scan_value * self.num_of_detectors - 1,
-                                            swath_pos,
-                                            swath_pos,
-                                            self.num_of_detectors)
-        modis_adjusted = s0 * (modis_base[0][0].item() - s1)
-        match.set_comparison_values_modis_offnad(viirs_value, modis_adjusted, swath_pos)
+        rows = (scan_values[:, None] - 1) * self.num_of_detectors + numpy.arange(self.num_of_detectors)[None, :]
+        values = band_plane[rows, swath_positions[:, None]]
+        modis_base = average_gathered_detectors(values, self.get_fill_mask(values))
+        return s0 * (modis_base - s1)
 
+    # Both chunk functions return float64 arrays of shape (scans, end_y - start_y + 1), each value the
+    # mean over one scan's detectors with fill values left out (NaN if every detector is fill).
     def get_data_chunk_3d(self, band, start_x, end_x, start_y, end_y, number_of_values_per_scan):
         if self.rank == 3:
-            final_list = []
-            big_list = []
-            data_subset = self.data[band]
-            filter_subset = data_subset[start_x:end_x + 1, start_y:end_y + 1]
-            for row in filter_subset:
-                big_list.append(row)
-                if len(big_list) % number_of_values_per_scan == 0:
-                    final_list.append((list(map(self.data_mean, zip(*big_list)))))
-                    big_list = []
-            return final_list
+            data_subset = self.data.get([band, start_x, start_y], [1, (end_x - start_x) + 1, (end_y - start_y) + 1])[0]
+            instrumentation.increment("bytes_read", data_subset.nbytes, data_set=self.name)
+            return average_detectors(data_subset, number_of_values_per_scan, self.get_fill_mask(data_subset))
         else:
             raise Exception("Attempted to 3D-Chunk a Non-3D data set.")
 
     def get_data_chunk_2d(self, start_x, end_x, start_y, end_y, number_of_values_per_scan):
         if self.rank == 2:
-            final_list = []
-            big_list = []
             data_subset = self.data.get([start_x, start_y], [(end_x - start_x) + 1, (end_y - start_y) + 1])
-            for row in data_subset:
-                big_list.append(row)
-                if len(big_list) % number_of_values_per_scan == 0:
-                    # zip(*big_list) takes all the lists (rows) in big_list and creates one new list, where each element ...
-                    # is another list containing the values from each row at corresponding indices.
-                    # [1,2,3] and [2,3,4] zipped becomes [[1,2],[2,3],[3,4]]
-                    # map applies the 'data_mean' function to every member of zip(*big_list)
-                    final_list.append(list(map(self.data_mean, zip(*big_list))))
-                    big_list = []
-            return final_list
+            instrumentation.increment("bytes_read", data_subset.nbytes, data_set=self.name)
+            return average_detectors(data_subset, number_of_values_per_scan, self.get_fill_mask(data_subset))
         else:
             raise Exception("Attempted to 2D-Chunk a Non-2D data set.")
 
-    def data_mean(self, a):
-        return sum(a) / len(a)
+    def get_fill_mask(self, values):
+        if "_FillValue" in self.attributes:
+            return values == self.get_fill_value()
+        return None
 
     def get_scales_and_offsets_for_band(self, band, dtype):
         if dtype == "Radiance":
@@ -145,12 +183,15 @@ class AquaSDSDataSet(object):
 
 class SuomiDataSet(object):
 
-    def __init__(self, data_set):
+    def __init__(self, data_set, cache=None):
         if isinstance(data_set, SDS):
             raise Exception("Invalid data set type for SuomiDataSet")
         else:
             self.ref_data = data_set
-            self.data = numpy.array(self.ref_data)
+            # The values are only read from disk the first time self.data is used, and are shared
+            # through the file's DataSetCache when one is given.
+            self.cache = cache
+            self.loaded_data = None
             self.attributes = self.ref_data.attrs
             self.dimensions = self.ref_data.shape
             # the -1 works on even 1D data sets
@@ -162,6 +203,29 @@ class SuomiDataSet(object):
                     self.num_of_detectors = 32
                     self.band_type = "I"
 
+    @property
+    def data(self):
+        if self.loaded_data is None:
+            if self.cache is not None:
+                self.loaded_data = self.cache.get(self.ref_data.name, self.read_data)
+            else:
+                self.loaded_data = self.read_data()
+        return self.loaded_data
+
+    def read_data(self):
+        data = numpy.array(self.ref_data)
+        instrumentation.increment("bytes_read", data.nbytes, data_set=self.ref_data.name)
+        return data
+
+    def read_hyperslab(self, start_x, end_x, start_y, end_y, interval=1):
+        # Rows start_x to end_x and every interval-th column from start_y to end_y. Unless the whole array
+        # is already in memory only this slab is read from disk, so it is never loaded in full.
+        if self.loaded_data is None and (self.cache is None or self.ref_data.name not in self.cache):
+            data = self.ref_data[start_x:(end_x + 1), start_y:(end_y + 1):interval]
+            instrumentation.increment("bytes_read", data.nbytes, data_set=self.ref_data.name)
+            return data
+        return self.data[start_x:(end_x + 1), start_y:(end_y + 1):interval]
+
     def get_dimensions(self):
         return tuple(self.dimensions)
 
@@ -169,7 +233,7 @@ class SuomiDataSet(object):
         return self.attributes
 
     def get_specific_data_point(self, x, y):
-        return self.data[x, y]
+        return self.read_hyperslab(x, x, y, y)[0, 0]
 
     def get_scale_factors(self):
         c0 = []
@@ -179,16 +243,16 @@ class SuomiDataSet(object):
             c1.append(self.data[i + 1])
         return c0, c1
 
-    def chunk_and_return_scan_data_for(self, start_x, end_x, start_y, end_y):
-        final_list = []
-        big_list = []
-        data_subset = self.data[start_x:(end_x + 1), start_y:(end_y + 1)]
-        for row in data_subset:
-            big_list.append(self.get_elements_at_interval(row, 5))
-            if len(big_list) % self.num_of_detectors == 0:
-                final_list.append(list(map(self.data_mean, zip(*big_list))))
-                big_list = []
-        return final_list
+    # Returns a float64 array of shape (scans, columns): every interval-th column between start_y and
+    # end_y, averaged over each scan's detectors with fill values left out (NaN if all are fill).
+    def chunk_and_return_scan_data_for(self, start_x, end_x, start_y, end_y, interval=5):
+        data_subset = self.data[start_x:(end_x + 1), start_y:(end_y + 1):interval]
+        return average_detectors(data_subset, self.num_of_detectors, viirs_fill_mask(data_subset))
+
+    # Same as chunk_and_return_scan_data_for, reading only the hyperslab it needs.
+    def read_scan_data_for(self, start_x, end_x, start_y, end_y, interval=5):
+        data_subset = self.read_hyperslab(start_x, end_x, start_y, end_y, interval)
+        return average_detectors(data_subset, self.num_of_detectors, viirs_fill_mask(data_subset))
 
     # This function is for I-Band data sets (Reflectance, Radiances) ONLY.
     def get_aggregate_value(self, ref_x, ref_y):
@@ -203,10 +267,8 @@ class SuomiDataSet(object):
             raise Exception("4x4 Aggregation only intended for I-Band data sets.")
 
     def get_elements_at_interval(self, unmodified_list, interval):
-        modified_list = []
-        for i in range(0, len(unmodified_list), interval):
-            modified_list.append(unmodified_list[i])
-        return modified_list
+        # Strided view, no copy is made for arrays.
+        return numpy.asarray(unmodified_list)[::interval]
 
     def sum_single_column_set(self):
         num = 0
@@ -214,9 +276,6 @@ class SuomiDataSet(object):
             num += column
         return num
 
-    def data_mean(self, a):
-        return sum(a) / len(a)
-
     def convert_all_microseconds(self):
         # Inteded for: MidTime and StartTime sets.
         times = []
@@ -227,16 +286,23 @@ class SuomiDataSet(object):
             times.append(corrected_time)
         return times
 
-    def compare_values(self, match, modis_value, s0=1, s1=1):
-        scan_value = match.get_viirs_scan()
-        swath_pos = match.get_viirs_swath_pos()
+    def gather_calibrated_values(self, scan_values, swath_positions, s0=1, s1=1, tiled=False):
+        # Detector-averaged, calibrated values for every (scan, swath position) pair in one gather.
+        # s0/s1 may be arrays holding each pair's granule scale factors. tiled=True only reads the
+        # hyperslab around the pairs instead of the whole data set (see tiling.py).
+        scan_values = numpy.asarray(scan_values, dtype=numpy.int64)
+        swath_positions = numpy.asarray(swath_positions, dtype=numpy.int64)
         # scan value is NOT scaled form zero, so 1 must be subtracted.
-        viirs_base = self.chunk_and_return_scan_data_for((scan_value - 1) * self.num_of_detectors,
-                                                         scan_value * self.num_of_detectors - 1,
-                                                         swath_pos,
-                                                         swath_pos)
-        viirs_adjusted = s0 * viirs_base[0][0].item() + s1
-        match.set_comparison_values_viirs_offnad(viirs_adjusted, modis_value, swath_pos)
+        rows = (scan_values[:, None] - 1) * self.num_of_detectors + numpy.arange(self.num_of_detectors)[None, :]
+        if tiled and len(rows):
+            first_row = rows.min()
+            first_column = swath_positions.min()
+            slab = self.read_hyperslab(first_row, rows.max(), first_column, swath_positions.max())
+            values = slab[rows - first_row, swath_positions[:, None] - first_column]
+        else:
+            values = self.data[rows, swath_positions[:, None]]
+        viirs_base = average_gathered_detectors(values, viirs_fill_mask(values))
+        return numpy.asarray(s0) * viirs_base + numpy.asarray(s1)
 
     def get_nadir_data_by_scan(self, scales, offsets):
         nadir_frame = self.dimensions[1] // 2
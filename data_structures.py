@@ -1,5 +1,6 @@
-from math import radians, sin, cos, asin, sqrt, atan2, degrees
+from math import cos
 import numpy
+import geometry
 
 
 class NadirPoint(object):
@@ -25,7 +26,7 @@ class NadirPoint(object):
         return self.scan_time
 
     def within_time_range(self, other_time):
-        time_difference = self.scan_time - other_time
+        time_difference = abs(self.scan_time - other_time)
         if time_difference <= self.max_time_difference:
             return True
         else:
@@ -33,15 +34,26 @@ class NadirPoint(object):
 
     def within_geospatial_range(self, other_coordinate):
         latitude_difference = self.coordinate[0] - other_coordinate[0]
-        longitude_difference = self.coordinate[1] - other_coordinate[1]
+        # Longitudes are compared the short way around, so points either side of the antimeridian still match.
+        longitude_difference = abs(self.coordinate[1] - other_coordinate[1]) % 360
+        longitude_difference = min(longitude_difference, 360 - longitude_difference)
         if abs(latitude_difference) <= self.max_coordinate_difference:
-            if abs(longitude_difference) <= (self.max_coordinate_difference + self.max_coordinate_difference*(1-cos(self.coordinate[0]))):
+            if longitude_difference <= (self.max_coordinate_difference + self.max_coordinate_difference*(1-cos(self.coordinate[0]))):
                 return True
             else:
                 return False
         else:
             return False
 
+# Both scan angle formulas work on single swath positions as well as on arrays of them.
+def viirs_scan_angle(swath):
+    return (2.*swath +0.5-33.5)*0.017785 -56.063
+
+
+def modis_scan_angle(swath):
+    return 2.0 * ((10.5+swath/1353 * 55.0) - 38.0)
+
+
 class TwoPointComparison(object):
     # TODO: Improve Constructor Clarity
 
@@ -61,13 +73,13 @@ class TwoPointComparison(object):
         self.viirs_value = v_rad
         self.modis_value = m_rad
         self.difference_ratio = v_rad / m_rad
-        self.scan_angle = (2.*swath +0.5-33.5)*0.017785 -56.063
+        self.scan_angle = viirs_scan_angle(swath)
 
     def set_comparison_values_modis_offnad(self, v_rad, m_rad, swath):
         self.viirs_value = v_rad
         self.modis_value = m_rad
         self.difference_ratio = m_rad / v_rad
-        self.scan_angle = 2.0 * ((10.5+swath/1353 * 55.0) - 38.0)
+        self.scan_angle = modis_scan_angle(swath)
 
     def return_info(self):
         tp = (self.viirs_scan_number, self.modis_scan_number, self.viirs_swath_pos, self.modis_swath_pos, self.viirs_value, self.modis_value, self.difference_ratio, self.scan_angle)
@@ -106,6 +118,9 @@ class GeospatialScanBox(object):
         self.start_scan = start_scan
         self.end_scan = end_scan
         self.crosses_anti = self.crosses_antemeridian()
+        # The footprint never changes, so its outline and extents are worked out once here.
+        self.polygon = self.get_edge_values()
+        self.extents = self.get_extents()
 
     def crosses_antemeridian(self):
         if abs(self.top_left[1]) > 80.0 and abs(self.top_right[1]) > 80.0:
@@ -121,70 +136,47 @@ class GeospatialScanBox(object):
 
     def get_brng_d(self, lat1, lon1, lat2, lon2):
         if self.crosses_anti:
-            if (-180 <= lon1 < 0):
-                lon1 += 360
-            if (-180 <= lon2 < 0):
-                lon2 += 360
-        lat1 = radians(lat1)
-        lon1 = radians(lon1)
-        lat2 = radians(lat2)
-        lon2 = radians(lon2)
-
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-        c = 2 * asin(sqrt(a))
-        d = c * 6371
-        y = sin(dlon) * cos(lat2)
-        x = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dlon)
-        brng = atan2(y, x)
+            lon1 = geometry.shift_across_antimeridian(lon1)
+            lon2 = geometry.shift_across_antimeridian(lon2)
+        d = geometry.distance(lat1, lon1, lat2, lon2)
+        brng = geometry.bearing(lat1, lon1, lat2, lon2)
         return d, brng
 
     def get_new_point(self, lat1, lon1, d, brng):
-        if self.crosses_anti and (-180 <= lon1 < 0):
-            lon1 += 360
-        R = 6371
-        lat1 = radians(lat1)
-        lon1 = radians(lon1)
-        lat2 = asin(sin(lat1) * cos(d / R) + cos(lat1) * sin(d / R) * cos(brng))
-        lon2 = lon1 + atan2(sin(brng) * sin(d / R) * cos(lat1), cos(d / R) - sin(lat1) * sin(lat2))
-
-        lat2 = degrees(lat2)
-        lon2 = degrees(lon2)
-        if self.crosses_anti and lon2 > 180:
-            lon2 -= 360
+        # d may be an array of distances, in which case arrays of points are returned.
+        if self.crosses_anti:
+            lon1 = geometry.shift_across_antimeridian(lon1)
+        lat2, lon2 = geometry.destination(lat1, lon1, d, brng)
+        if self.crosses_anti:
+            lon2 = geometry.unshift_across_antimeridian(lon2)
         return lat2, lon2
 
     def get_edge_points(self, point1, point2):
         distance, bearing = self.get_brng_d(point1[0], point1[1], point2[0], point2[1])
+        if not distance > 0:
+            # Coincident (or unusable) corners: the edge is just its starting point.
+            return numpy.array([point1], dtype=numpy.float64).reshape(-1, 2)
         increment = distance / 30
-        point_list = []
-        for i in numpy.arange(0, distance, increment):
-            point_list.append(tuple(self.get_new_point(point1[0], point1[1], i, bearing)))
-        return point_list
+        lats, lons = self.get_new_point(point1[0], point1[1], numpy.arange(0, distance, increment), bearing)
+        return numpy.column_stack((lats, lons))
 
     def get_edge_values(self):
         edge1 = self.get_edge_points(self.top_left, self.top_right)
         edge2 = self.get_edge_points(self.top_right, self.bottom_right)
         edge3 = self.get_edge_points(self.bottom_left, self.bottom_right)
         edge4 = self.get_edge_points(self.top_left, self.bottom_left)
-        return edge1 + edge2 + edge3 + edge4
+        return numpy.concatenate((edge1, edge2, edge3, edge4))
+
+    def get_extents(self):
+        # (smallest lat, biggest lat, smallest lon, biggest lon) of the edge points
+        if len(self.polygon) == 0:
+            return 1000.0, -1000.0, 1000.0, -1000.0
+        smallest_lat, smallest_lon = self.polygon.min(axis=0)
+        biggest_lat, biggest_lon = self.polygon.max(axis=0)
+        return smallest_lat, biggest_lat, smallest_lon, biggest_lon
 
     def encapsulates(self, coordinate):
-        edge_points = self.get_edge_values()
-        smallest_lat = 1000
-        smallest_lon = 1000
-        biggest_lat = -1000
-        biggest_lon = -1000
-        for point in edge_points:
-            if point[0] > biggest_lat:
-                biggest_lat = point[0]
-            if point[0] < smallest_lat:
-                smallest_lat = point[0]
-            if point[1] > biggest_lon:
-                biggest_lon = point[1]
-            if point[1] < smallest_lon:
-                smallest_lon = point[1]
+        smallest_lat, biggest_lat, smallest_lon, biggest_lon = self.extents
         if (smallest_lon <= coordinate[1] <= biggest_lon) and (smallest_lat <= coordinate[0] <= biggest_lat):
             return True
         else:
@@ -199,3 +191,57 @@ class GeospatialScanBox(object):
 
     def __str__(self):
         return str(self.top_left) + " " + str(self.bottom_right)
+
+
+def scan_boxes_to_arrays(boxes):
+    # corners[box] = (top left, bottom left, top right, bottom right), scans[box] = (start scan, end scan)
+    corners = numpy.array([(box.top_left, box.bottom_left, box.top_right, box.bottom_right) for box in boxes]).reshape(-1, 4, 2)
+    scans = numpy.array([(box.start_scan, box.end_scan) for box in boxes], dtype=numpy.int64).reshape(-1, 2)
+    return corners, scans
+
+
+def scan_boxes_from_arrays(corners, scans):
+    return [GeospatialScanBox(tuple(corners[b, 0]), tuple(corners[b, 1]), tuple(corners[b, 2]), tuple(corners[b, 3]),
+                              int(scans[b, 0]), int(scans[b, 1])) for b in range(len(scans))]
+
+
+class ScanBoxSet(object):
+    # Column-wise copy of a list of GeospatialScanBoxes so that many boxes can be tested against many
+    # coordinates in one array operation.
+
+    def __init__(self, boxes):
+        self.boxes = list(boxes)
+        extents = numpy.array([box.extents for box in self.boxes], dtype=numpy.float64).reshape(-1, 4)
+        self.smallest_lats = extents[:, 0]
+        self.biggest_lats = extents[:, 1]
+        self.smallest_lons = extents[:, 2]
+        self.biggest_lons = extents[:, 3]
+        self.start_scans = numpy.array([box.get_starting_scan() for box in self.boxes], dtype=numpy.int64)
+        self.end_scans = numpy.array([box.get_ending_scan() for box in self.boxes], dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __getitem__(self, item):
+        return self.boxes[item]
+
+    def contains(self, latitudes, longitudes):
+        # [box][coordinate] -> True when the coordinate is inside the box extents
+        latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+        longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+        inside = (self.smallest_lats[:, None] <= latitudes[None, :]) & (latitudes[None, :] <= self.biggest_lats[:, None]) & \
+                 (self.smallest_lons[:, None] <= longitudes[None, :]) & (longitudes[None, :] <= self.biggest_lons[:, None])
+        return inside
+
+    def within_time_windows(self, time_axis, starts, ends):
+        # [box][window] -> True when any of the box's scans falls in the time window
+        in_time = numpy.zeros((len(self.boxes), len(starts)), dtype=bool)
+        for b in range(len(self.boxes)):
+            in_time[b] = time_axis.any_in_window(self.start_scans[b] - 1, self.end_scans[b] - 1, starts, ends)
+        return in_time
+
+    def find_boxes_with_matches(self, track, time_axis):
+        starts, ends = time_axis.join(track.times, track.max_time_differences)
+        in_time = self.within_time_windows(time_axis, starts, ends)
+        has_match = numpy.any(in_time & self.contains(track.latitudes, track.longitudes), axis=1)
+        return [self.boxes[b] for b in numpy.nonzero(has_match)[0]]
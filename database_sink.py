@@ -0,0 +1,185 @@
+import csv
+import io
+import queue
+import sqlite3
+import threading
+import time
+import numpy
+import instrumentation
+from match_table import COLUMNS, COLUMN_NAMES
+
+AGGREGATE_COLUMNS = ("angle", "avgv", "std")
+
+
+class DatabaseSink(object):
+    # Writes rows from a background thread. Producers only put batches on a bounded queue (blocking
+    # when the writer falls behind), and the writer inserts them in chunks of batch_size rows and
+    # commits at most every commit_interval seconds. Backends implement connect() and insert_rows().
+    # Everything written between begin_pair() and end_pair() is inside a savepoint: the rows go to the
+    # database as they come, but a pair that fails is rolled back, so running it again adds no
+    # duplicates. Commits only happen between pairs.
+
+    def __init__(self, table, store_matches=False, batch_size=1000, commit_interval=5.0, queue_size=16):
+        self.table = table
+        # Raw per-match rows go to a second table named <table>_matches.
+        self.match_table = table + "_matches"
+        self.store_matches = store_matches
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.rows_written = 0
+        self.thread = threading.Thread(target=self.run_writer, name="database-sink", daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        raise NotImplementedError
+
+    def insert_rows(self, cursor, table, columns, rows):
+        raise NotImplementedError
+
+    def write_aggregates(self, rows, table=None):
+        # rows: [(angle, average ratio, standard deviation)]. table defaults to the sink's own, and raw
+        # matches for another table go to <table>_matches.
+        self.put(table or self.table, AGGREGATE_COLUMNS, [tuple(float(value) for value in row) for row in rows])
+
+    def write_matches(self, matches, table=None):
+        if self.store_matches and len(matches):
+            columns = [matches.column(name).tolist() for name in COLUMN_NAMES]
+            self.put(self.match_table if table is None else table + "_matches", COLUMN_NAMES, list(zip(*columns)))
+
+    def begin_pair(self):
+        self.put_item(("begin",))
+
+    def end_pair(self, succeeded=True):
+        # Keeps the pair's rows, or rolls them back if the pair failed
+        self.put_item(("release",) if succeeded else ("rollback",))
+
+    def put(self, table, columns, rows):
+        if rows:
+            self.put_item(("rows", table, columns, rows))
+
+    def put_item(self, item):
+        if self.error is not None:
+            raise Exception("Database writer failed: " + str(self.error))
+        self.queue.put(item)
+
+    def rolled_back(self):
+        # Called after a pair is rolled back, for backends that keep track of what they created
+        pass
+
+    def run_writer(self):
+        connection = None
+        try:
+            connection = self.connect()
+            cursor = connection.cursor()
+            last_commit = time.time()
+            in_pair = False
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.commit_interval)
+                except queue.Empty:
+                    item = ("idle",)
+                if item is None:
+                    break
+                if item[0] == "rows":
+                    kind, table, columns, rows = item
+                    with instrumentation.stage("db_write"):
+                        for start in range(0, len(rows), self.batch_size):
+                            self.insert_rows(cursor, table, columns, rows[start:start + self.batch_size])
+                    self.rows_written += len(rows)
+                    instrumentation.increment("rows_written", len(rows), table=table)
+                elif item[0] == "begin":
+                    cursor.execute("SAVEPOINT pair")
+                    in_pair = True
+                elif item[0] == "release":
+                    cursor.execute("RELEASE SAVEPOINT pair")
+                    in_pair = False
+                elif item[0] == "rollback":
+                    self.roll_back_pair(cursor)
+                    in_pair = False
+                if not in_pair and time.time() - last_commit >= self.commit_interval:
+                    connection.commit()
+                    last_commit = time.time()
+            # A pair that was never ended did not finish
+            if in_pair:
+                self.roll_back_pair(cursor)
+            connection.commit()
+        except Exception as e:
+            self.error = e
+            # Keep draining so producers blocked on a full queue are released; put() reports the error.
+            while self.queue.get() is not None:
+                pass
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def roll_back_pair(self, cursor):
+        cursor.execute("ROLLBACK TO SAVEPOINT pair")
+        cursor.execute("RELEASE SAVEPOINT pair")
+        instrumentation.increment("pairs_rolled_back")
+        self.rolled_back()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise Exception("Database writer failed: " + str(self.error))
+
+
+class PostgresSink(DatabaseSink):
+    # Tables must already exist (see README). Aggregates are sent as multi-row VALUES statements and
+    # raw matches through COPY.
+
+    def __init__(self, db_info, table, **kwargs):
+        # db_info = [database, username, password]
+        self.db_info = db_info
+        DatabaseSink.__init__(self, table, **kwargs)
+
+    def connect(self):
+        import psycopg2
+        return psycopg2.connect("dbname=" + self.db_info[0] + " user=" + self.db_info[1] + " password=" + self.db_info[2])
+
+    def insert_rows(self, cursor, table, columns, rows):
+        if columns == COLUMN_NAMES:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            buffer.seek(0)
+            cursor.copy_expert("COPY " + table + " (" + ", ".join(columns) + ") FROM STDIN WITH (FORMAT csv)", buffer)
+        else:
+            from psycopg2.extras import execute_values
+            execute_values(cursor, "INSERT INTO " + table + " (" + ", ".join(columns) + ") VALUES %s", rows,
+                           page_size=self.batch_size)
+
+
+class SQLiteSink(DatabaseSink):
+    # Same interface backed by a local SQLite file, so no database server is needed. Missing tables
+    # are created on their first write.
+
+    def __init__(self, database_file, table, **kwargs):
+        self.database_file = database_file
+        DatabaseSink.__init__(self, table, **kwargs)
+
+    def connect(self):
+        connection = sqlite3.connect(self.database_file)
+        self.created_tables = set()
+        return connection
+
+    def rolled_back(self):
+        # Tables created within the pair are gone again
+        self.created_tables.clear()
+
+    def create_table(self, connection, table, columns):
+        if columns == COLUMN_NAMES:
+            definition = ", ".join(name + (" INTEGER" if numpy.dtype(dtype).kind == "i" else " REAL")
+                                   for name, dtype in COLUMNS)
+        else:
+            definition = "angle REAL, avgv REAL, std REAL"
+        connection.execute("CREATE TABLE IF NOT EXISTS " + table + " (" + definition + ")")
+        self.created_tables.add(table)
+
+    def insert_rows(self, cursor, table, columns, rows):
+        if table not in self.created_tables:
+            self.create_table(cursor.connection, table, columns)
+        cursor.executemany("INSERT INTO " + table + " (" + ", ".join(columns) + ") VALUES (" +
+                           ", ".join("?" * len(columns)) + ")", rows)
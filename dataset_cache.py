@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+import instrumentation
+
+# Default memory budget per file: enough for the full M-band geolocation and radiance arrays of a
+# 4-granule CLASS file several times over.
+DEFAULT_MEMORY_BUDGET = 1024 ** 3
+
+
+class DataSetCache(object):
+    # In-memory LRU cache of arrays read from one file, keyed by data set name. Once the total size
+    # goes over memory_budget bytes the least recently used arrays are dropped. Arrays bigger than the
+    # whole budget are handed back without being kept. Safe to share with a prefetch thread: an array
+    # is read once, by whichever thread asks for it first, while any other thread asking for the same
+    # array waits for it.
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.arrays = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.lock = threading.RLock()
+        # key -> Event set once the thread reading that array is done
+        self.loading = {}
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def get(self, key, loader):
+        while True:
+            with self.lock:
+                if key in self.arrays:
+                    self.hits += 1
+                    instrumentation.increment("dataset_cache_hits")
+                    self.arrays.move_to_end(key)
+                    return self.arrays[key]
+                loading = self.loading.get(key)
+                if loading is None:
+                    self.misses += 1
+                    instrumentation.increment("dataset_cache_misses")
+                    self.loading[key] = threading.Event()
+                    break
+            # Another thread is reading this array. Look again once it is done; if it failed, or the array
+            # was too big to keep, this thread reads it itself.
+            loading.wait()
+        # Read outside the lock, so arrays under other keys can be read (or found) meanwhile
+        try:
+            array = loader()
+            with self.lock:
+                self.bytes_read += array.nbytes
+                if array.nbytes <= self.memory_budget:
+                    self.arrays[key] = array
+                    self.nbytes += array.nbytes
+                    self.evict()
+                    instrumentation.set_gauge("dataset_cache_bytes", self.nbytes)
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+        return array
+
+    def evict(self):
+        with self.lock:
+            while self.nbytes > self.memory_budget and self.arrays:
+                key, array = self.arrays.popitem(last=False)
+                self.nbytes -= array.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.arrays.clear()
+            self.nbytes = 0
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
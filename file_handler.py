@@ -2,22 +2,53 @@ from pyhdf.SD import *
 from pyhdf.HDF import *
 import h5py
 import re
-import time
 import numpy
 import datetime
-from data_sets import AquaSDSDataSet, SuomiDataSet, AquaVDataSet
-from data_structures import NadirPoint, TwoPointComparison, GeospatialScanBox
-
+from data_sets import AquaSDSDataSet, SuomiDataSet, AquaVDataSet, nadir_points_from_records
+from data_structures import NadirPoint, GeospatialScanBox, ScanBoxSet, scan_boxes_to_arrays, scan_boxes_from_arrays
+from collocation import NadirTrack, OffNadirGeolocation, iter_candidate_matches, times_to_seconds, \
+    DEFAULT_BATCH_SIZE
+from time_axis import ScanTimeAxis
+from geolocation_pyramid import DEFAULT_FRAME_INTERVAL, BLOCK_FRAMES, coarsen, find_candidate_blocks, refine
+from tiling import plan_tiles
+from match_table import MatchTable, concatenate
+from dataset_cache import DataSetCache, DEFAULT_MEMORY_BUDGET
+import instrumentation
+
+# (MODIS band index in EV_1KM_Emissive, VIIRS SDR data set) compared unless others are asked for.
+# 8 = MODIS Band 28. A VIIRS data set outside the file's main SDR group is given as "<group>/<data set>".
+DEFAULT_BAND_PAIR = (8, "Radiance")
 
 class HDF4File(object):
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, product_cache=None):
         self.hdf_file = HDF(file_name, HC.READ)
         self.sd_file_interface = SD(file_name, SDC.READ)
         self.v_file_interface = self.hdf_file.vstart()
         self.attributes = self.sd_file_interface.attributes()
-        self.boxes = self.generate_lat_lon_boxes()
+        # Scan boxes read geolocation from disk, so they are only generated on first use.
+        self.scan_boxes = None
+        self.scan_box_set = None
+        # Optional ProductCache for values derived from this file (see product_cache.py)
+        self.product_cache = product_cache
+        self.geolocation = None
+        self.time_axis = None
+        # AquaSDSDataSets by name, so band planes read once are kept for every pair using the file
+        self.sds_data_sets = {}
         self.name = file_name.split("/")[-1]
+        self.path = file_name
+
+    @property
+    def boxes(self):
+        if self.scan_boxes is None:
+            self.scan_boxes = cached_lat_lon_boxes(self)
+        return self.scan_boxes
+
+    @property
+    def box_set(self):
+        if self.scan_box_set is None:
+            self.scan_box_set = ScanBoxSet(self.boxes)
+        return self.scan_box_set
 
     def get_attributes(self):
         return self.attributes
@@ -30,6 +61,12 @@ class HDF4File(object):
             times.append(start_time + datetime.timedelta(seconds=(1.4771 * i)))
         return times
 
+    def get_time_axis(self):
+        if self.time_axis is None:
+            self.time_axis = ScanTimeAxis(cached_product(self, "scan_times",
+                                                         lambda: times_to_seconds(self.get_times_list())))
+        return self.time_axis
+
     def get_start_time(self):
         core_metadata = self.attributes['CoreMetadata.0']
         regex = re.compile('[M][Y][D][.A-Z0-9]+[.][h][d][f]')
@@ -45,7 +82,9 @@ class HDF4File(object):
         return date_and_time
 
     def get_specific_sds_data_set(self, data_set_name):
-        return AquaSDSDataSet(self.sd_file_interface.select(data_set_name))
+        if data_set_name not in self.sds_data_sets:
+            self.sds_data_sets[data_set_name] = AquaSDSDataSet(self.sd_file_interface.select(data_set_name))
+        return self.sds_data_sets[data_set_name]
 
     def get_specific_v_data_set(self, data_set_name):
         return AquaVDataSet(self.v_file_interface.attach(data_set_name))
@@ -59,73 +98,91 @@ class HDF4File(object):
         longitudes = self.get_specific_sds_data_set("Longitude")
         return latitudes, longitudes
 
-    def generate_scans_and_coordinates(self, zones):
-        coordinate_list = []
-        offnad_scan_list = []
+    def compare_to_off_nadir(self, nadir_objects, nadir_comp_data, offnad_data="EV_1KM_Emissive"):
+        return concatenate(self.iter_off_nadir_matches(nadir_objects, nadir_comp_data, offnad_data, batch_size=None))
+
+    def iter_off_nadir_matches(self, nadir_objects, nadir_comp_data, offnad_data="EV_1KM_Emissive",
+                               batch_size=DEFAULT_BATCH_SIZE, band=8, frame_interval=DEFAULT_FRAME_INTERVAL,
+                               tile_budget=None):
+        # The matches compare_to_off_nadir returns, in the same order, as MatchTables of batch_size rows
+        for tables in self.iter_band_matches(nadir_objects, [nadir_comp_data], [(offnad_data, band)], batch_size,
+                                             frame_interval, tile_budget):
+            yield tables[0]
+
+    def iter_band_matches(self, nadir_objects, nadir_values, bands, batch_size=DEFAULT_BATCH_SIZE,
+                          frame_interval=DEFAULT_FRAME_INTERVAL, tile_budget=None):
+        # Matches for several bands at once: the geometry is worked out once and each band's values are
+        # gathered at the same pixels. bands holds (data set, band index) tuples (see get_band) and
+        # nadir_values the nadir file's values for each. Yields one MatchTable per band for every batch.
+        # frame_interval is the matching resolution (see get_geolocation_level). MODIS files are small
+        # enough to be read whole, so tile_budget is not used here (see HDF5File.iter_band_matches).
+        track = NadirTrack(nadir_objects)
+        with instrumentation.stage("compare_to_off_nadir"):
+            with instrumentation.stage("zone_finding"):
+                offn_scans = self.find_zone_scans(nadir_objects)
+            with instrumentation.stage("coordinate_generation"):
+                geolocation = self.get_geolocation_level(track, offn_scans, frame_interval)
+        data_sets = {}
+        for data_set_name, band in bands:
+            if data_set_name not in data_sets:
+                data_sets[data_set_name] = self.get_specific_sds_data_set(data_set_name)
+        candidates = iter_candidate_matches(track, geolocation, offn_scans, batch_size)
+        while True:
+            # Nothing is timed across the yield, so the consumer's own stages are not nested in these.
+            with instrumentation.stage("compare_to_off_nadir"):
+                with instrumentation.stage("matching"):
+                    batch = next(candidates, None)
+                    if batch is None:
+                        break
+                    matches = self.build_match_table(track, geolocation, *batch)
+                with instrumentation.stage("value_extraction"):
+                    tables = [matches] + [matches.copy_geometry() for i in range(len(bands) - 1)]
+                    for table, nadir_comp_data, (data_set_name, band) in zip(tables, nadir_values, bands):
+                        self.set_match_values(table, batch[0], nadir_comp_data, data_set_name,
+                                              data_sets[data_set_name], band)
+            instrumentation.increment("matches", len(matches), off_nadir="MODIS")
+            yield tables
+
+    def find_zone_scans(self, nadir_objects):
+        offn_scans = []
+        zones = self.find_zones_with_matches(nadir_objects)
+        instrumentation.increment("boxes_tested", len(self.box_set))
+        instrumentation.increment("boxes_with_matches", len(zones))
         for area in zones:
-            # scan number - 1 = the scan index (from zero)
-            # scan index * 2 - the along-track index for MODIS geolocation values (2 values per scan)
-            # the +1 ensures the "end" index is at the last of the two geolocation values for the ending scan
-            coordinate_list += self.generate_coordinate_data_points((area.get_starting_scan() - 1) * 2,
-                                                                    (area.get_ending_scan() - 1) * 2 + 1)
-            offnad_scan_list += area.get_scan_list()
-        return coordinate_list, offnad_scan_list
+            offn_scans += area.get_scan_list()
+        return offn_scans
 
-    def compare_to_off_nadir(self, nadir_objects, nadir_comp_data, offnad_data="EV_1KM_Emissive"):
-        find_boxes_start = time.time()
-        print("Finding valid search boxes...")
-        search_zones = self.find_zones_with_matches(nadir_objects)
-        offn_coords, offn_scans = self.generate_scans_and_coordinates(search_zones)
-        find_boxes_end = time.time()
-        print("Finihsed! Process took " + str(find_boxes_end-find_boxes_start))
-        offnad_data_set = self.get_specific_sds_data_set(offnad_data)
-        # 8 = MODIS Band 28. Replace with Index for appropriate band if needed.
-        if offnad_data == "EV_1KM_RefSB":
-            scale, offset = offnad_data_set.get_scales_and_offsets_for_band(8, "Reflectance")
-        else:
-            scale, offset = offnad_data_set.get_scales_and_offsets_for_band(8, "Radiance")
-        times = self.get_times_list()
-        matches = []
-        print("Running comparisons...")
-        comparison_start = time.time()
+    def build_match_table(self, track, geolocation, n, o, c):
         # n - nadir scan index
-        # o - off-nadir scan index
+        # o - off-nadir geolocation row (scan index)
         # c - coordinate index (along frame index)
-        for n in range(len(nadir_objects)):
-            for o in range(len(offn_scans)):
-                # offnadir scan time = times[offn_scans[o] - 1]
-                if nadir_objects[n].within_time_range(times[offn_scans[o] - 1]):
-                    for c in range(len(offn_coords[o])):
-                        if nadir_objects[n].within_geospatial_range(offn_coords[o][c]):
-                            # c * 5 + 2 - converts the Along Frame Index for a geolocation file into an Along Frame Index for data.
-                            tpc = TwoPointComparison(n + 1,
-                                                     offn_scans[o],
-                                                     nadir_objects[n].get_nadir_pos(),
-                                                     (c * 5 + 2),
-                                                     offn_coords[o][c],
-                                                     nadir_objects[n].get_coordinates())
-                            offnad_data_set.compare_values(tpc,
-                                                          nadir_comp_data[n],
-                                                          s0=scale,
-                                                          s1=offset)
-                            matches.append(tpc)
-        comparison_end = time.time()
-        print("Finished! Process took " + str(comparison_end-comparison_start))
-        return matches
+        # c * 5 + 2 - converts the Along Frame Index for a geolocation file into an Along Frame Index for data
+        # (c * 40 + 2 when every 8th geolocation frame is matched, see get_geolocation_level).
+        return MatchTable({"viirs_scan": n + 1,
+                           "modis_scan": geolocation.scans[o],
+                           "viirs_swath_pos": track.positions[n],
+                           "modis_swath_pos": geolocation.get_frame_positions(c),
+                           "modis_lat": geolocation.latitudes[o, c],
+                           "modis_lon": geolocation.longitudes[o, c],
+                           "viirs_lat": track.latitudes[n],
+                           "viirs_lon": track.longitudes[n]})
+
+    def set_match_values(self, matches, nadir_indices, nadir_comp_data, offnad_data="EV_1KM_Emissive",
+                         offnad_data_set=None, band=8):
+        if offnad_data_set is None:
+            offnad_data_set = self.get_specific_sds_data_set(offnad_data)
+        # 8 = MODIS Band 28.
+        if offnad_data == "EV_1KM_RefSB":
+            scale, offset = offnad_data_set.get_scales_and_offsets_for_band(band, "Reflectance")
+        else:
+            scale, offset = offnad_data_set.get_scales_and_offsets_for_band(band, "Radiance")
+        modis_values = offnad_data_set.gather_calibrated_values(matches.column("modis_scan"),
+                                                                matches.column("modis_swath_pos"),
+                                                                s0=scale, s1=offset, band=band)
+        matches.set_comparison_values_modis_offnad([nadir_comp_data[i] for i in nadir_indices], modis_values)
 
     def find_zones_with_matches(self, nadir_object_list):
-        potential_match_boxes = self.boxes
-        times = self.get_times_list()
-        valid_zones = []
-        for box in potential_match_boxes:
-            start_time = times[box.get_starting_scan() - 1]
-            end_time = times[box.get_ending_scan() - 1]
-            for nadir_point in nadir_object_list:
-                if (nadir_point.within_time_range(start_time) or nadir_point.within_time_range(end_time)) and box.encapsulates(
-                        nadir_point.get_coordinates()):
-                    valid_zones.append(box)
-                    break
-        return valid_zones
+        return self.box_set.find_boxes_with_matches(NadirTrack(nadir_object_list), self.get_time_axis())
 
     def find_valid_factor(self):
         # Assumes scans will always range between 202-204 per granule
@@ -169,10 +226,30 @@ class HDF4File(object):
         # dimensions[1] - 1 = max y coordinate
         lat_coords = latitudes.get_data_chunk_2d(start_x, end_x, 0, dimensions[1] - 1, scale_factor)
         long_coords = longitudes.get_data_chunk_2d(start_x, end_x, 0, dimensions[1] - 1, scale_factor)
-        coordinates = []
-        for i in range(len(long_coords)):
-            coordinates.append(list(zip(lat_coords[i], long_coords[i])))
-        return coordinates
+        # coordinates[scan][along frame index] = (lat, lon)
+        return numpy.stack((lat_coords, long_coords), axis=-1)
+
+    def get_off_nadir_geolocation(self):
+        # Decimated coordinates for every scan in the granule, read once and spatially indexed on first use.
+        if self.geolocation is None:
+            latitudes, longitudes = self.get_lat_lon_sets()
+            along_track_len = latitudes.get_dimensions()[0]
+            scale_factor = self.get_scan_to_node_scale_factor(along_track_len)
+            coordinates = cached_product(self, "off_nadir_coordinates",
+                                         lambda: self.generate_coordinate_data_points(0, along_track_len - 1))
+            self.geolocation = OffNadirGeolocation(coordinates, range(1, along_track_len // scale_factor + 1),
+                                                   self.get_time_axis(), frame_interval=5, frame_offset=2)
+        return self.geolocation
+
+    def get_geolocation_level(self, track, offn_scans, frame_interval=DEFAULT_FRAME_INTERVAL):
+        # Off-nadir geolocation with a sample every frame_interval data frames (see geolocation_pyramid.py).
+        # The MODIS geolocation data sets only hold every 5th frame, so finer intervals get that, and
+        # coarser ones are rounded down to a multiple of 5.
+        geolocation = self.get_off_nadir_geolocation()
+        step = int(frame_interval) // geolocation.frame_interval
+        if step <= 1:
+            return geolocation
+        return coarsen(geolocation, step)
 
     def get_scan_to_node_scale_factor(self, scaled_dimension):
         number_of_scans = self.get_number_of_scans()
@@ -180,17 +257,26 @@ class HDF4File(object):
 
     def generate_nadir_data_points(self):
         scan_start_time = self.get_start_time()
-        metadata = self.get_specific_v_data_set('Level 1B Swath Metadata')
+        records = cached_product(self, "nadir_records",
+                                 lambda: self.get_specific_v_data_set('Level 1B Swath Metadata').read_nadir_records())
         # allow inputs for ranges
-        nadir_point_list = metadata.generate_nadir_point_search_boxes(scan_start_time, datetime.timedelta(minutes=15), .10)
+        nadir_point_list = nadir_points_from_records(records, scan_start_time, datetime.timedelta(minutes=15), .10)
         return nadir_point_list
 
-    def get_nadir_radiances(self):
-        radiances = self.get_specific_sds_data_set('EV_1KM_Emissive')
-        # 8 - MODIS Band 28, replace with whichever band.
-        ret_vals = radiances.get_nadir_data_by_scan(8)
+    def get_nadir_radiances(self, data_set_name='EV_1KM_Emissive', band=8):
+        radiances = self.get_specific_sds_data_set(data_set_name)
+        # 8 - MODIS Band 28
+        ret_vals = cached_nadir_radiances(self, lambda: radiances.get_nadir_data_by_scan(band), (data_set_name, band))
         return ret_vals
 
+    def get_band(self, band_pair):
+        # This file's side of a (MODIS band, VIIRS data set) pair, as get_nadir_radiances arguments
+        return 'EV_1KM_Emissive', band_pair[0]
+
+    def load_band(self, data_set_name='EV_1KM_Emissive', band=8):
+        # Reads a band's values ahead of matching (see prefetch.py)
+        self.get_specific_sds_data_set(data_set_name).get_band_plane(band)
+
     def get_number_of_scans(self):
         scans = self.attributes['Number of Scans']
         return scans
@@ -199,14 +285,19 @@ class HDF4File(object):
         return self.name
 
     def close_file(self):
+        self.sds_data_sets.clear()
         self.sd_file_interface.end()
         self.v_file_interface.end()
         self.hdf_file.close()
 
 
 class HDF5File(object):
-    def __init__(self, file_name):
+    def __init__(self, file_name, memory_budget=DEFAULT_MEMORY_BUDGET, product_cache=None):
         self.hdf_file = h5py.File(file_name, "r")
+        # Every array read from this file goes through the cache, so each is read from disk at most once.
+        self.data_cache = DataSetCache(memory_budget)
+        self.times = None
+        self.number_of_scans = None
         self.main_group = self.hdf_file['All_Data']
         for item in self.main_group.keys():
             if "SDR" in item:
@@ -215,26 +306,56 @@ class HDF5File(object):
                 self.file_type = item[6]
             if "GEO" in item:
                 self.geo_group = self.main_group[item]
-        self.boxes = self.generate_lat_lon_boxes()
+        # Scan boxes read geolocation from disk, so they are only generated on first use.
+        self.scan_boxes = None
+        self.scan_box_set = None
+        # Optional ProductCache for values derived from this file (see product_cache.py)
+        self.product_cache = product_cache
+        self.geolocation = None
+        self.time_axis = None
         if "RadianceFactors" in self.sdr_group:
             self.c0, self.c1 = self.get_radiance_factors()
         if "ReflectanceFactors" in self.sdr_group:
             self.s0, self.s1 = self.get_reflectance_factors()
         self.name = file_name.split("/")[-1]
+        self.path = file_name
+
+    @property
+    def boxes(self):
+        if self.scan_boxes is None:
+            self.scan_boxes = cached_lat_lon_boxes(self)
+        return self.scan_boxes
+
+    @property
+    def box_set(self):
+        if self.scan_box_set is None:
+            self.scan_box_set = ScanBoxSet(self.boxes)
+        return self.scan_box_set
 
     def get_specific_sdr_data_set(self, data_set_name):
-        return SuomiDataSet(self.sdr_group[data_set_name])
+        # "<group>/<data set>" reaches data sets in other SDR groups under All_Data
+        if "/" in data_set_name:
+            return SuomiDataSet(self.main_group[data_set_name], self.data_cache)
+        return SuomiDataSet(self.sdr_group[data_set_name], self.data_cache)
 
     def get_specific_geo_data_set(self, data_set_name):
-        return SuomiDataSet(self.geo_group[data_set_name])
+        return SuomiDataSet(self.geo_group[data_set_name], self.data_cache)
 
     def list_data_sets(self):
         for data_set in self.hdf_file.keys():
             print(data_set)
 
     def get_times_list(self):
-        mid_time = self.get_specific_geo_data_set('MidTime')
-        return mid_time.convert_all_microseconds()
+        if self.times is None:
+            mid_time = self.get_specific_geo_data_set('MidTime')
+            self.times = mid_time.convert_all_microseconds()
+        return self.times
+
+    def get_time_axis(self):
+        if self.time_axis is None:
+            self.time_axis = ScanTimeAxis(cached_product(self, "scan_times",
+                                                         lambda: times_to_seconds(self.get_times_list())))
+        return self.time_axis
 
     def get_lat_lon_sets(self):
         lat = self.get_specific_geo_data_set('Latitude')
@@ -242,21 +363,21 @@ class HDF5File(object):
         return lat, lon
 
     def get_number_of_scans(self):
-        num_of_scans_set = self.get_specific_geo_data_set('NumberOfScans')
-        return num_of_scans_set.sum_single_column_set()
+        if self.number_of_scans is None:
+            num_of_scans_set = self.get_specific_geo_data_set('NumberOfScans')
+            self.number_of_scans = num_of_scans_set.sum_single_column_set()
+        return self.number_of_scans
 
     def get_reflectance_factors(self):
-        try:
-            rad_factors = self.get_specific_sdr_data_set('ReflectanceFactors')
-            c0, c1 = rad_factors.get_scale_factors()
-            return c0, c1
-        # Default values returned if no data found
-        except KeyError:
-            return [1,1,1,1], [0,0,0,0]
+        return self.get_data_set_factors('Reflectance')
 
     def get_radiance_factors(self):
+        return self.get_data_set_factors('Radiance')
+
+    def get_data_set_factors(self, data_set_name):
+        # Per granule scales and offsets of e.g. Radiance, stored next to it as RadianceFactors
         try:
-            rad_factors = self.get_specific_sdr_data_set('RadianceFactors')
+            rad_factors = self.get_specific_sdr_data_set(data_set_name + 'Factors')
             c0, c1 = rad_factors.get_scale_factors()
             return c0, c1
         # Default values returned if no data found
@@ -265,13 +386,13 @@ class HDF5File(object):
 
     # For consistency, the "nadir along frame index" for the next two functions is the value of the dimension (max value) divded by two.
     def generate_nadir_data_points(self):
-        coordinates = self.generate_nadir_coordinates()
+        coordinates = cached_product(self, "nadir_coordinates", self.generate_nadir_coordinates)
         times = self.get_times_list()
         list_of_objs = []
         nadir_along_frame_index = self.get_specific_geo_data_set("Latitude").dimensions[1] // 2
         if len(times) == len(coordinates):
             for scan_no in range(len(coordinates)):
-                list_of_objs.append(NadirPoint(coordinates[scan_no][0][0], coordinates[scan_no][1][0], times[scan_no], scan_no,
+                list_of_objs.append(NadirPoint(coordinates[scan_no][0], coordinates[scan_no][1], times[scan_no], scan_no,
                                                .10, datetime.timedelta(minutes=15), nadir_along_frame_index))
         return list_of_objs
 
@@ -283,73 +404,175 @@ class HDF5File(object):
         lat_dimensions = lat_set.get_dimensions()
         lat_coords = lat_set.chunk_and_return_scan_data_for(0, lat_dimensions[0] - 1, lat_dimensions[1] // 2,
                                                             lat_dimensions[1] // 2)
-        return list(zip(lat_coords, long_coords))
+        # [scan] -> (lat, lon)
+        return numpy.column_stack((lat_coords[:, 0], long_coords[:, 0]))
 
     def compare_to_off_nadir(self, nadir_points, nadir_comp_data, offnad_data="Radiance"):
-        print("Finding valid search zones...")
-        find_boxes_start = time.time()
+        return concatenate(self.iter_off_nadir_matches(nadir_points, nadir_comp_data, offnad_data, batch_size=None))
+
+    def iter_off_nadir_matches(self, nadir_points, nadir_comp_data, offnad_data="Radiance",
+                               batch_size=DEFAULT_BATCH_SIZE, frame_interval=DEFAULT_FRAME_INTERVAL, tile_budget=None):
+        # The matches compare_to_off_nadir returns, in the same order, as MatchTables of batch_size rows
+        for tables in self.iter_band_matches(nadir_points, [nadir_comp_data], [(offnad_data,)], batch_size,
+                                             frame_interval, tile_budget):
+            yield tables[0]
+
+    def iter_band_matches(self, nadir_points, nadir_values, bands, batch_size=DEFAULT_BATCH_SIZE,
+                          frame_interval=DEFAULT_FRAME_INTERVAL, tile_budget=None):
+        # Matches for several bands at once: the geometry is worked out once and each band's values are
+        # gathered at the same pixels. bands holds (data set,) tuples (see get_band) and nadir_values the
+        # nadir file's values for each. Yields one MatchTable per band for every batch.
+        # frame_interval is the matching resolution (see get_geolocation_level). With a tile_budget (in
+        # bytes) the file is read and matched one tile at a time, and batches come tile by tile (see tiling.py).
+        track = NadirTrack(nadir_points)
+        with instrumentation.stage("compare_to_off_nadir"):
+            with instrumentation.stage("zone_finding"):
+                offn_scans = self.find_zone_scans(nadir_points)
+        data_sets = {}
+        for band in bands:
+            if band[0] not in data_sets:
+                data_sets[band[0]] = self.get_specific_sdr_data_set(band[0])
+        tiles = self.iter_geolocation_tiles(track, offn_scans, frame_interval, tile_budget, list(data_sets.values()))
+        while True:
+            with instrumentation.stage("compare_to_off_nadir"):
+                with instrumentation.stage("coordinate_generation"):
+                    geolocation = next(tiles, None)
+            if geolocation is None:
+                break
+            candidates = iter_candidate_matches(track, geolocation, offn_scans, batch_size)
+            while True:
+                # Nothing is timed across the yield, so the consumer's own stages are not nested in these.
+                with instrumentation.stage("compare_to_off_nadir"):
+                    with instrumentation.stage("matching"):
+                        batch = next(candidates, None)
+                        if batch is None:
+                            break
+                        matches = self.build_match_table(track, geolocation, *batch)
+                    with instrumentation.stage("value_extraction"):
+                        tables = [matches] + [matches.copy_geometry() for i in range(len(bands) - 1)]
+                        for table, nadir_comp_data, band in zip(tables, nadir_values, bands):
+                            self.set_match_values(table, batch[0], nadir_comp_data, band[0], data_sets[band[0]],
+                                                  tiled=tile_budget is not None)
+                instrumentation.increment("matches", len(matches), off_nadir="VIIRS")
+                yield tables
+
+    def find_zone_scans(self, nadir_points):
+        offn_scans = []
         zones = self.find_zones_with_matches(nadir_points)
-        offn_coords, offn_scans = self.generate_scans_and_coordinates(zones)
-        scan_times = self.get_times_list()
-        find_boxes_end = time.time()
-        print("Completed in " + str(find_boxes_end - find_boxes_start) + " seconds")
-        comparison_set = self.get_specific_sdr_data_set(offnad_data)
-        matches = []
-        print("Running comparisons ...")
-        compare_time_start = time.time()
-        for n in range(len(nadir_points)):
-            for o in range(len(offn_scans)):
-                if nadir_points[n].within_time_range(scan_times[offn_scans[o]-1]):
-                    for c in range(len(offn_coords[o])):
-                        if nadir_points[n].within_geospatial_range(offn_coords[o][c]):
-                            # c*5 is a modification when only every FIFTH element is chosen
-                            tpc = TwoPointComparison(offn_scans[o],
-                                                     n + 1, c * 5 + 1,
-                                                     nadir_points[n].get_nadir_pos(),
-                                                     nadir_points[n].get_coordinates(),
-                                                     offn_coords[o][c])
-                            # while all the scale factors are normally idenitical, the caluclations here ensure that the scale factors for the exact granule are beign used.
-                            comparison_set.compare_values(tpc, nadir_comp_data[n],
-                                                          self.c0[((offn_scans[o]-1)//48)],
-                                                          self.c1[((offn_scans[o]-1)//48)])
-                            matches.append(tpc)
-        comapre_time_end = time.time()
-        print("Completed in " + str(comapre_time_end-compare_time_start) + " seconds")
-        return matches
-
-    def generate_scans_and_coordinates(self, geo_zones):
-        coordinate_list = []
-        scan_list = []
-        number_of_detectors = 16
-        if self.file_type and self.file_type == "I":
-            number_of_detectors = 32
-        for area in geo_zones:
-            coordinate_list += self.generate_coordinate_data_points(
-                (area.get_starting_scan() - 1) * number_of_detectors,
-                (area.get_ending_scan() - 1) * number_of_detectors + (number_of_detectors-1))
-            scan_list += area.get_scan_list()
-        return coordinate_list, scan_list
+        instrumentation.increment("boxes_tested", len(self.box_set))
+        instrumentation.increment("boxes_with_matches", len(zones))
+        for area in zones:
+            offn_scans += area.get_scan_list()
+        return offn_scans
+
+    def build_match_table(self, track, geolocation, n, o, c):
+        # c*5 is a modification when only every FIFTH element is chosen (c*interval for other resolutions,
+        # see get_geolocation_level)
+        return MatchTable({"viirs_scan": geolocation.scans[o],
+                           "modis_scan": n + 1,
+                           "viirs_swath_pos": geolocation.get_frame_positions(c),
+                           "modis_swath_pos": track.positions[n],
+                           "modis_lat": track.latitudes[n],
+                           "modis_lon": track.longitudes[n],
+                           "viirs_lat": geolocation.latitudes[o, c],
+                           "viirs_lon": geolocation.longitudes[o, c]})
+
+    def set_match_values(self, matches, nadir_indices, nadir_comp_data, offnad_data="Radiance", offnad_data_set=None,
+                         tiled=False):
+        comparison_set = offnad_data_set
+        if comparison_set is None:
+            comparison_set = self.get_specific_sdr_data_set(offnad_data)
+        c0, c1 = self.get_data_set_factors(offnad_data)
+        # while all the scale factors are normally idenitical, the caluclations here ensure that the scale factors for the exact granule are beign used.
+        granules = (matches.column("viirs_scan") - 1) // 48
+        viirs_values = comparison_set.gather_calibrated_values(matches.column("viirs_scan"),
+                                                               matches.column("viirs_swath_pos"),
+                                                               numpy.asarray(c0)[granules],
+                                                               numpy.asarray(c1)[granules], tiled)
+        matches.set_comparison_values_viirs_offnad(viirs_values, [nadir_comp_data[i] for i in nadir_indices])
+
+    def get_off_nadir_geolocation(self):
+        # Decimated coordinates for every scan in the granule, read once and spatially indexed on first use.
+        if self.geolocation is None:
+            lat_set, long_set = self.get_lat_lon_sets()
+            along_track_len = lat_set.get_dimensions()[0]
+            coordinates = cached_product(self, "off_nadir_coordinates",
+                                         lambda: self.generate_coordinate_data_points(0, along_track_len - 1))
+            self.geolocation = OffNadirGeolocation(coordinates, range(1, along_track_len // lat_set.num_of_detectors + 1),
+                                                   self.get_time_axis(), frame_interval=5, frame_offset=1)
+        return self.geolocation
+
+    def get_geolocation_level(self, track, offn_scans, frame_interval=DEFAULT_FRAME_INTERVAL):
+        # Off-nadir geolocation with a sample every frame_interval data frames (see geolocation_pyramid.py).
+        # Coarser intervals are rounded down to a multiple of 5. Finer ones are only read for the blocks of
+        # the default level that could hold a match; they are read at frames c * frame_interval, so that
+        # is the data frame frame c stands for (no offset).
+        geolocation = self.get_off_nadir_geolocation()
+        frame_interval = int(frame_interval)
+        if frame_interval >= geolocation.frame_interval:
+            step = frame_interval // geolocation.frame_interval
+            return geolocation if step == 1 else coarsen(geolocation, step)
+        lat_set, long_set = self.get_lat_lon_sets()
+        detectors = lat_set.num_of_detectors
+
+        def read_scan(scan, first, last):
+            rows = ((scan - 1) * detectors, scan * detectors - 1)
+            return (lat_set.chunk_and_return_scan_data_for(rows[0], rows[1], first, last, frame_interval)[0],
+                    long_set.chunk_and_return_scan_data_for(rows[0], rows[1], first, last, frame_interval)[0])
+
+        block_samples = BLOCK_FRAMES // geolocation.frame_interval
+        blocks = find_candidate_blocks(track, geolocation, offn_scans, block_samples)
+        return refine(geolocation, blocks, block_samples, frame_interval, 0, lat_set.get_dimensions()[1], read_scan)
+
+    def iter_geolocation_tiles(self, track, offn_scans, frame_interval=DEFAULT_FRAME_INTERVAL, tile_budget=None,
+                               value_sets=()):
+        # The off-nadir geolocation to match: all of it (get_geolocation_level) without a tile_budget,
+        # otherwise one tile of consecutive scans at a time, read straight from the file (see tiling.py).
+        # value_sets are the data sets whose values will be read for each tile, to size the tiles.
+        if tile_budget is None:
+            yield self.get_geolocation_level(track, offn_scans, frame_interval)
+            return
+        geolocation = self.get_off_nadir_geolocation()
+        # The same samples as get_geolocation_level: coarser intervals are rounded down to a multiple of the
+        # default level's and keep its offset, finer ones have none.
+        frame_interval = int(frame_interval)
+        frame_offset = 0
+        if frame_interval >= geolocation.frame_interval:
+            frame_interval -= frame_interval % geolocation.frame_interval
+            frame_offset = geolocation.frame_offset
+        lat_set, long_set = self.get_lat_lon_sets()
+        detectors = lat_set.num_of_detectors
+        blocks = find_candidate_blocks(track, geolocation, offn_scans, BLOCK_FRAMES // geolocation.frame_interval)
+        # Raw geolocation and values for every detector, plus the detector-averaged coordinates
+        bytes_per_scan_frame = detectors * sum(data_set.ref_data.dtype.itemsize
+                                               for data_set in [lat_set, long_set] + list(value_sets)) + 16
+        # The halo is one sample of the default level, as in geolocation_pyramid.refine
+        for rows, first, last in plan_tiles(blocks, BLOCK_FRAMES, geolocation.frame_interval, lat_set.get_dimensions()[1],
+                                            bytes_per_scan_frame, tile_budget):
+            scans = geolocation.scans[rows]
+            first -= first % frame_interval
+            start_x = (scans[0] - 1) * detectors
+            end_x = scans[-1] * detectors - 1
+            coordinates = numpy.stack((lat_set.read_scan_data_for(start_x, end_x, first, last, frame_interval),
+                                       long_set.read_scan_data_for(start_x, end_x, first, last, frame_interval)), axis=-1)
+            instrumentation.increment("tiles")
+            # Frame c of a tile is data frame first + c * frame_interval (+ the default level's offset)
+            yield OffNadirGeolocation(coordinates, scans, geolocation.time_axis, geolocation.cell_size, frame_interval,
+                                      first + frame_offset)
 
     def find_zones_with_matches(self, nadir_object_list):
-        boxes = self.boxes
-        scan_times = self.get_times_list()
-        valid_zones = []
-        for box in boxes:
-            start_scan = box.get_starting_scan()
-            end_scan = box.get_ending_scan()
-            for item in nadir_object_list:
-                if (item.within_time_range(scan_times[start_scan-1]) or item.within_time_range(scan_times[end_scan-1])) and box.encapsulates(item.get_coordinates()):
-                    valid_zones.append(box)
-                    break
-        return valid_zones
+        return self.box_set.find_boxes_with_matches(NadirTrack(nadir_object_list), self.get_time_axis())
 
     def generate_lat_lon_boxes(self):
         lat_set, long_set = self.get_lat_lon_sets()
         lat_set_max = lat_set.get_dimensions()[1]
         long_set_max = long_set.get_dimensions()[1]
         scan_num = self.get_number_of_scans()
+        # 16 detectors per scan for M-band geolocation, 32 for I-band; a box spans 24 scans
+        detectors = lat_set.num_of_detectors
+        last_row = 24 * detectors - 1
         boxes = []
-        for val_index in range(0, scan_num*16, 384):
+        for val_index in range(0, scan_num*detectors, 24*detectors):
             start_offset = 0
             end_offset = 0
             top_left = (lat_set.get_specific_data_point(val_index, 0),long_set.get_specific_data_point(val_index, 0))
@@ -360,15 +583,15 @@ class HDF5File(object):
             while self.is_filler_coordiante(top_right):
                 start_offset += 1
                 top_right = (lat_set.get_specific_data_point(val_index+start_offset, lat_set_max-1), long_set.get_specific_data_point(val_index+start_offset, long_set_max-1))
-            bottom_right = (lat_set.get_specific_data_point(val_index+383, lat_set_max-1),long_set.get_specific_data_point(val_index+383, long_set_max-1))
+            bottom_right = (lat_set.get_specific_data_point(val_index+last_row, lat_set_max-1),long_set.get_specific_data_point(val_index+last_row, long_set_max-1))
             while self.is_filler_coordiante(bottom_right):
                 end_offset -= 1
-                bottom_right = (lat_set.get_specific_data_point(val_index+383+end_offset, lat_set_max-1),long_set.get_specific_data_point(val_index+383+end_offset, long_set_max-1))
-            bottom_left = (lat_set.get_specific_data_point(val_index+383, 0), long_set.get_specific_data_point(val_index+383, 0))
+                bottom_right = (lat_set.get_specific_data_point(val_index+last_row+end_offset, lat_set_max-1),long_set.get_specific_data_point(val_index+last_row+end_offset, long_set_max-1))
+            bottom_left = (lat_set.get_specific_data_point(val_index+last_row, 0), long_set.get_specific_data_point(val_index+last_row, 0))
             while self.is_filler_coordiante(bottom_left):
                 end_offset -= 1
-                bottom_left = (lat_set.get_specific_data_point(val_index+383+end_offset, 0),long_set.get_specific_data_point(val_index+383+end_offset, 0))
-            boxes.append(GeospatialScanBox(top_left, bottom_left, top_right, bottom_right, val_index // 16 + 1 + (start_offset//16), val_index // 16 + 24 + (end_offset//16)))
+                bottom_left = (lat_set.get_specific_data_point(val_index+last_row+end_offset, 0),long_set.get_specific_data_point(val_index+last_row+end_offset, 0))
+            boxes.append(GeospatialScanBox(top_left, bottom_left, top_right, bottom_right, val_index // detectors + 1 + (start_offset//detectors), val_index // detectors + 24 + (end_offset//detectors)))
         return boxes
 
     def is_filler_coordiante(self, coord):
@@ -377,25 +600,73 @@ class HDF5File(object):
         else:
             return False
 
-    def get_nadir_radiances(self):
-        scales, offsets = self.get_radiance_factors()
-        radiances = self.get_specific_sdr_data_set("Radiance")
-        data = radiances.get_nadir_data_by_scan(scales, offsets)
+    def get_nadir_radiances(self, data_set_name="Radiance"):
+        scales, offsets = self.get_data_set_factors(data_set_name)
+        radiances = self.get_specific_sdr_data_set(data_set_name)
+        data = cached_nadir_radiances(self, lambda: radiances.get_nadir_data_by_scan(scales, offsets), (data_set_name,))
         return data
 
+    def get_band(self, band_pair):
+        # This file's side of a (MODIS band, VIIRS data set) pair, as get_nadir_radiances arguments
+        return (band_pair[1],)
+
+    def load_band(self, data_set_name="Radiance"):
+        # Reads a data set's values (and factors) into the file's DataSetCache ahead of matching (see prefetch.py)
+        self.get_specific_sdr_data_set(data_set_name).data
+        self.get_data_set_factors(data_set_name)
+
     def generate_coordinate_data_points(self, start_x, end_x):
         lat_set, long_set = self.get_lat_lon_sets()
         lat_dimensions = lat_set.get_dimensions()
         long_dimensions = long_set.get_dimensions()
-        long_coords = long_set.chunk_and_return_scan_data_for(start_x, end_x, 0, long_dimensions[1] - 1)
-        lat_coords = lat_set.chunk_and_return_scan_data_for(start_x, end_x, 0, lat_dimensions[1] - 1)
-        coordinates = []
-        for i in range(len(long_coords)):
-            coordinates.append(list(zip(lat_coords[i], long_coords[i])))
-        return coordinates
+        # Only every 5th column is read, so the whole (I-band) geolocation never has to be in memory.
+        long_coords = long_set.read_scan_data_for(start_x, end_x, 0, long_dimensions[1] - 1)
+        lat_coords = lat_set.read_scan_data_for(start_x, end_x, 0, lat_dimensions[1] - 1)
+        # coordinates[scan][along frame index] = (lat, lon)
+        return numpy.stack((lat_coords, long_coords), axis=-1)
 
     def __str__(self):
         return self.name
 
     def close_file(self):
-        self.hdf_file.close()
\ No newline at end of file
+        self.data_cache.clear()
+        self.hdf_file.close()
+
+
+def open_data_file(file_name, product_cache=None):
+    # HDF4 (.hdf) files are MODIS granules, HDF5 (.h5) files are VIIRS CLASS files.
+    if file_name[-3:] == "hdf":
+        return HDF4File(file_name, product_cache=product_cache)
+    elif file_name[-2:] == "h5":
+        return HDF5File(file_name, product_cache=product_cache)
+
+
+def cached_product(data_file, product, loader, params=()):
+    # loader() returns an array; it is only called when the file's product cache has no copy.
+    if data_file.product_cache is None:
+        return loader()
+    return data_file.product_cache.get_or_create(data_file.path, product, loader, params)
+
+
+def cached_lat_lon_boxes(data_file):
+    cache = data_file.product_cache
+    if cache is None:
+        return data_file.generate_lat_lon_boxes()
+    corners = cache.get(data_file.path, "box_corners")
+    scans = cache.get(data_file.path, "box_scans")
+    if corners is None or scans is None:
+        boxes = data_file.generate_lat_lon_boxes()
+        corners, scans = scan_boxes_to_arrays(boxes)
+        cache.put(data_file.path, "box_corners", corners)
+        cache.put(data_file.path, "box_scans", scans)
+        return boxes
+    return scan_boxes_from_arrays(corners, scans)
+
+
+def cached_nadir_radiances(data_file, loader, params=()):
+    # loader() returns {scan index: radiance}, which is cached as rows of (scan index, radiance).
+    if data_file.product_cache is None:
+        return loader()
+    pairs = cached_product(data_file, "nadir_radiances",
+                           lambda: numpy.array(list(loader().items()), dtype=numpy.float64).reshape(-1, 2), params)
+    return {int(scan): value for scan, value in zip(pairs[:, 0].tolist(), pairs[:, 1])}
@@ -0,0 +1,103 @@
+import numpy
+from collocation import OffNadirGeolocation
+from geometry import longitude_difference
+import instrumentation
+
+# Off-nadir geolocation can be matched at several resolutions, given as the number of data frames
+# between geolocation samples (detectors are always averaged per scan). Coarse to fine the levels are:
+#   - the granule's scan boxes (ScanBoxSet), which pick the scans worth looking at,
+#   - blocks of BLOCK_FRAMES frames of each scan,
+#   - a sample every DEFAULT_FRAME_INTERVAL frames, which is read (and cached) for every granule,
+#   - every frame.
+# Coarser resolutions are taken from the default level. Finer ones are only read for the blocks of the
+# default level that could lie within some nadir point's tolerance, so full resolution costs about as
+# much as the overlap between the granules rather than the whole swath.
+
+DEFAULT_FRAME_INTERVAL = 5
+BLOCK_FRAMES = 40
+
+
+def coarsen(geolocation, step):
+    # Every step-th sample of each scan
+    coordinates = numpy.stack((geolocation.latitudes[:, ::step], geolocation.longitudes[:, ::step]), axis=-1)
+    return OffNadirGeolocation(coordinates, geolocation.scans, geolocation.time_axis, geolocation.cell_size,
+                               geolocation.frame_interval * step, geolocation.frame_offset)
+
+
+def get_block_extents(geolocation, block_samples):
+    # Centre and half size (latitude, then longitude) of every block of block_samples samples of each
+    # scan, as [scan row][block] arrays. The samples on either side of a block are taken in as well, so
+    # the frames between samples are covered. Blocks without a valid sample get NaN.
+    rows, samples = geolocation.latitudes.shape
+    blocks = -(-samples // block_samples)
+    extents = numpy.full((4, rows, blocks), numpy.nan)
+    with numpy.errstate(invalid="ignore"):
+        for b in range(blocks):
+            first = max(b * block_samples - 1, 0)
+            last = min((b + 1) * block_samples + 1, samples)
+            latitudes = geolocation.latitudes[:, first:last]
+            longitudes = geolocation.longitudes[:, first:last]
+            valid = numpy.isfinite(latitudes) & numpy.isfinite(longitudes)
+            lat_max = numpy.where(valid, latitudes, -numpy.inf).max(axis=1)
+            lat_min = numpy.where(valid, latitudes, numpy.inf).min(axis=1)
+            # Longitudes are measured from the first valid sample so blocks across the antimeridian stay whole.
+            reference = longitudes[numpy.arange(rows), numpy.argmax(valid, axis=1)]
+            offsets = (longitudes - reference[:, None] + 180.0) % 360.0 - 180.0
+            lon_max = numpy.where(valid, offsets, -numpy.inf).max(axis=1)
+            lon_min = numpy.where(valid, offsets, numpy.inf).min(axis=1)
+            extents[0, :, b] = (lat_max + lat_min) / 2
+            extents[1, :, b] = (lat_max - lat_min) / 2
+            extents[2, :, b] = reference + (lon_max + lon_min) / 2
+            extents[3, :, b] = (lon_max - lon_min) / 2
+    return extents
+
+
+def find_candidate_blocks(track, geolocation, allowed_scans=None, block_samples=BLOCK_FRAMES // DEFAULT_FRAME_INTERVAL):
+    # [scan row][block] -> True where some nadir point is close enough in time and space for the block
+    # to hold a match
+    centre_lats, half_lats, centre_lons, half_lons = get_block_extents(geolocation, block_samples)
+    blocks = numpy.zeros(centre_lats.shape, dtype=bool)
+    if len(track) == 0 or len(geolocation) == 0:
+        return blocks
+    allowed_rows = numpy.ones(len(geolocation), dtype=bool)
+    if allowed_scans is not None:
+        allowed_rows = numpy.isin(geolocation.scans, numpy.asarray(allowed_scans, dtype=numpy.int64))
+    time_axis = geolocation.time_axis
+    starts, ends = time_axis.join(track.times, track.max_time_differences)
+    with numpy.errstate(invalid="ignore"):
+        for n in numpy.nonzero(starts < ends)[0]:
+            rows = allowed_rows & time_axis.in_range(geolocation.scans - 1, starts[n], ends[n])
+            if not rows.any():
+                continue
+            lat_radius = track.max_coordinate_differences[n]
+            near = numpy.abs(centre_lats[rows] - track.latitudes[n]) <= half_lats[rows] + lat_radius
+            # Close to a pole every longitude is within reach.
+            if abs(track.latitudes[n]) + lat_radius < 90:
+                near &= longitude_difference(centre_lons[rows], track.longitudes[n]) <= \
+                    half_lons[rows] + track.max_longitude_differences[n]
+            blocks[rows] |= near
+    instrumentation.increment("pyramid_blocks_tested", blocks.size)
+    instrumentation.increment("pyramid_blocks_kept", int(blocks.sum()))
+    return blocks
+
+
+def refine(geolocation, blocks, block_samples, frame_interval, frame_offset, number_of_frames, read_scan):
+    # Geolocation at frame_interval frames per sample for the scans with candidate blocks, read from the
+    # first to the last candidate block of each scan and NaN elsewhere. read_scan(scan, first, last)
+    # returns the scan's latitudes and longitudes at frames first, first + frame_interval, ... up to last.
+    block_frames = block_samples * geolocation.frame_interval
+    samples = -(-number_of_frames // frame_interval)
+    rows = numpy.nonzero(blocks.any(axis=1))[0]
+    coordinates = numpy.full((len(rows), samples, 2), numpy.nan)
+    for i, row in enumerate(rows):
+        candidates = numpy.nonzero(blocks[row])[0]
+        # One default sample either side, as in get_block_extents
+        first = max(candidates[0] * block_frames - geolocation.frame_interval, 0)
+        first -= first % frame_interval
+        last = min((candidates[-1] + 1) * block_frames + geolocation.frame_interval, number_of_frames - 1)
+        latitudes, longitudes = read_scan(geolocation.scans[row], first, last)
+        start = first // frame_interval
+        coordinates[i, start:start + len(latitudes), 0] = latitudes
+        coordinates[i, start:start + len(longitudes), 1] = longitudes
+    return OffNadirGeolocation(coordinates, geolocation.scans[rows], geolocation.time_axis, geolocation.cell_size,
+                               frame_interval, frame_offset)
@@ -0,0 +1,53 @@
+import numpy
+
+# Mean earth radius (km), as used by GeospatialScanBox
+EARTH_RADIUS = 6371.0
+
+# All functions take scalars or arrays of degrees (distances in km, bearings in radians) and
+# broadcast like any other NumPy operation.
+
+
+def shift_across_antimeridian(lon):
+    # Moves western longitudes to (180, 360) so that a region spanning the antimeridian is continuous.
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    return numpy.where((lon >= -180.0) & (lon < 0.0), lon + 360.0, lon)[()]
+
+
+def unshift_across_antimeridian(lon):
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    return numpy.where(lon > 180.0, lon - 360.0, lon)[()]
+
+
+def longitude_difference(lon1, lon2):
+    # Absolute longitude difference, taking the shorter way around the antimeridian.
+    difference = numpy.abs(numpy.asarray(lon1, dtype=numpy.float64) - numpy.asarray(lon2, dtype=numpy.float64)) % 360.0
+    return numpy.minimum(difference, 360.0 - difference)
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # Haversine great-circle distance in km
+    lat1, lon1, lat2, lon2 = map(numpy.radians, (lat1, lon1, lat2, lon2))
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+    return 2 * numpy.arcsin(numpy.sqrt(a)) * EARTH_RADIUS
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    # Initial bearing (radians) of the great circle from point 1 to point 2
+    lat1, lon1, lat2, lon2 = map(numpy.radians, (lat1, lon1, lat2, lon2))
+    dlon = lon2 - lon1
+    y = numpy.sin(dlon) * numpy.cos(lat2)
+    x = numpy.cos(lat1) * numpy.sin(lat2) - numpy.sin(lat1) * numpy.cos(lat2) * numpy.cos(dlon)
+    return numpy.arctan2(y, x)
+
+
+def destination(lat1, lon1, d, brng):
+    # Point reached after travelling d km from point 1 along bearing brng (radians)
+    lat1 = numpy.radians(lat1)
+    lon1 = numpy.radians(lon1)
+    angular_distance = numpy.asarray(d, dtype=numpy.float64) / EARTH_RADIUS
+    lat2 = numpy.arcsin(numpy.sin(lat1) * numpy.cos(angular_distance) +
+                        numpy.cos(lat1) * numpy.sin(angular_distance) * numpy.cos(brng))
+    lon2 = lon1 + numpy.arctan2(numpy.sin(brng) * numpy.sin(angular_distance) * numpy.cos(lat1),
+                                numpy.cos(angular_distance) - numpy.sin(lat1) * numpy.sin(lat2))
+    return numpy.degrees(lat2), numpy.degrees(lon2)
+
@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import numpy
+from collocation import times_to_seconds
+from file_handler import open_data_file
+
+# Default location of the catalog, next to basepath.pk and dbinfo.pk
+DEFAULT_CATALOG_FILE = 'granules.db'
+# Same windows the nadir points search with (see generate_nadir_data_points): 15 minutes, .10 degrees
+DEFAULT_TIME_RANGE = 15 * 60.0
+DEFAULT_SPATIAL_RANGE = .10
+
+
+class GranuleRecord(object):
+    # What the catalog knows about one file: its time span (seconds from REFERENCE_TIME), scan count and
+    # the extents of each of its scan boxes as (smallest lat, biggest lat, smallest lon, biggest lon).
+
+    def __init__(self, path, start_time, end_time, scans, extents):
+        self.path = path
+        self.start_time = start_time
+        self.end_time = end_time
+        self.scans = scans
+        self.extents = numpy.asarray(extents, dtype=numpy.float64).reshape(-1, 4)
+
+    def __str__(self):
+        return self.path.split("/")[-1]
+
+
+class GranuleCatalog(object):
+    # Persistent SQLite catalog of granule time spans and scan box footprints. Files are only opened
+    # when they are new or have changed on disk (size or modification time), so later runs over the same
+    # directories can plan their file pairs without reading any HDF data.
+
+    def __init__(self, database_file=DEFAULT_CATALOG_FILE):
+        self.database_file = database_file
+        self.connection = sqlite3.connect(database_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS granules (path TEXT PRIMARY KEY, size INTEGER, "
+                                "modified REAL, start_time REAL, end_time REAL, scans INTEGER)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS footprints (path TEXT, start_scan INTEGER, "
+                                "end_scan INTEGER, smallest_lat REAL, biggest_lat REAL, smallest_lon REAL, "
+                                "biggest_lon REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS footprints_path ON footprints (path)")
+        self.connection.commit()
+
+    def is_current(self, path):
+        row = self.connection.execute("SELECT size, modified FROM granules WHERE path = ?",
+                                      (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return False
+        stat = os.stat(path)
+        return row[0] == stat.st_size and row[1] == stat.st_mtime
+
+    def add_file(self, data_file):
+        # data_file is an open HDF4File or HDF5File; it is left open.
+        path = os.path.abspath(data_file.path)
+        if self.is_current(path):
+            return
+        stat = os.stat(path)
+        times = times_to_seconds(data_file.get_times_list())
+        self.connection.execute("DELETE FROM granules WHERE path = ?", (path,))
+        self.connection.execute("DELETE FROM footprints WHERE path = ?", (path,))
+        self.connection.execute("INSERT INTO granules VALUES (?, ?, ?, ?, ?, ?)",
+                                (path, stat.st_size, stat.st_mtime, float(times.min()), float(times.max()),
+                                 int(data_file.get_number_of_scans())))
+        self.connection.executemany("INSERT INTO footprints VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    [(path, int(box.get_starting_scan()), int(box.get_ending_scan())) +
+                                     tuple(float(value) for value in box.extents) for box in data_file.boxes])
+        self.connection.commit()
+
+    def add_path(self, path):
+        if not self.is_current(path):
+            data_file = open_data_file(path)
+            try:
+                self.add_file(data_file)
+            finally:
+                data_file.close_file()
+
+    def get_granule(self, path):
+        path = os.path.abspath(path)
+        row = self.connection.execute("SELECT start_time, end_time, scans FROM granules WHERE path = ?",
+                                      (path,)).fetchone()
+        if row is None:
+            raise Exception("Granule not in catalog: " + path)
+        extents = self.connection.execute("SELECT smallest_lat, biggest_lat, smallest_lon, biggest_lon FROM footprints "
+                                          "WHERE path = ? ORDER BY start_scan", (path,)).fetchall()
+        return GranuleRecord(path, row[0], row[1], row[2], extents)
+
+    def plan_pairs(self, nadir_files, on_files, time_range=DEFAULT_TIME_RANGE, spatial_range=DEFAULT_SPATIAL_RANGE):
+        # Same (n_num, on_num, nadir path, off-nadir path) tasks as parallel_runner.plan_pair_tasks, minus
+        # the pairs that cannot produce a match. Accepts file objects or paths; anything not yet in the
+        # catalog is added first.
+        nadir_paths = [getattr(f, "path", f) for f in nadir_files]
+        off_nadir_paths = [getattr(f, "path", f) for f in on_files]
+        for data_file in list(nadir_files) + list(on_files):
+            if hasattr(data_file, "path"):
+                self.add_file(data_file)
+            else:
+                self.add_path(data_file)
+        nadir_records = [self.get_granule(path) for path in nadir_paths]
+        off_nadir_records = [self.get_granule(path) for path in off_nadir_paths]
+        if not off_nadir_records:
+            return []
+        # Off-nadir granules sorted by start time: the candidates for a nadir granule are one contiguous
+        # run, bounded below by the longest off-nadir granule, so planning is close to linear in the files.
+        starts = numpy.array([r.start_time for r in off_nadir_records])
+        ends = numpy.array([r.end_time for r in off_nadir_records])
+        order = numpy.argsort(starts, kind="stable")
+        sorted_starts = starts[order]
+        longest = float((ends - starts).max())
+        tasks = []
+        for n_num, nadir in enumerate(nadir_records):
+            first = numpy.searchsorted(sorted_starts, nadir.start_time - time_range - longest, side="left")
+            last = numpy.searchsorted(sorted_starts, nadir.end_time + time_range, side="right")
+            candidates = numpy.sort(order[first:last])
+            for on_num in candidates:
+                off_nadir = off_nadir_records[on_num]
+                if off_nadir.end_time < nadir.start_time - time_range:
+                    continue
+                if footprints_overlap(nadir.extents, off_nadir.extents, spatial_range):
+                    tasks.append((n_num, int(on_num), nadir_paths[n_num], off_nadir_paths[on_num]))
+        return tasks
+
+    def close(self):
+        self.connection.close()
+
+
+def padded_extents(extents, padding):
+    # Boxes reaching the poles can hold any longitude, and boxes across the antimeridian already span
+    # -180 to 180 in their extents.
+    extents = extents.copy()
+    extents[:, 0] -= padding
+    extents[:, 1] += padding
+    extents[:, 2] -= padding
+    extents[:, 3] += padding
+    polar = (extents[:, 0] < -80.0) | (extents[:, 1] > 80.0)
+    extents[polar, 2] = -180.0
+    extents[polar, 3] = 180.0
+    return extents
+
+
+def footprints_overlap(extents1, extents2, padding=0.0):
+    # True when any box of one footprint overlaps any box of the other
+    if len(extents1) == 0 or len(extents2) == 0:
+        return False
+    a = padded_extents(extents1, padding)
+    b = padded_extents(extents2, 0.0)
+    overlap = (a[:, None, 0] <= b[None, :, 1]) & (b[None, :, 0] <= a[:, None, 1]) & \
+              (a[:, None, 2] <= b[None, :, 3]) & (b[None, :, 2] <= a[:, None, 3])
+    return bool(overlap.any())
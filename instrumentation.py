@@ -0,0 +1,203 @@
+import json
+import re
+import threading
+import time
+
+# Process-wide stage timers, counters and gauges. Everything is off until enable() is called; while
+# disabled, stage() hands back one shared do-nothing context manager and increment()/set_gauge() return
+# straight away, so instrumented code costs little more than a function call.
+#
+#   with instrumentation.stage("matching"):
+#       ...
+#   instrumentation.increment("bytes_read", array.nbytes, data_set="Radiance")
+#
+# Stages nest: a stage opened inside another is recorded as "outer/inner".
+
+PROMETHEUS_PREFIX = "overpass_"
+
+
+class NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.path = None
+        self.start = None
+
+    def __enter__(self):
+        stack = self.registry.get_stack()
+        stack.append(self.name)
+        self.path = "/".join(stack)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.add_time(self.path, time.perf_counter() - self.start)
+        self.registry.get_stack().pop()
+        return False
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # stage path -> [calls, total seconds, longest call]
+            self.timers = {}
+            # (name, ((label, value), ...)) -> value
+            self.counters = {}
+            self.gauges = {}
+
+    def get_stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def add_time(self, path, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(path, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def increment(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def snapshot(self):
+        # Plain, picklable copy, e.g. to send back from a worker process and merge()
+        with self.lock:
+            return {"timers": dict((path, list(timer)) for path, timer in self.timers.items()),
+                    "counters": dict(self.counters),
+                    "gauges": dict(self.gauges)}
+
+    def merge(self, snapshot):
+        # Timers and counters add up; gauges take the merged value.
+        with self.lock:
+            for path, (calls, total, longest) in snapshot["timers"].items():
+                timer = self.timers.setdefault(path, [0, 0.0, 0.0])
+                timer[0] += calls
+                timer[1] += total
+                timer[2] = max(timer[2], longest)
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(snapshot["gauges"])
+
+    def to_dict(self):
+        snapshot = self.snapshot()
+        return {"stages": dict((path, {"calls": calls, "seconds": total, "max_seconds": longest})
+                               for path, (calls, total, longest) in sorted(snapshot["timers"].items())),
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(snapshot["counters"].items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in sorted(snapshot["gauges"].items())]}
+
+    def to_json(self, file_name=None):
+        report = json.dumps(self.to_dict(), indent=2)
+        if file_name is not None:
+            with open(file_name, "w") as file:
+                file.write(report)
+        return report
+
+    def to_prometheus(self, file_name=None):
+        # Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = []
+        if snapshot["timers"]:
+            for metric, column in (("stage_seconds_total", 1), ("stage_calls_total", 0)):
+                lines.append("# TYPE " + PROMETHEUS_PREFIX + metric + " counter")
+                for path, timer in sorted(snapshot["timers"].items()):
+                    lines.append(PROMETHEUS_PREFIX + metric + format_labels((("stage", path),)) + " " + repr(timer[column]))
+        for values, kind, suffix in ((snapshot["counters"], "counter", "_total"), (snapshot["gauges"], "gauge", "")):
+            typed = set()
+            for (name, labels), value in sorted(values.items()):
+                metric = PROMETHEUS_PREFIX + metric_name(name) + suffix
+                if metric not in typed:
+                    lines.append("# TYPE " + metric + " " + kind)
+                    typed.add(metric)
+                lines.append(metric + format_labels(labels) + " " + repr(value))
+        text = "\n".join(lines) + "\n"
+        if file_name is not None:
+            with open(file_name, "w") as file:
+                file.write(text)
+        return text
+
+    def format_summary(self):
+        # One line per stage, for printing at the end of a run
+        snapshot = self.snapshot()
+        lines = []
+        for path, (calls, total, longest) in sorted(snapshot["timers"].items()):
+            lines.append(path + ": " + str(round(total, 4)) + "s over " + str(calls) + " call(s)")
+        for (name, labels), value in sorted(snapshot["counters"].items()):
+            lines.append(name + format_labels(labels) + ": " + str(value))
+        return "\n".join(lines)
+
+
+def metric_name(name):
+    return re.sub("[^a-zA-Z0-9_]", "_", name)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(metric_name(label) + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                          for label, value in labels) + "}"
+
+
+# The process-wide registry and shortcuts to it
+registry = Registry()
+
+
+def enable():
+    registry.enabled = True
+
+
+def disable():
+    registry.enabled = False
+
+
+def is_enabled():
+    return registry.enabled
+
+
+def stage(name):
+    return registry.stage(name)
+
+
+def increment(name, amount=1, **labels):
+    registry.increment(name, amount, **labels)
+
+
+def set_gauge(name, value, **labels):
+    registry.set_gauge(name, value, **labels)
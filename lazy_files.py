@@ -0,0 +1,181 @@
+import os
+import threading
+from collections import OrderedDict
+from file_handler import open_data_file
+
+# Default number of files kept open at once by a FileHandlePool
+DEFAULT_MAX_OPEN_FILES = 32
+# Default number of files whose derived values a DataFileSet keeps in memory
+DEFAULT_MAX_FILES = 64
+# Values worked out from a file's contents that hold no file handles. They are kept when an idle file is
+# closed and handed back to it when it is reopened, so nothing is read from disk twice.
+PRESERVED_ATTRIBUTES = ("scan_boxes", "scan_box_set", "time_axis", "geolocation", "times", "number_of_scans")
+
+
+class FileHandlePool(object):
+    # Tracks the LazyDataFiles that currently have their file open, least recently used first, and
+    # closes the oldest ones once more than max_open_files are open. Pinned files (those of the pair
+    # being matched) are never closed, even if that leaves more files open. Safe to share with a
+    # prefetch thread.
+
+    def __init__(self, max_open_files=DEFAULT_MAX_OPEN_FILES):
+        self.max_open_files = max(int(max_open_files), 1)
+        self.open_files = OrderedDict()
+        # id(lazy file) -> number of pins
+        self.pins = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.open_files)
+
+    def touch(self, lazy_file):
+        with self.lock:
+            self.open_files[id(lazy_file)] = lazy_file
+            self.open_files.move_to_end(id(lazy_file))
+            excess = len(self.open_files) - self.max_open_files
+            # The file just touched is about to be used, so it is kept as well.
+            unpinned = [key for key in self.open_files if key not in self.pins and key != id(lazy_file)]
+            for key in unpinned[:max(excess, 0)]:
+                self.open_files.pop(key).release()
+
+    def pin(self, lazy_file):
+        with self.lock:
+            self.pins[id(lazy_file)] = self.pins.get(id(lazy_file), 0) + 1
+
+    def unpin(self, lazy_file):
+        with self.lock:
+            if self.pins.get(id(lazy_file), 0) > 1:
+                self.pins[id(lazy_file)] -= 1
+            else:
+                self.pins.pop(id(lazy_file), None)
+
+    def is_pinned(self, lazy_file):
+        with self.lock:
+            return id(lazy_file) in self.pins
+
+    def forget(self, lazy_file):
+        with self.lock:
+            self.open_files.pop(id(lazy_file), None)
+
+    def close_all(self):
+        with self.lock:
+            while self.open_files:
+                key, lazy_file = self.open_files.popitem(last=False)
+                lazy_file.release()
+
+
+class LazyDataFile(object):
+    # Stand-in for an HDF4File/HDF5File that only records the path and size/modification time until the
+    # file is actually used. Any other attribute is looked up on the real file, which is opened (and its
+    # preserved values restored) on demand.
+
+    def __init__(self, file_name, pool=None, product_cache=None):
+        self.path = file_name
+        self.name = file_name.split("/")[-1]
+        stat = os.stat(file_name)
+        self.size = stat.st_size
+        self.modified = stat.st_mtime
+        self.pool = pool
+        self.product_cache = product_cache
+        self.data_file = None
+        self.preserved = {}
+        # Nadir values, kept here so every pair the file is the nadir side of shares them
+        self.nadir_points = None
+        self.nadir_values = {}
+        # Only one thread opens the file
+        self.open_lock = threading.Lock()
+
+    def get_data_file(self):
+        if self.data_file is None:
+            with self.open_lock:
+                if self.data_file is None:
+                    data_file = open_data_file(self.path, self.product_cache)
+                    if data_file is None:
+                        raise Exception("Unsupported file type: " + self.path)
+                    for name, value in self.preserved.items():
+                        setattr(data_file, name, value)
+                    self.data_file = data_file
+        if self.pool is not None:
+            self.pool.touch(self)
+        return self.data_file
+
+    def generate_nadir_data_points(self):
+        if self.nadir_points is None:
+            self.nadir_points = self.get_data_file().generate_nadir_data_points()
+        return self.nadir_points
+
+    def get_nadir_radiances(self, *arguments):
+        if arguments not in self.nadir_values:
+            self.nadir_values[arguments] = self.get_data_file().get_nadir_radiances(*arguments)
+        return self.nadir_values[arguments]
+
+    def is_open(self):
+        return self.data_file is not None
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the proxy itself
+        if name in ("data_file", "pool", "product_cache", "preserved", "path", "nadir_points", "nadir_values",
+                    "open_lock"):
+            raise AttributeError(name)
+        return getattr(self.get_data_file(), name)
+
+    def release(self):
+        # Closes the file handle but keeps whatever was already worked out from it
+        if self.data_file is not None:
+            for name in PRESERVED_ATTRIBUTES:
+                value = getattr(self.data_file, name, None)
+                if value is not None:
+                    self.preserved[name] = value
+            self.data_file.close_file()
+            self.data_file = None
+
+    def close_file(self):
+        if self.pool is not None:
+            self.pool.forget(self)
+        self.release()
+
+    def __str__(self):
+        return self.name
+
+
+class DataFileSet(object):
+    # The LazyDataFile for each path used in a run, so every pair a file is part of (in either
+    # direction) shares its derived values instead of working them out again. Only the max_files most
+    # recently used files are kept; older ones are closed and forgotten, unless they are pinned. Safe to
+    # share with a prefetch thread (see prefetch.py).
+
+    def __init__(self, product_cache=None, max_files=DEFAULT_MAX_FILES, max_open_files=DEFAULT_MAX_OPEN_FILES):
+        self.product_cache = product_cache
+        self.max_files = max(int(max_files), 2)
+        self.pool = FileHandlePool(max_open_files)
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.files)
+
+    def get(self, path, pin=False):
+        # With pin=True the file stays open until unpin() is called for it (see FileHandlePool).
+        with self.lock:
+            if path in self.files:
+                self.files.move_to_end(path)
+                lazy_file = self.files[path]
+            else:
+                lazy_file = LazyDataFile(path, self.pool, self.product_cache)
+                self.files[path] = lazy_file
+                excess = len(self.files) - self.max_files
+                unpinned = [key for key, value in self.files.items() if not self.pool.is_pinned(value)]
+                for oldest_path in unpinned[:max(excess, 0)]:
+                    self.files.pop(oldest_path).close_file()
+            if pin:
+                self.pool.pin(lazy_file)
+            return lazy_file
+
+    def unpin(self, lazy_file):
+        self.pool.unpin(lazy_file)
+
+    def close_all(self):
+        with self.lock:
+            while self.files:
+                path, lazy_file = self.files.popitem(last=False)
+                lazy_file.close_file()
@@ -1,13 +1,44 @@
 import os
-from file_handler import HDF4File, HDF5File
+from file_handler import open_data_file
 import matplotlib.pyplot as plt
 import psycopg2
-import numpy
 import pickle
+from database_sink import PostgresSink
+from band_differencing import compute_ivm
+from angle_statistics import AngleStatistics
+from parallel_runner import run_pair_tasks, add_reverse_tasks
+from granule_catalog import GranuleCatalog
+from lazy_files import LazyDataFile, FileHandlePool
+from product_cache import ProductCache
+import instrumentation
 
 
 base_location_file = 'basepath.pk'
 database_info_file = 'dbinfo.pk'
+catalog_file = 'granules.db'
+# Input files are only opened when used, and at most this many are kept open at a time.
+max_open_files = 32
+file_pool = FileHandlePool(max_open_files)
+# Derived arrays (scan boxes, coordinates, scan times, nadir radiances) are kept on disk between runs.
+product_cache = ProductCache('product_cache')
+# Stage timings and counters of the last comparison run are written here as JSON.
+metrics_file = 'metrics.json'
+# Matches are handed to the database and statistics this many at a time, then dropped.
+match_batch_size = 65536
+# Off-nadir geolocation is matched with a sample every this many data frames (see geolocation_pyramid.py);
+# 1 matches every VIIRS frame.
+match_frame_interval = 5
+# Bytes of VIIRS geolocation and radiances to hold at a time when matching, e.g. 256 * 1024 ** 2 for
+# full resolution I-band files (see tiling.py). None reads each file whole.
+match_tile_budget = None
+# With one worker process, the files of this many upcoming pairs are read on a background thread while
+# the current pair is matched (see prefetch.py). 0 turns prefetching off.
+prefetch_lookahead = 1
+# Per-angle statistics of the last comparison run (see angle_statistics.py) are written here; they can
+# be merged with those of other runs. None keeps every distinct scan angle apart.
+statistics_file = 'angle_statistics.json'
+reverse_statistics_file = 'angle_statistics_reverse.json'
+angle_bin_width = None
 base_location = ''
 base_db_info = []
 
@@ -24,10 +55,9 @@ def run_program():
         off_nadir_files = gather_input_files()
         input_db_info()
         response2 = input("Would you like to run the reverse as well? [y/n]: ")
-        nvon_options_and_run(nadir_files, off_nadir_files)
-        # If response2 is a faulty input, the reverse is simply not executed.
-        if response2.lower() == "y":
-            nvon_options_and_run(off_nadir_files, nadir_files)
+        # If response2 is a faulty input, the reverse is simply not executed. Otherwise both directions
+        # are run together, sharing each file's derived values.
+        nvon_options_and_run(nadir_files, off_nadir_files, reverse=(response2.lower() == "y"))
     elif response.lower() == "ivm":
         input_directory_info()
         print("Note: for I and M-Band inputs, only the first files in the specified folders will be processed.")
@@ -68,18 +98,12 @@ def gather_input_files():
     file_list = []
     for filename in os.listdir(path):
         if filename.endswith(".h5") or filename.endswith("hdf"):
-            print("Opening ... " + filename)
-            file_list.append(open_file(path + "/" + filename))
+            print("Found ... " + filename)
+            file_list.append(LazyDataFile(path + "/" + filename, file_pool, product_cache))
     return file_list
 
 def open_file(given_file):
-    f_name = given_file
-    if f_name[-3:] == "hdf":
-        opened_file = HDF4File(f_name)
-        return opened_file
-    elif f_name[-2:] == "h5":
-        opened_file = HDF5File(f_name)
-        return opened_file
+    return open_data_file(given_file)
 
 def input_db_info():
     global base_db_info
@@ -110,72 +134,81 @@ def input_db_info():
         print("Invalid inputs - please input 'y' or 'n'")
         input_db_info()
 
-def info_to_database(list_of_matches, table, cursor):
-    final_dict = {}
-    for pair in list_of_matches:
-        if .9 <= pair.get_ratio() <= 1.1:
-            if pair.get_angle() not in final_dict.keys():
-                final_dict[pair.get_angle()] = [pair.get_ratio()]
-            else:
-                final_dict[pair.get_angle()].append(pair.get_ratio())
-    for key in final_dict.keys():
-        cursor.execute("INSERT INTO " + table + " (angle, avgv, std) VALUES (%s, %s, %s)",
-                    (key, numpy.mean(final_dict[key]), numpy.std(final_dict[key])))
-
-def nvon_options_and_run(nadir_files, on_files):
+def nvon_options_and_run(nadir_files, on_files, reverse=False):
     global base_db_info
     # base_db_info = [database, username, password]
     db = input("Would you like to submit this data to your database? [y/n]: ")
     # Submitting to database initialized to false.
     database_submit = False
-    # Initialization / default for the table name
-    table = ""
+    sink = None
+    tables = {}
     if db.lower() == "y":
        database_submit = True
     # Input-checking not done for table names due to limitations in interacting with the database.
-       table = input("What table would you like to submit the data to?: ")
-    conn = psycopg2.connect("dbname=" + base_db_info[0] + " user=" + base_db_info[1] + " password=" + base_db_info[2])
-    cur = conn.cursor()
-    final_dict = {}
-    for n_num in range(len(nadir_files)):
-        n_points = nadir_files[n_num].generate_nadir_data_points()
-        n_radiances = nadir_files[n_num].get_nadir_radiances()
-        for on_num in range(len(on_files)):
-            print("Comparing off-nadir " + str(on_files[on_num]) + " to nadir values of " + str(nadir_files[n_num]))
-            final_dict[(on_num, n_num)] = on_files[on_num].compare_to_off_nadir(n_points, n_radiances)
-            print("Found " + str(len(final_dict[(on_num, n_num)])) + " matches.")
+       tables[False] = input("What table would you like to submit the data to?: ")
+       if reverse:
+           tables[True] = input("What table would you like to submit the reverse data to?: ")
+       raw = input("Would you like to store every individual match as well (in <table>_matches)? [y/n]: ")
+       sink = PostgresSink(base_db_info, tables[False], store_matches=(raw.lower() == "y"))
+    workers = input("How many worker processes should be used? [1]: ")
+    # Faulty or empty input runs every comparison in this process.
+    workers = int(workers) if workers.isdigit() and int(workers) > 0 else 1
+    instrumentation.enable()
+    instrumentation.registry.reset()
+    # Pairs whose time spans or footprints never overlap are skipped without being opened.
+    catalog = GranuleCatalog(catalog_file)
+    tasks = catalog.plan_pairs(nadir_files, on_files)
+    forward_pairs = set((task[2], task[3]) for task in tasks)
+    if reverse:
+        tasks = add_reverse_tasks(tasks, catalog.plan_pairs(on_files, nadir_files))
+    # Planning only needs the files' times and footprints; the pairs open their files again by path.
+    file_pool.close_all()
+    # Statistics of the whole run, for each direction
+    run_statistics = {False: AngleStatistics(angle_bin_width), True: AngleStatistics(angle_bin_width)}
+    with instrumentation.stage("nvon"):
+        for result in run_pair_tasks(tasks, workers, product_cache, match_batch_size,
+                                     frame_interval=match_frame_interval, tile_budget=match_tile_budget,
+                                     lookahead=prefetch_lookahead):
+            is_reverse = (result.nadir_path, result.off_nadir_path) not in forward_pairs
+            print("Compared off-nadir " + result.off_nadir_name + " to nadir values of " + result.nadir_name)
+            # Only the per-angle statistics are kept across batches. Raw matches are written batch by batch
+            # within the pair's savepoint, so a failed pair leaves nothing in the database.
+            number_of_matches = 0
+            statistics = AngleStatistics(angle_bin_width)
+            if database_submit:
+                sink.begin_pair()
+            for matches in result.iter_batches():
+                number_of_matches += len(matches)
+                statistics.add(matches)
+                if database_submit:
+                    sink.write_matches(matches, tables[is_reverse])
+            if result.error is not None:
+                # A corrupt or unreadable granule only loses its own pairs.
+                print("Skipping pair, comparison failed:\n" + result.error)
+                instrumentation.increment("pairs_failed")
+                if database_submit:
+                    sink.end_pair(succeeded=False)
+                continue
+            instrumentation.increment("pairs_compared")
+            print("Found " + str(number_of_matches) + " matches.")
+            run_statistics[is_reverse].merge(statistics)
             if database_submit:
-                info_to_database(final_dict[(on_num, n_num)], table, cur)
-    conn.commit()
-    cur.close()
-    conn.close()
+                sink.write_aggregates(statistics.get_aggregates(), tables[is_reverse])
+                sink.end_pair()
+        catalog.close()
+        if database_submit:
+            sink.close()
+    # Nothing opened through the input files is left open after the run.
+    file_pool.close_all()
+    print(instrumentation.registry.format_summary())
+    instrumentation.registry.to_json(metrics_file)
+    run_statistics[False].to_json(statistics_file)
+    if reverse:
+        run_statistics[True].to_json(reverse_statistics_file)
 
-def ivm(m_file, i_file):
-    trace = []
-    m = []
-    i = []
-    # To avoid constantly re-loading data into memory, data set information is extracted for this function.
-    i_data = i_file.get_specific_sdr_data_set("Reflectance")
-    m_data = m_file.get_specific_sdr_data_set("Reflectance")
-    f1, f2 = i_file.get_reflectance_factors()
-    s1, s2 = m_file.get_reflectance_factors()
-    # 3072 = 48 (number of scans in a granule) x 4 (number of granules in a CLASS file) x 16 (number of detectors per scan for M Files).
-    for x in range(3072):
-        row = []
-        mrow = []
-        irow = []
-        # 3200 (standard number of frames for an M file)
-        for y in range(3200):
-            # Scale Factors f1/f2 and s1/s2 are indexed per granule. x position // number of indexes per granule = granule index
-            i_value = (i_data.get_aggregate_value(x * 2, y * 2) * f1[x // 1536] + f2[x // 1536]).item()
-            m_value = (m_data.get_specific_data_point(x, y) * s1[x // 768] + s2[x // 768]).item()
-            # i1 - .93*m5
-            row.append((i_value) - (.93*m_value))
-            mrow.append(m_value)
-            irow.append(i_value)
-        trace.append(row)
-        m.append(mrow)
-        i.append(irow)
+def ivm(m_file, i_file, tiled=False):
+    # tiled=True processes one granule of rows at a time to bound memory use.
+    trace, i, m = compute_ivm(i_file, m_file, tiled)
     create_heatmap(trace, "I1-M5")
     create_heatmap(i, "I1")
     create_heatmap(m, "M5")
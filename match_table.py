@@ -0,0 +1,162 @@
+import numpy
+from data_structures import TwoPointComparison, viirs_scan_angle, modis_scan_angle
+
+# Column name -> dtype. Scans are counted from one, swath positions are along-frame indices.
+COLUMNS = (("viirs_scan", numpy.int32),
+           ("modis_scan", numpy.int32),
+           ("viirs_swath_pos", numpy.int32),
+           ("modis_swath_pos", numpy.int32),
+           ("viirs_lat", numpy.float32),
+           ("viirs_lon", numpy.float32),
+           ("modis_lat", numpy.float32),
+           ("modis_lon", numpy.float32),
+           ("viirs_value", numpy.float64),
+           ("modis_value", numpy.float64),
+           ("difference_ratio", numpy.float64),
+           ("scan_angle", numpy.float64))
+COLUMN_NAMES = tuple(name for name, dtype in COLUMNS)
+# Where the two pixels are, as opposed to the values compared there
+GEOMETRY_COLUMNS = COLUMN_NAMES[:8]
+
+
+class MatchTable(object):
+    # Struct-of-arrays store for matches: one NumPy array per TwoPointComparison attribute.
+    # Batches are kept as separate chunks and only joined together when a column is read.
+
+    def __init__(self, columns=None):
+        self.chunks = {name: [] for name in COLUMN_NAMES}
+        self.length = 0
+        if columns is not None:
+            self.append_batch(columns)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.row(i)
+
+    def append_batch(self, columns):
+        # columns: {name: array}. Missing columns are filled with zeros, like a fresh TwoPointComparison.
+        lengths = set(len(values) for values in columns.values())
+        if len(lengths) > 1:
+            raise Exception("All MatchTable columns in a batch must be the same length")
+        batch_length = lengths.pop() if lengths else 0
+        if batch_length == 0:
+            return
+        for name, dtype in COLUMNS:
+            if name in columns:
+                self.chunks[name].append(numpy.asarray(columns[name], dtype=dtype))
+            else:
+                self.chunks[name].append(numpy.zeros(batch_length, dtype=dtype))
+        self.length += batch_length
+
+    def append(self, other):
+        if len(other):
+            self.append_batch(other.get_columns())
+
+    def column(self, name):
+        chunks = self.chunks[name]
+        if len(chunks) != 1:
+            dtype = dict(COLUMNS)[name]
+            self.chunks[name] = [numpy.concatenate(chunks) if chunks else numpy.empty(0, dtype=dtype)]
+        return self.chunks[name][0]
+
+    def get_columns(self):
+        return {name: self.column(name) for name in COLUMN_NAMES}
+
+    def get_ratios(self):
+        return self.column("difference_ratio")
+
+    def get_angles(self):
+        return self.column("scan_angle")
+
+    def nbytes(self):
+        return sum(chunk.nbytes for chunks in self.chunks.values() for chunk in chunks)
+
+    def set_comparison_values_viirs_offnad(self, viirs_values, modis_values):
+        # Array equivalent of TwoPointComparison.set_comparison_values_viirs_offnad for every row
+        viirs_values = numpy.asarray(viirs_values, dtype=numpy.float64)
+        modis_values = numpy.asarray(modis_values, dtype=numpy.float64)
+        self.chunks["viirs_value"] = [viirs_values]
+        self.chunks["modis_value"] = [modis_values]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            self.chunks["difference_ratio"] = [viirs_values / modis_values]
+        self.chunks["scan_angle"] = [viirs_scan_angle(self.column("viirs_swath_pos").astype(numpy.float64))]
+
+    def set_comparison_values_modis_offnad(self, viirs_values, modis_values):
+        viirs_values = numpy.asarray(viirs_values, dtype=numpy.float64)
+        modis_values = numpy.asarray(modis_values, dtype=numpy.float64)
+        self.chunks["viirs_value"] = [viirs_values]
+        self.chunks["modis_value"] = [modis_values]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            self.chunks["difference_ratio"] = [modis_values / viirs_values]
+        self.chunks["scan_angle"] = [modis_scan_angle(self.column("modis_swath_pos").astype(numpy.float64))]
+
+    def copy_geometry(self):
+        # New table sharing this one's geometry arrays, without any values, e.g. to fill in another band
+        return MatchTable({name: self.column(name) for name in GEOMETRY_COLUMNS})
+
+    def filter(self, mask):
+        # mask may be a boolean array or an array of row indices
+        return MatchTable({name: values[mask] for name, values in self.get_columns().items()})
+
+    def filter_ratios(self, low=.9, high=1.1):
+        ratios = self.get_ratios()
+        return self.filter((low <= ratios) & (ratios <= high))
+
+    def group_by_angle(self, column="difference_ratio"):
+        # {scan angle: array of the column's values at that angle}
+        angles = self.get_angles()
+        if len(angles) == 0:
+            return {}
+        order = numpy.argsort(angles, kind="stable")
+        unique_angles, starts = numpy.unique(angles[order], return_index=True)
+        groups = numpy.split(self.column(column)[order], starts[1:])
+        return dict(zip(unique_angles.tolist(), groups))
+
+    def row(self, i):
+        # TwoPointComparison view of a single row
+        columns = self.get_columns()
+        tpc = TwoPointComparison(int(columns["viirs_scan"][i]),
+                                 int(columns["modis_scan"][i]),
+                                 int(columns["viirs_swath_pos"][i]),
+                                 int(columns["modis_swath_pos"][i]),
+                                 (columns["modis_lat"][i], columns["modis_lon"][i]),
+                                 (columns["viirs_lat"][i], columns["viirs_lon"][i]))
+        tpc.viirs_value = float(columns["viirs_value"][i])
+        tpc.modis_value = float(columns["modis_value"][i])
+        tpc.difference_ratio = float(columns["difference_ratio"][i])
+        tpc.scan_angle = float(columns["scan_angle"][i])
+        return tpc
+
+    def to_npz(self, file_name, compressed=False):
+        if compressed:
+            numpy.savez_compressed(file_name, **self.get_columns())
+        else:
+            numpy.savez(file_name, **self.get_columns())
+
+    def to_arrow(self):
+        # pyarrow is only needed for Arrow/Parquet export, so it is imported here rather than at the top.
+        import pyarrow
+        return pyarrow.table(self.get_columns())
+
+    def to_parquet(self, file_name):
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(self.to_arrow(), file_name)
+
+    def __str__(self):
+        return "MatchTable with " + str(self.length) + " matches"
+
+
+def aggregate_by_angle(matches, low=.9, high=1.1):
+    # [(angle, average ratio, standard deviation)] over the ratios between low and high
+    final_dict = matches.filter_ratios(low, high).group_by_angle()
+    return [(key, numpy.mean(final_dict[key]), numpy.std(final_dict[key])) for key in final_dict.keys()]
+
+
+def concatenate(tables):
+    combined = MatchTable()
+    for table in tables:
+        combined.append(table)
+    return combined
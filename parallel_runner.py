@@ -0,0 +1,214 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import traceback
+from collocation import DEFAULT_BATCH_SIZE
+from geolocation_pyramid import DEFAULT_FRAME_INTERVAL
+from file_handler import open_data_file
+from lazy_files import DataFileSet
+from prefetch import Prefetcher
+from match_table import concatenate
+import instrumentation
+
+
+class PairResult(object):
+    # Outcome of comparing one nadir file with one off-nadir file. Exactly one of matches (a
+    # MatchTable) and error (a formatted traceback) is set, unless the pair is streamed: then batches is
+    # a generator that compares the pair while it is read through iter_batches(). When band pairs were
+    # given, matches and every batch are {band pair: MatchTable} instead.
+
+    def __init__(self, n_num, on_num, nadir_path, off_nadir_path, matches=None, error=None, metrics=None,
+                 batches=None):
+        self.n_num = n_num
+        self.on_num = on_num
+        self.nadir_path = nadir_path
+        self.off_nadir_path = off_nadir_path
+        self.nadir_name = nadir_path.split("/")[-1]
+        self.off_nadir_name = off_nadir_path.split("/")[-1]
+        self.matches = matches
+        self.error = error
+        # instrumentation snapshot taken in a worker process, merged into the parent's by run_pair_tasks
+        self.metrics = metrics
+        self.batches = batches
+
+    def iter_batches(self):
+        # The pair's matches as one or more MatchTables. For a streamed pair a failure stops the batches
+        # and sets error, so check it after the loop rather than before.
+        if self.batches is None:
+            if self.matches is not None:
+                yield self.matches
+            return
+        try:
+            for matches in self.batches:
+                yield matches
+        except Exception:
+            self.error = traceback.format_exc()
+
+
+def iter_pair_matches(task, product_cache=None, batch_size=DEFAULT_BATCH_SIZE, band_pairs=None, data_files=None,
+                      frame_interval=DEFAULT_FRAME_INTERVAL, tile_budget=None):
+    # Compares one pair in this process, yielding its matches in batches of batch_size (None for a
+    # single batch). Both files are closed once the batches run out, fail, or the generator is closed.
+    # With a list of (MODIS band, VIIRS data set) pairs the matching is done once and each batch is
+    # {band pair: MatchTable}. Files taken from a DataFileSet are left open for the pairs after this one.
+    # frame_interval is the matching resolution in data frames (see geolocation_pyramid.py), and a
+    # tile_budget in bytes reads and matches VIIRS off-nadir files a tile at a time (see tiling.py).
+    n_num, on_num, nadir_path, off_nadir_path = task
+    nadir_file = None
+    off_nadir_file = None
+    try:
+        with instrumentation.stage("file_open"):
+            if data_files is not None:
+                # Pinned, so a prefetch of the next pairs does not close them while they are matched
+                nadir_file = data_files.get(nadir_path, pin=True)
+                off_nadir_file = data_files.get(off_nadir_path, pin=True)
+            else:
+                nadir_file = open_data_file(nadir_path, product_cache)
+                off_nadir_file = open_data_file(off_nadir_path, product_cache)
+        if band_pairs is None:
+            with instrumentation.stage("nadir_extraction"):
+                nadir_points = nadir_file.generate_nadir_data_points()
+                nadir_radiances = nadir_file.get_nadir_radiances()
+            for matches in off_nadir_file.iter_off_nadir_matches(nadir_points, nadir_radiances, batch_size=batch_size,
+                                                                 frame_interval=frame_interval, tile_budget=tile_budget):
+                yield matches
+        else:
+            with instrumentation.stage("nadir_extraction"):
+                nadir_points = nadir_file.generate_nadir_data_points()
+                nadir_values = [nadir_file.get_nadir_radiances(*nadir_file.get_band(pair)) for pair in band_pairs]
+            bands = [off_nadir_file.get_band(pair) for pair in band_pairs]
+            for tables in off_nadir_file.iter_band_matches(nadir_points, nadir_values, bands, batch_size, frame_interval,
+                                                           tile_budget):
+                yield dict(zip(band_pairs, tables))
+    finally:
+        for opened_file in (nadir_file, off_nadir_file):
+            if opened_file is not None and data_files is not None:
+                data_files.unpin(opened_file)
+            elif opened_file is not None:
+                try:
+                    opened_file.close_file()
+                except Exception:
+                    pass
+
+
+def compare_file_pair(task, product_cache=None, collect_metrics=False, band_pairs=None, data_files=None,
+                      frame_interval=DEFAULT_FRAME_INTERVAL, tile_budget=None):
+    # Runs in a worker process. Files are opened here from their paths, since pyhdf/h5py handles
+    # cannot be sent between processes, and any failure is returned rather than raised. A ProductCache
+    # lets every worker map the same derived arrays instead of recomputing them.
+    n_num, on_num, nadir_path, off_nadir_path = task
+    if collect_metrics:
+        instrumentation.enable()
+        instrumentation.registry.reset()
+    try:
+        if band_pairs is None:
+            matches = concatenate(iter_pair_matches(task, product_cache, None, None, data_files, frame_interval,
+                                                    tile_budget))
+        else:
+            batches = list(iter_pair_matches(task, product_cache, None, band_pairs, data_files, frame_interval,
+                                             tile_budget))
+            matches = dict((pair, concatenate(batch[pair] for batch in batches)) for pair in band_pairs)
+        result = PairResult(n_num, on_num, nadir_path, off_nadir_path, matches=matches)
+    except Exception:
+        result = PairResult(n_num, on_num, nadir_path, off_nadir_path, error=traceback.format_exc())
+    if collect_metrics:
+        result.metrics = instrumentation.registry.snapshot()
+    return result
+
+
+def compare_file_pairs(tasks, product_cache=None, collect_metrics=False, band_pairs=None,
+                       frame_interval=DEFAULT_FRAME_INTERVAL, tile_budget=None):
+    # Runs a group of tasks in one worker process, sharing their files, e.g. a pair and its reverse.
+    # The group's instrumentation snapshot comes back with the first result.
+    if collect_metrics:
+        instrumentation.enable()
+        instrumentation.registry.reset()
+    data_files = DataFileSet(product_cache)
+    try:
+        results = [compare_file_pair(task, product_cache, band_pairs=band_pairs, data_files=data_files,
+                                     frame_interval=frame_interval, tile_budget=tile_budget) for task in tasks]
+    finally:
+        data_files.close_all()
+    if collect_metrics and results:
+        results[0].metrics = instrumentation.registry.snapshot()
+    return results
+
+
+def group_pair_tasks(tasks):
+    # Consecutive tasks comparing the same two files, in either direction, go in one group.
+    groups = []
+    for task in tasks:
+        if groups and set(groups[-1][-1][2:]) == set(task[2:]):
+            groups[-1].append(task)
+        else:
+            groups.append([task])
+    return groups
+
+
+def add_reverse_tasks(tasks, reverse_tasks):
+    # Puts each reverse task straight after the forward task for the same two files, so both directions
+    # are run together and share the files' derived values. Reverse tasks without a forward one go last.
+    reverse_by_files = dict(((task[3], task[2]), task) for task in reverse_tasks)
+    combined = []
+    for task in tasks:
+        combined.append(task)
+        reverse_task = reverse_by_files.pop((task[2], task[3]), None)
+        if reverse_task is not None:
+            combined.append(reverse_task)
+    combined += [task for task in reverse_tasks if (task[3], task[2]) in reverse_by_files]
+    return combined
+
+
+def plan_pair_tasks(nadir_files, on_files):
+    # Same order as the nested nadir -> off-nadir loops. Accepts file objects or paths.
+    nadir_paths = [getattr(f, "path", f) for f in nadir_files]
+    off_nadir_paths = [getattr(f, "path", f) for f in on_files]
+    tasks = []
+    for n_num in range(len(nadir_paths)):
+        for on_num in range(len(off_nadir_paths)):
+            tasks.append((n_num, on_num, nadir_paths[n_num], off_nadir_paths[on_num]))
+    return tasks
+
+
+def run_pair_tasks(tasks, workers=1, product_cache=None, batch_size=None, band_pairs=None,
+                   frame_interval=DEFAULT_FRAME_INTERVAL, tile_budget=None, lookahead=0):
+    # Yields PairResults in task order, whatever order the workers finish in. workers=1 runs
+    # everything in this process; there a batch_size streams each pair, so only one batch of matches
+    # is held at a time, and each result's batches have to be read before asking for the next result.
+    # Worker processes always send back whole pairs. Files are shared by all the tasks run in this
+    # process, and by each group of consecutive tasks on the same two files in a worker. In this
+    # process, lookahead > 0 reads the files of up to that many following pairs on a background thread
+    # while a pair is matched (see prefetch.py).
+    if workers <= 1:
+        tasks = list(tasks)
+        data_files = DataFileSet(product_cache)
+        prefetcher = None
+        if lookahead > 0:
+            prefetcher = Prefetcher(tasks, data_files, band_pairs, lookahead, tile_budget is not None)
+        try:
+            for task_index, task in enumerate(tasks):
+                if prefetcher is not None:
+                    prefetcher.wait(task_index)
+                if batch_size is None:
+                    yield compare_file_pair(task, product_cache, band_pairs=band_pairs, data_files=data_files,
+                                            frame_interval=frame_interval, tile_budget=tile_budget)
+                else:
+                    yield PairResult(*task, batches=iter_pair_matches(task, product_cache, batch_size, band_pairs,
+                                                                     data_files, frame_interval, tile_budget))
+                if prefetcher is not None:
+                    # The caller is done with the pair (and its batches) once it asks for the next one
+                    prefetcher.finish(task_index)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            data_files.close_all()
+    else:
+        # Workers keep their own instrumentation, which comes back with each result when it is enabled here.
+        compare = partial(compare_file_pairs, product_cache=product_cache, collect_metrics=instrumentation.is_enabled(),
+                          band_pairs=band_pairs, frame_interval=frame_interval, tile_budget=tile_budget)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for results in executor.map(compare, group_pair_tasks(tasks)):
+                for result in results:
+                    if result.metrics is not None:
+                        instrumentation.registry.merge(result.metrics)
+                    yield result
+
@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+from file_handler import DEFAULT_BAND_PAIR
+import instrumentation
+
+# Reads what the next planned pairs need on a background thread while the current pair is matched, so
+# disk (or network) and CPU are busy at the same time. The values end up in the files' own memos (the
+# DataFileSet's LazyDataFiles, their DataSetCaches and band planes), where the pair's run finds them.
+#
+#   prefetcher = Prefetcher(tasks, data_files)
+#   for i, task in enumerate(tasks):
+#       prefetcher.wait(i)
+#       ... run task ...
+#       prefetcher.finish(i)
+#   prefetcher.close()
+#
+# A prefetched pair's files are pinned until finish() is called for it, so neither the DataFileSet nor its
+# FileHandlePool closes them (which would drop the values read into them) before the pair has run.
+#
+# At most lookahead pairs past the current one are read ahead, so memory stays bounded. h5py reads
+# release the GIL for most of their work; pyhdf never releases it, so HDF4 reads from the two threads
+# simply take turns.
+
+DEFAULT_LOOKAHEAD = 1
+
+
+def prefetch_pair(task, data_files, band_pairs=None, tiled=False):
+    # Everything iter_pair_matches reads from the pair's two files. Values are read the same way the
+    # pair asks for them, so the memos match. With tiled=True the off-nadir values are left to be read
+    # tile by tile. Returns the two files, pinned; they are unpinned again if the prefetch fails.
+    n_num, on_num, nadir_path, off_nadir_path = task
+    pinned = []
+    try:
+        with instrumentation.stage("prefetch"):
+            nadir_file = data_files.get(nadir_path, pin=True)
+            pinned.append(nadir_file)
+            off_nadir_file = data_files.get(off_nadir_path, pin=True)
+            pinned.append(off_nadir_file)
+            nadir_file.generate_nadir_data_points()
+            if band_pairs is None:
+                nadir_file.get_nadir_radiances()
+            else:
+                for band_pair in band_pairs:
+                    nadir_file.get_nadir_radiances(*nadir_file.get_band(band_pair))
+            off_nadir_file.box_set
+            off_nadir_file.get_time_axis()
+            off_nadir_file.get_off_nadir_geolocation()
+            if not tiled:
+                for band_pair in band_pairs or [DEFAULT_BAND_PAIR]:
+                    off_nadir_file.load_band(*off_nadir_file.get_band(band_pair))
+    except Exception:
+        for lazy_file in pinned:
+            data_files.unpin(lazy_file)
+        raise
+    instrumentation.increment("pairs_prefetched")
+    return pinned
+
+
+class Prefetcher(object):
+    # Runs prefetch_pair for the tasks after the current one on a single background thread. A failed
+    # prefetch is ignored; the pair reads (and fails) again when it runs, which reports the error.
+    # data_files must be able to keep the files of lookahead + 1 pairs open at once.
+
+    def __init__(self, tasks, data_files, band_pairs=None, lookahead=DEFAULT_LOOKAHEAD, tiled=False):
+        self.tasks = list(tasks)
+        self.data_files = data_files
+        self.band_pairs = band_pairs
+        self.lookahead = max(int(lookahead), 0)
+        self.tiled = tiled
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        # task index -> Future
+        self.futures = {}
+        self.next_task = 0
+
+    def wait(self, task_index):
+        # Called before running tasks[task_index]: queues the tasks up to lookahead past it and waits until
+        # its own prefetch is done.
+        while self.next_task < len(self.tasks) and self.next_task <= task_index + self.lookahead:
+            self.futures[self.next_task] = self.executor.submit(prefetch_pair, self.tasks[self.next_task],
+                                                                self.data_files, self.band_pairs, self.tiled)
+            self.next_task += 1
+        future = self.futures.get(task_index)
+        if future is not None:
+            with instrumentation.stage("prefetch_wait"):
+                try:
+                    future.result()
+                except Exception:
+                    instrumentation.increment("prefetches_failed")
+
+    def finish(self, task_index):
+        # Called once tasks[task_index] has run: its files may be closed again from now on.
+        future = self.futures.pop(task_index, None)
+        if future is not None:
+            self.unpin(future)
+
+    def unpin(self, future):
+        if not future.cancelled() and future.exception() is None:
+            for lazy_file in future.result():
+                self.data_files.unpin(lazy_file)
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        for future in self.futures.values():
+            self.unpin(future)
+        self.futures.clear()
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import numpy
+import instrumentation
+
+# Default location and size cap of the product cache
+DEFAULT_CACHE_DIRECTORY = 'product_cache'
+DEFAULT_SIZE_LIMIT = 4 * 1024 ** 3
+
+
+class ProductCache(object):
+    # Directory of .npy files holding arrays derived from input granules (scan boxes, coordinates, scan
+    # times, nadir radiances...). Entries are named <file key>_<product key>.npy, where the file key
+    # hashes the granule's path and the product key hashes its size, modification time, the product name
+    # and any parameters, so a changed granule never reads a stale entry. Arrays are loaded back
+    # memory-mapped and read-only, which lets later runs and worker processes share the pages instead of
+    # each holding a copy. Once the directory grows past size_limit bytes the least recently used entries
+    # (by file modification time, refreshed on every hit) are deleted.
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, size_limit=DEFAULT_SIZE_LIMIT):
+        self.directory = directory
+        self.size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+
+    def get_file_key(self, path):
+        return hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+
+    def get_entry_path(self, path, product, params=()):
+        stat = os.stat(path)
+        description = repr((stat.st_size, stat.st_mtime, product, tuple(params)))
+        product_key = hashlib.sha1(description.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.directory, self.get_file_key(path) + "_" + product_key + ".npy")
+
+    def get(self, path, product, params=()):
+        # The cached array, memory-mapped, or None
+        entry_path = self.get_entry_path(path, product, params)
+        try:
+            array = numpy.load(entry_path, mmap_mode="r")
+        except (IOError, ValueError):
+            self.misses += 1
+            instrumentation.increment("product_cache_misses", product=product)
+            return None
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            # Evicted by another process since it was loaded
+            self.misses += 1
+            instrumentation.increment("product_cache_misses", product=product)
+            return None
+        self.hits += 1
+        instrumentation.increment("product_cache_hits", product=product)
+        return array
+
+    def put(self, path, product, array, params=()):
+        entry_path = self.get_entry_path(path, product, params)
+        os.makedirs(self.directory, exist_ok=True)
+        # Written under a temporary name and renamed, so other processes never load a partial file.
+        temporary_path = entry_path[:-4] + "." + str(os.getpid()) + ".tmp"
+        with open(temporary_path, "wb") as file:
+            numpy.save(file, numpy.ascontiguousarray(array))
+        os.replace(temporary_path, entry_path)
+        # Mapped before evicting, so an entry bigger than the whole limit can still be used this once.
+        array = numpy.load(entry_path, mmap_mode="r")
+        self.evict()
+        return array
+
+    def get_or_create(self, path, product, loader, params=()):
+        array = self.get(path, product, params)
+        if array is None:
+            array = self.put(path, product, loader(), params)
+        return array
+
+    def list_entries(self):
+        # [(last use, size, entry path)], least recently used first
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for entry_name in os.listdir(self.directory):
+            if entry_name.endswith(".npy"):
+                entry_path = os.path.join(self.directory, entry_name)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return sorted(entries)
+
+    def get_size(self):
+        return sum(size for last_use, size, entry_path in self.list_entries())
+
+    def evict(self):
+        entries = self.list_entries()
+        total = sum(size for last_use, size, entry_path in entries)
+        for last_use, size, entry_path in entries:
+            if total <= self.size_limit:
+                break
+            self.remove(entry_path)
+            total -= size
+
+    def invalidate(self, path):
+        # Drops every entry derived from one granule, whatever its size and modification time were
+        prefix = self.get_file_key(path) + "_"
+        for last_use, size, entry_path in self.list_entries():
+            if os.path.basename(entry_path).startswith(prefix):
+                self.remove(entry_path)
+
+    def clear(self):
+        for last_use, size, entry_path in self.list_entries():
+            self.remove(entry_path)
+
+    def remove(self, entry_path):
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
@@ -0,0 +1,74 @@
+from math import floor
+import numpy
+from geometry import longitude_difference
+
+
+class GeolocationGridIndex(object):
+    # Buckets geolocation values into lat/lon cells of cell_size degrees. Pixels are stored sorted by
+    # cell key (lat_cell * lon_cells + lon_cell), so every row of cells a query touches is one
+    # contiguous slice that can be found by bisection.
+
+    def __init__(self, latitudes, longitudes, cell_size=0.25):
+        self.shape = numpy.shape(latitudes)
+        self.cell_size = float(cell_size)
+        self.lat_cells = int(numpy.ceil(180.0 / self.cell_size))
+        self.lon_cells = int(numpy.ceil(360.0 / self.cell_size))
+        lats = numpy.asarray(latitudes, dtype=numpy.float64).ravel()
+        lons = numpy.asarray(longitudes, dtype=numpy.float64).ravel()
+        # Fill values (-999.x) and NaNs are never returned by a query.
+        valid = numpy.isfinite(lats) & numpy.isfinite(lons) & (numpy.abs(lats) <= 90.0) & (numpy.abs(lons) <= 360.0)
+        pixels = numpy.nonzero(valid)[0]
+        keys = self.cell_keys(lats[pixels], lons[pixels])
+        order = numpy.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.pixels = pixels[order]
+        self.latitudes = lats[self.pixels]
+        self.longitudes = lons[self.pixels]
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def lat_cell(self, lat):
+        return numpy.clip(numpy.floor((lat + 90.0) / self.cell_size).astype(numpy.int64), 0, self.lat_cells - 1)
+
+    def lon_cell(self, lon):
+        return numpy.floor(((lon + 180.0) % 360.0) / self.cell_size).astype(numpy.int64) % self.lon_cells
+
+    def cell_keys(self, lats, lons):
+        return self.lat_cell(lats) * self.lon_cells + self.lon_cell(lons)
+
+    def get_cell_ranges(self, lat, lon, lat_radius, lon_radius):
+        first_row = int(self.lat_cell(lat - lat_radius))
+        last_row = int(self.lat_cell(lat + lat_radius))
+        # Near the poles (or for very wide windows) every longitude cell is a candidate.
+        if lon_radius >= 180.0 or abs(lat) + lat_radius >= 90.0:
+            column_spans = [(0, self.lon_cells - 1)]
+        else:
+            first_column = int(floor(((lon - lon_radius + 180.0) % 360.0) / self.cell_size)) % self.lon_cells
+            last_column = int(floor(((lon + lon_radius + 180.0) % 360.0) / self.cell_size)) % self.lon_cells
+            if first_column <= last_column:
+                column_spans = [(first_column, last_column)]
+            else:
+                # The window crosses the antimeridian, so it wraps to the start of the row.
+                column_spans = [(first_column, self.lon_cells - 1), (0, last_column)]
+        ranges = []
+        for row in range(first_row, last_row + 1):
+            for first_column, last_column in column_spans:
+                start = numpy.searchsorted(self.keys, row * self.lon_cells + first_column, side="left")
+                end = numpy.searchsorted(self.keys, row * self.lon_cells + last_column, side="right")
+                if start < end:
+                    ranges.append((start, end))
+        return ranges
+
+    def query(self, lat, lon, lat_radius, lon_radius):
+        # Returns the flat (row-major) indices of all pixels within lat_radius/lon_radius degrees.
+        ranges = self.get_cell_ranges(lat, lon, lat_radius, lon_radius)
+        if not ranges:
+            return numpy.empty(0, dtype=numpy.int64)
+        candidates = numpy.concatenate([numpy.arange(start, end) for start, end in ranges])
+        in_range = (numpy.abs(self.latitudes[candidates] - lat) <= lat_radius) & \
+                   (longitude_difference(self.longitudes[candidates], lon) <= lon_radius)
+        return numpy.sort(self.pixels[candidates[in_range]])
+
+    def query_scans_and_frames(self, lat, lon, lat_radius, lon_radius):
+        return numpy.divmod(self.query(lat, lon, lat_radius, lon_radius), self.shape[1])
@@ -0,0 +1,158 @@
+import datetime
+import os
+import h5py
+import numpy
+from pyhdf.SD import SD, SDC
+from pyhdf.HDF import HDF, HC
+# HDF.vstart() needs the VS module to have been imported
+import pyhdf.VS
+
+# Small stand-ins for real granules, written with the same layout the file handlers read, so the whole
+# pipeline can be run and timed without downloading any data. Geolocation is a straight track heading
+# north; radiances are random but calibrate to nearly the same values on both instruments, so most
+# ratios land inside the .9 - 1.1 window used by aggregate_by_angle.
+
+MODIS_SCANS = 203
+MODIS_FRAMES = 1354
+MODIS_GEOLOCATION_FRAMES = 271
+MODIS_SCAN_SECONDS = 1.4771
+MODIS_GRANULE_MINUTES = 5
+# Degrees per scan along and across track
+MODIS_LATITUDE_STEP = .09
+MODIS_SWATH_WIDTH = 22.0
+VIIRS_SCANS_PER_GRANULE = 48
+VIIRS_DETECTORS = 16
+VIIRS_FRAMES = 3200
+VIIRS_SCAN_SECONDS = 1.7864
+VIIRS_LATITUDE_STEP = .1
+VIIRS_SWATH_WIDTH = 30.0
+EPOCH = datetime.datetime(1958, 1, 1)
+
+
+def wrap_longitudes(longitudes):
+    # Into [-180, 180), so tracks can be put across the antimeridian. Longitudes already in range are
+    # left exactly as they are.
+    return numpy.where(longitudes >= 180, longitudes - 360, numpy.where(longitudes < -180, longitudes + 360, longitudes))
+
+
+def modis_file_name(start_time):
+    return "MYD021KM.A" + start_time.strftime("%Y%j.%H%M") + ".061.hdf"
+
+
+def viirs_file_name(start_time, band="M"):
+    return ("SVM14" if band == "M" else "SVI05") + "_npp_d" + start_time.strftime("%Y%m%d_t%H%M") + ".h5"
+
+
+def make_modis_granule(path, start_time, latitude=-10.5, longitude=20.3, scans=MODIS_SCANS, seed=0):
+    # MYD021KM-like HDF4 file: 2 geolocation rows per scan (Latitude/Longitude), 10 detectors per scan
+    # in EV_1KM_Emissive, and one Level 1B Swath Metadata record per scan. Only 202-204 scans are
+    # supported by HDF4File.find_valid_factor, and start_time must fall on a whole minute.
+    rows = numpy.arange(scans * 2)[:, None] / 2.0
+    frames = numpy.arange(MODIS_GEOLOCATION_FRAMES)[None, :]
+    middle = MODIS_GEOLOCATION_FRAMES // 2
+    latitudes = (latitude + rows * MODIS_LATITUDE_STEP + 0 * frames).astype(numpy.float32)
+    longitudes = wrap_longitudes(longitude + (frames - middle) / float(middle) * MODIS_SWATH_WIDTH / 2 + rows * .01).astype(numpy.float32)
+    # Vdata has to be written before the SD data sets
+    hdf_file = HDF(path, HC.WRITE | HC.CREATE)
+    v_interface = hdf_file.vstart()
+    metadata = v_interface.create("Level 1B Swath Metadata",
+                                  (("Scan Number", HC.INT32, 1), ("Complete Scan Flag", HC.INT32, 1),
+                                   ("Scan Type", HC.CHAR8, 4), ("Mirror Side", HC.INT32, 1),
+                                   ("EV Sector Start Time", HC.FLOAT64, 1), ("EV_Frames", HC.INT32, 1),
+                                   ("Nadir_Frame_Number", HC.INT32, 1), ("Latitude of Nadir Frame", HC.FLOAT32, 1),
+                                   ("Longitude of Nadir Frame", HC.FLOAT32, 1)))
+    for scan in range(scans):
+        metadata.write([[scan + 1, 1, "Day", scan % 2, 0.0, MODIS_FRAMES, MODIS_FRAMES // 2,
+                         float(latitudes[2 * scan, middle]), float(longitudes[2 * scan, middle])]])
+    metadata.detach()
+    v_interface.end()
+    hdf_file.close()
+    sd_file = SD(path, SDC.WRITE)
+    for name, values in (("Latitude", latitudes), ("Longitude", longitudes)):
+        data_set = sd_file.create(name, SDC.FLOAT32, values.shape)
+        # The fill value has to be set before any data is written
+        data_set.setfillvalue(-999.0)
+        data_set[:] = values
+        data_set.endaccess()
+    emissive = sd_file.create("EV_1KM_Emissive", SDC.UINT16, (16, scans * 10, MODIS_FRAMES))
+    emissive.setfillvalue(65535)
+    emissive[:] = numpy.random.RandomState(seed).randint(630, 700, size=(16, scans * 10, MODIS_FRAMES)).astype(numpy.uint16)
+    emissive.radiance_scales = [.001 * (band + 1) for band in range(16)]
+    emissive.radiance_offsets = [100.0 + band for band in range(16)]
+    emissive.endaccess()
+    sd_file.attr("CoreMetadata.0").set(SDC.CHAR, 'LOCALGRANULEID = "' + modis_file_name(start_time)[:-4] +
+                                       '.2016001000000.hdf"')
+    sd_file.attr("Number of Scans").set(SDC.INT32, scans)
+    sd_file.end()
+    return path
+
+
+def make_viirs_granule(path, start_time, latitude=-10.0, longitude=20.0, granules=4, seed=1, band="M"):
+    # CLASS-like aggregated HDF5 file with the SVM14 SDR and the terrain-corrected M-band geolocation
+    # (GMTCO) in one file, holding the given number of 48-scan granules. band="I" writes SVI05 with the
+    # I-band geolocation (GITCO) instead: twice the detectors and frames over the same ground.
+    scale = 1 if band == "M" else 2
+    detectors = VIIRS_DETECTORS * scale
+    scans = granules * VIIRS_SCANS_PER_GRANULE
+    rows = numpy.arange(scans * detectors)[:, None] / float(detectors)
+    frames = numpy.arange(VIIRS_FRAMES * scale)[None, :] / float(scale)
+    middle = VIIRS_FRAMES // 2
+    with h5py.File(path, "w") as hdf_file:
+        sdr = hdf_file.create_group("All_Data/" + ("VIIRS-M14-SDR_All" if band == "M" else "VIIRS-I5-SDR_All"))
+        sdr["Radiance"] = numpy.random.RandomState(seed).randint(23500, 26500, size=(scans * detectors, VIIRS_FRAMES * scale)).astype(numpy.uint16)
+        sdr["RadianceFactors"] = numpy.array([.0002, .01] * granules, dtype=numpy.float32)
+        geo = hdf_file.create_group("All_Data/" + ("VIIRS-MOD-GEO-TC_All" if band == "M" else "VIIRS-IMG-GEO-TC_All"))
+        geo["Latitude"] = (latitude + rows * VIIRS_LATITUDE_STEP + 0 * frames).astype(numpy.float32)
+        geo["Longitude"] = wrap_longitudes(longitude + (frames - middle) / float(middle) * VIIRS_SWATH_WIDTH / 2 + rows * .011).astype(numpy.float32)
+        # MidTime is in microseconds from 1958
+        first = int((start_time - EPOCH).total_seconds() * 1e6)
+        geo["MidTime"] = numpy.array([first + int(scan * VIIRS_SCAN_SECONDS * 1e6) for scan in range(scans)], dtype=numpy.uint64)
+        geo["NumberOfScans"] = numpy.array([VIIRS_SCANS_PER_GRANULE] * granules, dtype=numpy.int32)
+    return path
+
+
+def make_reflectance_granule(path, band="M", granules=2, seed=2):
+    # VIIRS M5 or I1 reflectance file for the I vs. M band comparison. I-band files have twice the rows
+    # and columns. A few fill values are put in the first row.
+    rows_per_granule = 768 if band == "M" else 1536
+    columns = VIIRS_FRAMES if band == "M" else VIIRS_FRAMES * 2
+    with h5py.File(path, "w") as hdf_file:
+        sdr = hdf_file.create_group("All_Data/" + ("VIIRS-M5-SDR_All" if band == "M" else "VIIRS-I1-SDR_All"))
+        reflectance = numpy.random.RandomState(seed).randint(0, 60000, size=(granules * rows_per_granule, columns)).astype(numpy.uint16)
+        reflectance[0, :4] = 65533
+        sdr["Reflectance"] = reflectance
+        sdr["ReflectanceFactors"] = numpy.array(sum([[1.5e-5 * (g + 1), -.01 * g] for g in range(granules)], []),
+                                                dtype=numpy.float32)
+        geo = hdf_file.create_group("All_Data/VIIRS-MOD-GEO-TC_All")
+        geo["Latitude"] = numpy.zeros((granules * 768, VIIRS_FRAMES), numpy.float32)
+        geo["Longitude"] = numpy.zeros((granules * 768, VIIRS_FRAMES), numpy.float32)
+        geo["MidTime"] = numpy.arange(granules * VIIRS_SCANS_PER_GRANULE, dtype=numpy.uint64) * 1786400 + 1800000000000000
+        geo["NumberOfScans"] = numpy.array([VIIRS_SCANS_PER_GRANULE] * granules, dtype=numpy.int32)
+    return path
+
+
+def make_granule_set(directory, modis_granules=1, viirs_granules=4, overlap=1.0,
+                     start_time=datetime.datetime(2016, 1, 1, 12, 30), viirs_band="M", longitude=20.0):
+    # Writes consecutive MODIS granules into <directory>/modis and one CLASS file with viirs_granules
+    # granules into <directory>/viirs, starting two minutes before the first MODIS granule. overlap is
+    # the fraction of the MODIS swath width the VIIRS track overlaps: 1 puts the tracks almost on top of
+    # each other, 0 moves VIIRS just clear of MODIS. viirs_band="I" writes an I-band file. longitude is
+    # where the VIIRS track starts; 179 puts the nadir tracks across the antimeridian. Returns
+    # (MODIS paths, VIIRS paths).
+    modis_directory = os.path.join(directory, "modis")
+    viirs_directory = os.path.join(directory, "viirs")
+    for sub_directory in (modis_directory, viirs_directory):
+        os.makedirs(sub_directory, exist_ok=True)
+        for file_name in os.listdir(sub_directory):
+            os.remove(os.path.join(sub_directory, file_name))
+    modis_paths = []
+    for granule in range(modis_granules):
+        granule_start = start_time + datetime.timedelta(minutes=MODIS_GRANULE_MINUTES * granule)
+        latitude = -10.5 + granule * MODIS_SCANS * MODIS_LATITUDE_STEP
+        modis_paths.append(make_modis_granule(os.path.join(modis_directory, modis_file_name(granule_start)),
+                                              granule_start, latitude=latitude, longitude=longitude + .3, seed=granule))
+    viirs_start = start_time - datetime.timedelta(minutes=2)
+    viirs_longitude = longitude + (1.0 - overlap) * (MODIS_SWATH_WIDTH + VIIRS_SWATH_WIDTH) / 2
+    viirs_paths = [make_viirs_granule(os.path.join(viirs_directory, viirs_file_name(viirs_start, viirs_band)),
+                                      viirs_start, longitude=viirs_longitude, granules=viirs_granules, band=viirs_band)]
+    return modis_paths, viirs_paths
@@ -0,0 +1,16 @@
+import os
+import sys
+import pytest
+
+# The modules live at the top of the repository, next to this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_granules import make_granule_set
+
+
+@pytest.fixture(scope="session")
+def granules(tmp_path_factory):
+    # (MODIS path, VIIRS path) of one overlapping synthetic pair
+    modis_paths, viirs_paths = make_granule_set(str(tmp_path_factory.mktemp("granules")), modis_granules=1,
+                                                viirs_granules=4)
+    return modis_paths[0], viirs_paths[0]
@@ -0,0 +1,47 @@
+import numpy
+import pytest
+from band_differencing import M5_WEIGHT, compute_ivm
+from file_handler import HDF5File
+from synthetic_granules import make_reflectance_granule
+
+
+@pytest.fixture(scope="module")
+def reflectance_files(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("ivm")
+    i_file = HDF5File(make_reflectance_granule(str(directory / "SVI01_npp_d20160101_t1230.h5"), band="I"))
+    m_file = HDF5File(make_reflectance_granule(str(directory / "SVM05_npp_d20160101_t1230.h5"), band="M"))
+    yield i_file, m_file
+    i_file.close_file()
+    m_file.close_file()
+
+
+def reflectance_at(data_file, row, column, rows_per_granule):
+    # One pixel scaled with the factors of its own granule, or NaN for a fill value
+    raw = int(data_file.get_specific_sdr_data_set("Reflectance").data[row, column])
+    gains, offsets = data_file.get_reflectance_factors()
+    granule = row // rows_per_granule
+    return numpy.nan if raw >= 65528 else raw * gains[granule] + offsets[granule]
+
+
+@pytest.mark.parametrize("tiled", [False, True])
+def test_ivm_matches_pixel_by_pixel_reference(reflectance_files, tiled):
+    i_file, m_file = reflectance_files
+    trace, i_values, m_values = compute_ivm(i_file, m_file, tiled)
+    assert trace.shape == i_values.shape == m_values.shape == (2 * 768, 3200)
+    # Fill values in the first row, both granules, and the last row and column
+    for row, column in [(0, 0), (0, 1), (0, 2), (0, 5), (100, 700), (767, 3199), (768, 0), (1000, 1234), (1535, 3199)]:
+        i_expected = numpy.mean([reflectance_at(i_file, 2 * row + r, 2 * column + c, 1536)
+                                 for r in (0, 1) for c in (0, 1)])
+        m_expected = reflectance_at(m_file, row, column, 768)
+        assert numpy.allclose([i_values[row, column], m_values[row, column], trace[row, column]],
+                              [i_expected, m_expected, i_expected - M5_WEIGHT * m_expected],
+                              rtol=1e-6, atol=1e-6, equal_nan=True)
+    assert numpy.isnan(m_values[0, :4]).all() and numpy.isnan(i_values[0, :2]).all()
+    assert not numpy.isnan(trace[1:]).any()
+
+
+def test_tiled_ivm_equals_untiled(reflectance_files):
+    untiled = compute_ivm(*reflectance_files)
+    tiled = compute_ivm(*reflectance_files, tiled=True)
+    for whole, tile in zip(untiled, tiled):
+        assert numpy.array_equal(whole, tile, equal_nan=True)
@@ -0,0 +1,98 @@
+import os
+import shutil
+import sqlite3
+import numpy
+import pytest
+from batch import get_band_tables, parse_settings, run_batch
+from synthetic_granules import make_granule_set
+
+
+def get_settings(directories, tmp_path, *arguments):
+    # directories = (nadir, off-nadir)
+    return parse_settings(["--nadir", directories[0], "--off-nadir", directories[1],
+                           "--manifest", str(tmp_path / "manifest.db"), "--catalog", str(tmp_path / "granules.db"),
+                           "--cache", str(tmp_path / "cache"), "--prefetch", "0"] + list(arguments))
+
+
+def count_rows(database_file):
+    # {table: rows}
+    connection = sqlite3.connect(database_file)
+    tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    counts = dict((table, connection.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]) for table in tables)
+    connection.close()
+    return counts
+
+
+def test_band_tables_use_the_full_data_set_name():
+    tables = get_band_tables({"table": "t"}, [(8, "Radiance"), (8, "VIIRS-M15-SDR_All/Radiance"),
+                                              (8, "VIIRS-M15-SDR_All/BrightnessTemperature")])
+    assert tables[False] == {(8, "Radiance"): "t_8_Radiance",
+                             (8, "VIIRS-M15-SDR_All/Radiance"): "t_8_VIIRS_M15_SDR_All_Radiance",
+                             (8, "VIIRS-M15-SDR_All/BrightnessTemperature"): "t_8_VIIRS_M15_SDR_All_BrightnessTemperature"}
+    assert tables[True][(8, "Radiance")] == "t_8_Radiance_reverse"
+
+
+def test_band_pairs_sharing_a_table_are_refused():
+    with pytest.raises(Exception):
+        get_band_tables({"table": "t"}, [(8, "VIIRS-M15-SDR_All/Radiance"), (8, "VIIRS_M15-SDR_All/Radiance")])
+    with pytest.raises(Exception):
+        get_band_tables({"table": "t"}, [(8, "Radiance"), (8, "Radiance_reverse")])
+
+
+def test_reverse_results_get_their_own_tables(granules, tmp_path):
+    directories = (os.path.dirname(granules[0]), os.path.dirname(granules[1]))
+    database_file = str(tmp_path / "results.db")
+    assert run_batch(get_settings(directories, tmp_path, "--reverse", "--sqlite", database_file, "--table", "t",
+                                  "--store-matches")) == 0
+    counts = count_rows(database_file)
+    assert set(counts) == {"t", "t_matches", "t_reverse", "t_reverse_matches"}
+    assert all(counts.values())
+    # The forward tables hold exactly what a run without --reverse writes.
+    forward_path = tmp_path / "forward"
+    forward_path.mkdir()
+    forward_file = str(forward_path / "results.db")
+    assert run_batch(get_settings(directories, forward_path, "--sqlite", forward_file, "--table", "t",
+                                  "--store-matches")) == 0
+    forward_counts = count_rows(forward_file)
+    assert forward_counts == {"t": counts["t"], "t_matches": counts["t_matches"]}
+    assert counts["t_reverse_matches"] != counts["t_matches"]
+
+
+def read_export(file_name):
+    # {(band, off-nadir instrument, angle): (count, average, deviation)}
+    with open(file_name) as file:
+        lines = file.read().splitlines()[1:]
+    rows = {}
+    for line in lines:
+        band, instrument, angle, count, average, deviation = line.split(",")[:6]
+        rows[(band, instrument, float(angle))] = (int(count), float(average), float(deviation))
+    return rows
+
+
+def test_statistics_merge_across_incremental_runs(tmp_path):
+    modis_paths, viirs_paths = make_granule_set(str(tmp_path / "granules"), modis_granules=2, viirs_granules=4)
+    nadir_directory = tmp_path / "nadir"
+    nadir_directory.mkdir()
+    incremental = tmp_path / "incremental"
+    incremental.mkdir()
+    settings = ("--bin-width", ".5", "--export", str(incremental / "aggregates.csv"))
+    # The second MODIS granule only turns up for the second run.
+    shutil.copy2(modis_paths[0], str(nadir_directory))
+    directories = (str(nadir_directory), os.path.dirname(viirs_paths[0]))
+    assert run_batch(get_settings(directories, incremental, *settings)) == 0
+    shutil.copy2(modis_paths[1], str(nadir_directory))
+    assert run_batch(get_settings(directories, incremental, *settings)) == 0
+    at_once = tmp_path / "at_once"
+    at_once.mkdir()
+    assert run_batch(get_settings(directories, at_once, "--bin-width", ".5", "--export",
+                                  str(at_once / "aggregates.csv"))) == 0
+    merged = read_export(str(incremental / "aggregates.csv"))
+    expected = read_export(str(at_once / "aggregates.csv"))
+    assert sorted(merged) == sorted(expected) and len(merged) > 0
+    for key in expected:
+        assert merged[key][0] == expected[key][0]
+        assert numpy.allclose(merged[key][1:], expected[key][1:])
+    # Statistics made with other bins could not be merged with these, so the run is refused up front.
+    with pytest.raises(Exception, match="bin_width"):
+        run_batch(get_settings(directories, incremental, "--bin-width", "1", "--export",
+                               str(incremental / "aggregates.csv")))
@@ -0,0 +1,74 @@
+import datetime
+import pytest
+from collocation import NadirTrack, OffNadirGeolocation, find_candidate_matches, times_to_seconds
+from data_structures import NadirPoint
+from file_handler import HDF4File, HDF5File
+from synthetic_granules import make_granule_set
+from time_axis import ScanTimeAxis
+
+
+@pytest.fixture(scope="module", params=[20.0, 179.0], ids=["prime_meridian", "antimeridian"])
+def granule_pair(request, tmp_path_factory):
+    modis_paths, viirs_paths = make_granule_set(str(tmp_path_factory.mktemp("collocation")), modis_granules=1,
+                                                viirs_granules=2, longitude=request.param)
+    return modis_paths[0], viirs_paths[0], request.param
+
+
+def match_by_loops(nadir_points, off_nadir_file, scans):
+    # The nested nadir -> scan -> frame loops compare_to_off_nadir used to run, one pixel at a time
+    geolocation = off_nadir_file.get_off_nadir_geolocation()
+    rows = dict((scan, row) for row, scan in enumerate(geolocation.scans))
+    times = off_nadir_file.get_times_list()
+    matches = []
+    for n in range(len(nadir_points)):
+        for scan in scans:
+            if nadir_points[n].within_time_range(times[scan - 1]):
+                for c in range(geolocation.latitudes.shape[1]):
+                    if nadir_points[n].within_geospatial_range(geolocation.get_coordinate(rows[scan], c)):
+                        matches.append((n, scan, c))
+    return matches
+
+
+@pytest.mark.parametrize("reverse", [False, True], ids=["viirs_off_nadir", "modis_off_nadir"])
+def test_vectorized_matches_equal_nested_loops(granule_pair, reverse):
+    modis_file = HDF4File(granule_pair[0])
+    viirs_file = HDF5File(granule_pair[1])
+    nadir_file, off_nadir_file = (viirs_file, modis_file) if reverse else (modis_file, viirs_file)
+    nadir_points = nadir_file.generate_nadir_data_points()
+    scans = off_nadir_file.find_zone_scans(nadir_points)
+    geolocation = off_nadir_file.get_off_nadir_geolocation()
+    n, o, c = find_candidate_matches(NadirTrack(nadir_points), geolocation, scans)
+    expected = match_by_loops(nadir_points, off_nadir_file, scans)
+    assert len(expected) > 0
+    assert list(zip(n.tolist(), geolocation.scans[o].tolist(), c.tolist())) == expected
+    modis_file.close_file()
+    viirs_file.close_file()
+
+
+def test_matches_are_found_on_both_sides_of_the_antimeridian(granule_pair):
+    modis_file = HDF4File(granule_pair[0])
+    viirs_file = HDF5File(granule_pair[1])
+    nadir_points = modis_file.generate_nadir_data_points()
+    geolocation = viirs_file.get_off_nadir_geolocation()
+    n, o, c = find_candidate_matches(NadirTrack(nadir_points), geolocation, viirs_file.find_zone_scans(nadir_points))
+    longitudes = geolocation.longitudes[o, c]
+    crosses = (longitudes > 179).any() and (longitudes < -179).any()
+    assert crosses == (granule_pair[2] == 179.0)
+    modis_file.close_file()
+    viirs_file.close_file()
+
+
+def test_matches_include_pixels_exactly_on_the_tolerance_boundaries():
+    # At the equator the longitude tolerance equals the latitude one. Both nadir points allow 0.5 degrees
+    # and 10 seconds, and the second sits next to the antimeridian.
+    nadir_time = datetime.datetime(2016, 1, 1, 12, 30)
+    nadir_points = [NadirPoint(0.0, 10.0, nadir_time, 1, .5, datetime.timedelta(seconds=10), 0),
+                    NadirPoint(0.0, 179.75, nadir_time, 2, .5, datetime.timedelta(seconds=10), 1)]
+    frames = [(0.0, 10.0), (.5, 10.0), (.5000001, 10.0), (-.5, 10.0), (0.0, 10.5), (0.0, 10.5000001), (0.0, 9.5),
+              (0.0, 9.4999999), (0.0, -179.75), (0.0, -179.7499999)]
+    scan_times = times_to_seconds([nadir_time + datetime.timedelta(seconds=s) for s in (-10, 0, 10.001, 10)])
+    geolocation = OffNadirGeolocation([frames] * 4, [1, 2, 3, 4], ScanTimeAxis(scan_times))
+    n, o, c = find_candidate_matches(NadirTrack(nadir_points), geolocation)
+    matches = list(zip(n.tolist(), geolocation.scans[o].tolist(), c.tolist()))
+    assert matches == [(0, scan, frame) for scan in (1, 2, 4) for frame in (0, 1, 3, 4, 6)] + \
+        [(1, scan, 8) for scan in (1, 2, 4)]
@@ -0,0 +1,43 @@
+import datetime
+import h5py
+import numpy
+from pyhdf.SD import SD, SDC
+from file_handler import HDF4File, HDF5File
+from synthetic_granules import make_modis_granule, make_viirs_granule
+
+START = datetime.datetime(2016, 1, 1, 12, 30)
+
+
+def test_gathered_viirs_values_leave_fill_values_out(tmp_path):
+    path = make_viirs_granule(str(tmp_path / "viirs.h5"), START, granules=1)
+    with h5py.File(path, "r+") as hdf_file:
+        radiance = hdf_file["All_Data/VIIRS-M14-SDR_All/Radiance"]
+        # Scan 1: detector 0 is fill at frame 10, every detector at frame 20
+        radiance[0, 10] = 65535
+        radiance[:16, 20] = 65533
+    viirs_file = HDF5File(path)
+    data_set = viirs_file.get_specific_sdr_data_set("Radiance")
+    expected = data_set.read_scan_data_for(0, 15, 0, 30, 10)[0]
+    for tiled in (False, True):
+        values = data_set.gather_calibrated_values([1, 1, 1, 1], [0, 10, 20, 30], tiled=tiled)
+        assert numpy.array_equal(values, expected + 1, equal_nan=True)
+    assert numpy.isnan(expected[2]) and not numpy.isnan(expected[1])
+    viirs_file.close_file()
+
+
+def test_gathered_modis_values_leave_fill_values_out(tmp_path):
+    path = make_modis_granule(str(tmp_path / "modis.hdf"), START)
+    sd_file = SD(path, SDC.WRITE)
+    emissive = sd_file.select("EV_1KM_Emissive")
+    # Scan 1 of band 8: detector 0 is fill at frame 10, every detector at frame 20
+    emissive[8:9, 0:1, 10:11] = numpy.full((1, 1, 1), 65535, numpy.uint16)
+    emissive[8:9, 0:10, 20:21] = numpy.full((1, 10, 1), 65535, numpy.uint16)
+    emissive.endaccess()
+    sd_file.end()
+    modis_file = HDF4File(path)
+    data_set = modis_file.get_specific_sds_data_set("EV_1KM_Emissive")
+    expected = data_set.get_data_chunk_3d(8, 0, 9, 0, 30, 10)[0][[0, 10, 20, 30]]
+    values = data_set.gather_calibrated_values([1, 1, 1, 1], [0, 10, 20, 30], 1, 0)
+    assert numpy.array_equal(values, expected, equal_nan=True)
+    assert numpy.isnan(expected[2]) and not numpy.isnan(expected[1])
+    modis_file.close_file()
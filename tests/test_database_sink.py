@@ -0,0 +1,84 @@
+import sqlite3
+import numpy
+from database_sink import SQLiteSink
+from file_handler import HDF4File, HDF5File
+from match_table import COLUMN_NAMES, MatchTable, concatenate
+
+
+def get_tables(database_file):
+    connection = sqlite3.connect(database_file)
+    tables = set(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    connection.close()
+    return tables
+
+
+def test_sqlite_tables_are_created_on_first_write(tmp_path):
+    database_file = str(tmp_path / "sink.db")
+    sink = SQLiteSink(database_file, "base", store_matches=True)
+    sink.write_aggregates([(1.0, 2.0, 3.0)], "base_8_Radiance")
+    sink.close()
+    assert get_tables(database_file) == {"base_8_Radiance"}
+
+
+def test_sqlite_rows_are_inserted_in_chunks_and_flushed_on_close(tmp_path):
+    database_file = str(tmp_path / "sink.db")
+    # Nothing is committed before close: the commit interval is never reached.
+    sink = SQLiteSink(database_file, "base", store_matches=True, batch_size=3, commit_interval=3600)
+    aggregates = [(float(angle), angle / 10.0, angle / 100.0) for angle in range(7)]
+    sink.write_aggregates(aggregates)
+    matches = MatchTable({"viirs_scan": numpy.arange(1, 6), "modis_scan": numpy.arange(6, 11),
+                          "viirs_lat": numpy.linspace(-1, 1, 5), "difference_ratio": numpy.linspace(.9, 1.1, 5)})
+    sink.write_matches(matches)
+    sink.close()
+    assert sink.rows_written == 12
+    connection = sqlite3.connect(database_file)
+    stored_aggregates = connection.execute("SELECT angle, avgv, std FROM base ORDER BY angle").fetchall()
+    stored_matches = connection.execute("SELECT " + ", ".join(COLUMN_NAMES) + " FROM base_matches ORDER BY viirs_scan"
+                                        ).fetchall()
+    connection.close()
+    assert stored_aggregates == aggregates
+    assert len(stored_matches) == 5
+    for c, name in enumerate(COLUMN_NAMES):
+        assert numpy.allclose([row[c] for row in stored_matches], matches.column(name)), name
+
+
+def count_matches(database_file, table):
+    connection = sqlite3.connect(database_file)
+    count = connection.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]
+    connection.close()
+    return count
+
+
+def test_retried_pair_is_stored_once(granules, tmp_path):
+    modis_file = HDF4File(granules[0])
+    viirs_file = HDF5File(granules[1])
+    batches = list(viirs_file.iter_off_nadir_matches(modis_file.generate_nadir_data_points(),
+                                                     modis_file.get_nadir_radiances(), batch_size=500))
+    modis_file.close_file()
+    viirs_file.close_file()
+    database_file = str(tmp_path / "sink.db")
+    # commit_interval=0 commits whenever it is allowed to, so nothing waits for close to be written
+    sink = SQLiteSink(database_file, "base", store_matches=True, commit_interval=0)
+    # The first attempt writes two batches, then fails.
+    sink.begin_pair()
+    sink.write_matches(batches[0])
+    sink.write_matches(batches[1])
+    sink.end_pair(succeeded=False)
+    # An earlier successful pair is kept while another one fails.
+    sink.begin_pair()
+    sink.write_matches(batches[0])
+    sink.end_pair()
+    sink.begin_pair()
+    sink.write_matches(batches[1])
+    sink.end_pair(succeeded=False)
+    sink.begin_pair()
+    for matches in batches[1:]:
+        sink.write_matches(matches)
+    sink.write_aggregates([(1.0, 2.0, 3.0)])
+    sink.end_pair()
+    # A pair still open at close did not finish.
+    sink.begin_pair()
+    sink.write_matches(batches[0])
+    sink.close()
+    assert count_matches(database_file, "base_matches") == len(concatenate(batches))
+    assert count_matches(database_file, "base") == 1
@@ -0,0 +1,26 @@
+import pytest
+from file_handler import HDF4File, HDF5File
+from match_table import concatenate
+
+
+@pytest.mark.parametrize("frame_interval", [1, 2, 3, 4, 5])
+def test_matched_coordinates_are_those_of_the_matched_frame(granules, frame_interval):
+    modis_file = HDF4File(granules[0])
+    viirs_file = HDF5File(granules[1])
+    matches = concatenate(viirs_file.iter_off_nadir_matches(modis_file.generate_nadir_data_points(),
+                                                            modis_file.get_nadir_radiances(), batch_size=None,
+                                                            frame_interval=frame_interval))
+    assert len(matches) > 0
+    lat_set, long_set = viirs_file.get_lat_lon_sets()
+    rows, frames = lat_set.get_dimensions()
+    latitudes = lat_set.chunk_and_return_scan_data_for(0, rows - 1, 0, frames - 1, 1)
+    longitudes = long_set.chunk_and_return_scan_data_for(0, rows - 1, 0, frames - 1, 1)
+    # The every-5th-frame level keeps its historical c * 5 + 1 labelling of the frame read at c * 5.
+    offset = 1 if frame_interval == 5 else 0
+    scans = matches.column("viirs_scan") - 1
+    positions = matches.column("viirs_swath_pos") - offset
+    # MatchTable keeps coordinates as float32
+    assert (matches.column("viirs_lat") == latitudes[scans, positions].astype("float32")).all()
+    assert (matches.column("viirs_lon") == longitudes[scans, positions].astype("float32")).all()
+    modis_file.close_file()
+    viirs_file.close_file()
@@ -0,0 +1,6 @@
+from benchmarks import check_geometry_accuracy
+
+
+def test_array_geometry_agrees_with_the_scalar_reference():
+    errors = check_geometry_accuracy()
+    assert max(errors.values()) <= 1e-6, errors
@@ -0,0 +1,60 @@
+import datetime
+import os
+import pytest
+import granule_catalog
+from granule_catalog import GranuleCatalog
+from parallel_runner import plan_pair_tasks, run_pair_tasks
+from synthetic_granules import make_granule_set, make_viirs_granule, viirs_file_name
+
+
+@pytest.fixture(scope="module")
+def granule_paths(tmp_path_factory):
+    # Two MODIS granules, the VIIRS file over them, and VIIRS files too late and too far away to match them
+    directory = str(tmp_path_factory.mktemp("catalog"))
+    modis_paths, viirs_paths = make_granule_set(directory, modis_granules=2, viirs_granules=2)
+    start_time = datetime.datetime(2016, 1, 1, 12, 28)
+    later = start_time + datetime.timedelta(hours=3)
+    viirs_paths.append(make_viirs_granule(os.path.join(directory, "viirs", viirs_file_name(later)), later, granules=2))
+    os.makedirs(os.path.join(directory, "elsewhere"))
+    viirs_paths.append(make_viirs_granule(os.path.join(directory, "elsewhere", viirs_file_name(start_time)),
+                                          start_time, longitude=120.0, granules=2))
+    return modis_paths, viirs_paths
+
+
+def test_planned_pairs_are_the_pairs_that_can_match(granule_paths, tmp_path):
+    modis_paths, viirs_paths = granule_paths
+    catalog = GranuleCatalog(str(tmp_path / "granules.db"))
+    for nadir_paths, off_nadir_paths in ((modis_paths, viirs_paths), (viirs_paths, modis_paths)):
+        every_pair = plan_pair_tasks(nadir_paths, off_nadir_paths)
+        planned = catalog.plan_pairs(nadir_paths, off_nadir_paths)
+        # The same tasks, in the same order, minus the pairs skipped
+        assert len(planned) > 0
+        assert planned == [task for task in every_pair if task in planned]
+        for task, result in zip(every_pair, run_pair_tasks(every_pair)):
+            assert result.error is None, result.error
+            assert (len(result.matches) > 0) == (task in planned), task
+            if viirs_paths[1] in task or viirs_paths[2] in task:
+                assert task not in planned
+    catalog.close()
+
+
+def test_catalogued_files_are_not_opened_again_until_they_change(granule_paths, tmp_path, monkeypatch):
+    modis_paths, viirs_paths = granule_paths
+    catalog_file = str(tmp_path / "granules.db")
+    catalog = GranuleCatalog(catalog_file)
+    planned = catalog.plan_pairs(modis_paths, viirs_paths)
+    catalog.close()
+    opened = []
+    original = granule_catalog.open_data_file
+    monkeypatch.setattr(granule_catalog, "open_data_file", lambda path: opened.append(path) or original(path))
+    catalog = GranuleCatalog(catalog_file)
+    assert catalog.plan_pairs(modis_paths, viirs_paths) == planned
+    assert opened == []
+    stat = os.stat(viirs_paths[0])
+    os.utime(viirs_paths[0], (stat.st_atime, stat.st_mtime + 1))
+    try:
+        assert catalog.plan_pairs(modis_paths, viirs_paths) == planned
+    finally:
+        os.utime(viirs_paths[0], (stat.st_atime, stat.st_mtime))
+    assert opened == [viirs_paths[0]]
+    catalog.close()
@@ -0,0 +1,29 @@
+from lazy_files import DataFileSet, FileHandlePool, LazyDataFile
+
+
+def test_pinned_files_stay_open(granules):
+    pool = FileHandlePool(max_open_files=1)
+    nadir_file = LazyDataFile(granules[0], pool)
+    off_nadir_file = LazyDataFile(granules[1], pool)
+    pool.pin(nadir_file)
+    nadir_file.get_number_of_scans()
+    off_nadir_file.get_number_of_scans()
+    assert nadir_file.is_open() and off_nadir_file.is_open()
+    pool.unpin(nadir_file)
+    off_nadir_file.get_number_of_scans()
+    assert not nadir_file.is_open() and off_nadir_file.is_open()
+    pool.close_all()
+
+
+def test_pinned_files_are_not_forgotten(tmp_path):
+    # Files are only opened when used, so these never have to hold data.
+    paths = [str(tmp_path / name) for name in ("a.hdf", "b.h5", "c.h5")]
+    for path in paths:
+        open(path, "w").close()
+    data_files = DataFileSet(max_files=2)
+    pinned = data_files.get(paths[0], pin=True)
+    data_files.get(paths[1])
+    data_files.get(paths[2])
+    assert data_files.get(paths[0]) is pinned
+    assert len(data_files) == 2
+    data_files.close_all()
@@ -0,0 +1,47 @@
+import numpy
+import pytest
+from match_table import COLUMNS, COLUMN_NAMES, MatchTable, concatenate
+
+
+def make_columns(length, start=0):
+    return dict((name, numpy.arange(start, start + length).astype(dtype)) for name, dtype in COLUMNS)
+
+
+def test_columns_round_trip_with_their_dtypes():
+    columns = make_columns(5)
+    table = MatchTable(columns)
+    assert len(table) == 5
+    for name, dtype in COLUMNS:
+        assert table.column(name).dtype == dtype
+        assert numpy.array_equal(table.column(name), columns[name])
+    assert numpy.array_equal(MatchTable(table.get_columns()).get_ratios(), columns["difference_ratio"])
+    row = table.row(3)
+    assert (row.get_viirs_scan(), row.get_modis_swath_pos(), row.get_ratio()) == (3, 3, 3.0)
+
+
+def test_missing_columns_are_zero_and_lengths_must_agree():
+    table = MatchTable({"viirs_scan": [1, 2, 3]})
+    assert table.column("modis_value").tolist() == [0.0, 0.0, 0.0]
+    with pytest.raises(Exception):
+        MatchTable({"viirs_scan": [1, 2], "modis_scan": [1]})
+
+
+def test_concatenate_keeps_every_row_in_order():
+    tables = [MatchTable(make_columns(3)), MatchTable(), MatchTable(make_columns(4, start=3))]
+    combined = concatenate(tables)
+    assert len(combined) == 7
+    expected = make_columns(7)
+    for name in COLUMN_NAMES:
+        assert numpy.array_equal(combined.column(name), expected[name]), name
+    # The tables concatenated are left as they were
+    assert len(tables[0]) == 3 and len(tables[2]) == 4
+    assert len(concatenate([])) == 0 and concatenate([]).column("scan_angle").dtype == numpy.float64
+
+
+def test_npz_round_trip(tmp_path):
+    table = concatenate([MatchTable(make_columns(2)), MatchTable(make_columns(2, start=2))])
+    table.to_npz(str(tmp_path / "matches.npz"))
+    with numpy.load(str(tmp_path / "matches.npz")) as saved:
+        restored = MatchTable(dict(saved))
+    for name in COLUMN_NAMES:
+        assert numpy.array_equal(restored.column(name), table.column(name)), name
@@ -0,0 +1,48 @@
+import numpy
+from data_structures import modis_scan_angle, viirs_scan_angle
+from match_table import COLUMN_NAMES
+from parallel_runner import add_reverse_tasks, plan_pair_tasks, run_pair_tasks
+
+
+def test_worker_results_equal_serial_results(granules):
+    tasks = plan_pair_tasks([granules[0]], [granules[1]])
+    tasks = add_reverse_tasks(tasks, plan_pair_tasks([granules[1]], [granules[0]]))
+    # A pair whose file is missing fails the same way in either mode
+    tasks.append((1, 0, granules[0] + ".missing", granules[1]))
+    serial = list(run_pair_tasks(tasks, workers=1))
+    parallel = list(run_pair_tasks(tasks, workers=2))
+    assert [result.nadir_path for result in parallel] == [task[2] for task in tasks]
+    for serial_result, parallel_result in zip(serial, parallel):
+        assert (serial_result.n_num, serial_result.on_num) == (parallel_result.n_num, parallel_result.on_num)
+        assert (serial_result.error is None) == (parallel_result.error is None)
+        if serial_result.error is not None:
+            continue
+        assert len(serial_result.matches) > 0
+        assert len(serial_result.matches) == len(parallel_result.matches)
+        for name in COLUMN_NAMES:
+            assert numpy.array_equal(serial_result.matches.column(name), parallel_result.matches.column(name),
+                                     equal_nan=True), name
+    assert serial[-1].error is not None
+
+
+def test_reverse_pairs_invert_the_ratio_and_match_a_run_of_their_own(granules):
+    forward_tasks = plan_pair_tasks([granules[0]], [granules[1]])
+    reverse_tasks = plan_pair_tasks([granules[1]], [granules[0]])
+    tasks = add_reverse_tasks(forward_tasks, reverse_tasks)
+    assert tasks == forward_tasks + reverse_tasks
+    forward, reverse = list(run_pair_tasks(tasks))
+    # MODIS nadir: VIIRS / MODIS. VIIRS nadir: the inverse, MODIS / VIIRS.
+    for result in (forward, reverse):
+        assert result.error is None and len(result.matches) > 0
+    forward_matches, reverse_matches = forward.matches, reverse.matches
+    assert numpy.allclose(forward_matches.get_ratios(),
+                          forward_matches.column("viirs_value") / forward_matches.column("modis_value"))
+    assert numpy.allclose(reverse_matches.get_ratios() * reverse_matches.column("viirs_value") /
+                          reverse_matches.column("modis_value"), 1.0)
+    # Scan angles come from the off-nadir instrument's swath positions
+    assert numpy.allclose(forward_matches.get_angles(), viirs_scan_angle(forward_matches.column("viirs_swath_pos")))
+    assert numpy.allclose(reverse_matches.get_angles(), modis_scan_angle(reverse_matches.column("modis_swath_pos")))
+    # Running both directions together, on shared files, changes nothing in either
+    alone = list(run_pair_tasks(reverse_tasks))[0]
+    for name in COLUMN_NAMES:
+        assert numpy.array_equal(alone.matches.column(name), reverse.matches.column(name), equal_nan=True), name
@@ -0,0 +1,82 @@
+import shutil
+import threading
+import time
+import numpy
+from dataset_cache import DataSetCache
+from lazy_files import DataFileSet
+from parallel_runner import iter_pair_matches
+from prefetch import Prefetcher
+
+
+def test_prefetched_files_stay_open_until_their_pair_has_run(granules, tmp_path):
+    # Only one file may stay open unpinned, so running the first pair would close the second pair's
+    # off-nadir file, and drop what was read into it, if the prefetch had not pinned it.
+    modis_path, viirs_path = granules
+    other_viirs_path = str(tmp_path / viirs_path.split("/")[-1])
+    shutil.copy(viirs_path, other_viirs_path)
+    tasks = [(0, 0, modis_path, viirs_path), (0, 1, modis_path, other_viirs_path)]
+    data_files = DataFileSet(max_open_files=1)
+    prefetcher = Prefetcher(tasks, data_files, lookahead=1)
+    try:
+        prefetcher.wait(0)
+        prefetcher.futures[1].result()
+        prefetched = data_files.get(other_viirs_path)
+        cached = len(prefetched.data_file.data_cache)
+        assert cached > 0
+        assert sum(len(batch) for batch in iter_pair_matches(tasks[0], batch_size=1000, data_files=data_files)) > 0
+        prefetcher.finish(0)
+        assert prefetched.is_open() and len(prefetched.data_file.data_cache) == cached
+        prefetcher.wait(1)
+        prefetcher.finish(1)
+        assert not data_files.pool.is_pinned(prefetched)
+        data_files.get(modis_path).get_number_of_scans()
+        assert not prefetched.is_open()
+    finally:
+        prefetcher.close()
+        data_files.close_all()
+
+
+def test_arrays_are_read_once_and_outside_the_cache_lock():
+    cache = DataSetCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_loader():
+        calls.append("slow")
+        started.set()
+        release.wait(5)
+        return numpy.zeros(10)
+
+    results = []
+    readers = [threading.Thread(target=lambda: results.append(cache.get("slow", slow_loader))) for _ in range(2)]
+    for reader in readers:
+        reader.start()
+    assert started.wait(5)
+    # While "slow" is being read, another array can still be read
+    fast_reader = threading.Thread(target=lambda: results.append(cache.get("fast", lambda: numpy.ones(3))))
+    fast_reader.start()
+    fast_reader.join(2)
+    assert not fast_reader.is_alive() and results[0].tolist() == [1.0, 1.0, 1.0]
+    results.clear()
+    time.sleep(.05)
+    release.set()
+    for reader in readers:
+        reader.join(5)
+    assert calls == ["slow"]
+    assert len(results) == 2 and results[0] is results[1]
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_a_failed_read_is_retried_by_the_next_caller():
+    cache = DataSetCache()
+
+    def failing_loader():
+        raise IOError("unreadable")
+
+    try:
+        cache.get("data", failing_loader)
+    except IOError:
+        pass
+    assert cache.get("data", lambda: numpy.arange(3)).tolist() == [0, 1, 2]
+    assert cache.loading == {}
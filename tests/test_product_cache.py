@@ -0,0 +1,21 @@
+import os
+import numpy
+from product_cache import ProductCache
+
+
+def test_entry_evicted_while_being_read_is_a_miss(tmp_path, monkeypatch):
+    source = tmp_path / "granule.h5"
+    source.write_bytes(b"granule")
+    cache = ProductCache(str(tmp_path / "cache"))
+    cache.put(str(source), "coordinates", numpy.arange(4))
+    entry_path = cache.get_entry_path(str(source), "coordinates")
+    load = numpy.load
+
+    def load_then_evict(file_name, *arguments, **keywords):
+        # Another process evicts the entry right after it is mapped
+        array = load(file_name, *arguments, **keywords)
+        os.remove(entry_path)
+        return array
+    monkeypatch.setattr(numpy, "load", load_then_evict)
+    assert cache.get(str(source), "coordinates") is None
+    assert cache.misses == 1 and cache.hits == 0
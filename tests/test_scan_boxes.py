@@ -0,0 +1,29 @@
+import numpy
+from data_structures import GeospatialScanBox, ScanBoxSet
+
+
+def test_scan_box_with_coincident_corners():
+    # The two top corners are the same point, so the top edge has no length.
+    box = GeospatialScanBox((-10.0, 20.0), (-12.0, 19.0), (-10.0, 20.0), (-12.0, 21.0), 1, 24)
+    smallest_lat, biggest_lat, smallest_lon, biggest_lon = box.extents
+    # Edges are great circles sampled short of their last corner, so the extents are only close to the corners'.
+    assert abs(smallest_lat + 12.0) < 0.01 and biggest_lat == -10.0
+    assert smallest_lon == 19.0 and abs(biggest_lon - 21.0) < 0.1
+    assert box.encapsulates((-11.0, 20.0))
+    assert not box.encapsulates((-9.0, 20.0))
+
+
+def test_scan_box_set_agrees_with_each_box():
+    boxes = [GeospatialScanBox((-10.0, 20.0), (-12.0, 19.0), (-10.0, 22.0), (-12.0, 21.0), 1, 24),
+             GeospatialScanBox((-8.0, 20.5), (-10.0, 20.0), (-8.0, 22.5), (-10.0, 22.0), 25, 48),
+             # Across the antimeridian
+             GeospatialScanBox((5.0, 178.0), (3.0, 177.5), (5.0, -178.0), (3.0, -178.5), 49, 72)]
+    box_set = ScanBoxSet(boxes)
+    rng = numpy.random.RandomState(0)
+    latitudes = rng.uniform(-13, 6, 2000)
+    longitudes = numpy.concatenate((rng.uniform(18, 24, 1000), rng.uniform(176, 184, 1000)))
+    longitudes = numpy.where(longitudes >= 180, longitudes - 360, longitudes)
+    inside = box_set.contains(latitudes, longitudes)
+    for b, box in enumerate(boxes):
+        assert inside[b].tolist() == [box.encapsulates(point) for point in zip(latitudes, longitudes)]
+    assert inside.any(axis=1).all()
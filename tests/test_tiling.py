@@ -0,0 +1,31 @@
+import numpy
+import pytest
+from file_handler import HDF4File, HDF5File
+from match_table import concatenate
+
+
+def match(granules, frame_interval, tile_budget):
+    modis_file = HDF4File(granules[0])
+    viirs_file = HDF5File(granules[1])
+    matches = concatenate(viirs_file.iter_off_nadir_matches(modis_file.generate_nadir_data_points(),
+                                                            modis_file.get_nadir_radiances(), batch_size=1000,
+                                                            frame_interval=frame_interval, tile_budget=tile_budget))
+    modis_file.close_file()
+    viirs_file.close_file()
+    # Tiles come scan by scan, so only the set of matches is the same
+    order = numpy.lexsort([matches.column(name) for name in ("viirs_swath_pos", "viirs_scan", "modis_swath_pos",
+                                                             "modis_scan")])
+    return {name: matches.column(name)[order] for name in ("modis_scan", "modis_swath_pos", "viirs_scan",
+                                                           "viirs_swath_pos", "viirs_lat", "viirs_lon",
+                                                           "difference_ratio")}
+
+
+@pytest.mark.parametrize("frame_interval", [1, 3, 5, 7, 10])
+def test_tiled_matches_equal_untiled_matches(granules, frame_interval):
+    untiled = match(granules, frame_interval, None)
+    assert len(untiled["modis_scan"]) > 0
+    # A budget of one byte puts every scan in a tile of its own
+    for tile_budget in (1, 10 ** 6):
+        tiled = match(granules, frame_interval, tile_budget)
+        for name in untiled:
+            assert numpy.array_equal(tiled[name], untiled[name], equal_nan=True), name
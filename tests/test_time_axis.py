@@ -0,0 +1,36 @@
+import numpy
+from time_axis import ScanTimeAxis
+
+
+def test_empty_axis_has_empty_windows():
+    time_axis = ScanTimeAxis([])
+    starts, ends = time_axis.join([10.0, 20.0], [5.0, 5.0])
+    assert starts.tolist() == [0, 0] and ends.tolist() == [0, 0]
+    assert not time_axis.in_range(numpy.array([], dtype=numpy.int64), 0, 0).any()
+    assert not time_axis.any_in_window(0, 2, starts, ends).any()
+
+
+def test_window_includes_scans_exactly_on_its_boundaries():
+    time_axis = ScanTimeAxis([0.0, 10.0, 20.0, 30.0])
+    starts, ends = time_axis.join([20.0], [10.0])
+    assert (starts[0], ends[0]) == (1, 4)
+    assert time_axis.in_range(numpy.arange(4), starts[0], ends[0]).tolist() == [False, True, True, True]
+    assert time_axis.any_in_window(3, 3, starts, ends).tolist() == [True]
+    assert time_axis.any_in_window(0, 0, starts, ends).tolist() == [False]
+
+
+def test_windows_outside_the_axis_hold_no_scans():
+    time_axis = ScanTimeAxis([0.0, 10.0, 20.0, 30.0])
+    starts, ends = time_axis.join([-20.0, 50.0], [10.0, 10.0])
+    assert starts.tolist() == [0, 4] and ends.tolist() == [0, 4]
+    assert not time_axis.in_range(numpy.arange(4), starts[0], ends[0]).any()
+    assert not time_axis.in_range(numpy.arange(4), starts[1], ends[1]).any()
+    assert time_axis.any_in_window(0, 3, starts, ends).tolist() == [False, False]
+
+
+def test_unsorted_scan_times_are_found_by_rank():
+    time_axis = ScanTimeAxis([30.0, 0.0, 20.0, 10.0])
+    starts, ends = time_axis.join([5.0], [6.0])
+    assert time_axis.in_range(numpy.arange(4), starts[0], ends[0]).tolist() == [False, True, False, True]
+    assert time_axis.any_in_window(0, 0, starts, ends).tolist() == [False]
+    assert time_axis.any_in_window(0, 1, starts, ends).tolist() == [True]
@@ -0,0 +1,32 @@
+import numpy
+
+# Out-of-core matching for full resolution VIIRS, where a CLASS file of I-band granules (32 detectors
+# and 6400 frames per scan) is too big to hold whole. The scans with candidate blocks (see
+# geolocation_pyramid.find_candidate_blocks) are split into tiles of consecutive scans. Each tile
+# covers the frames from its first to its last candidate block, widened by a halo of frames on either
+# side, and is kept under a fixed number of bytes. Geolocation and values are read from the file one
+# tile's hyperslab at a time and matched on their own. Every pixel falls in exactly one tile, so the
+# tiles' matches only have to be put together: none are lost at tile edges and none come twice.
+
+DEFAULT_TILE_BUDGET = 256 * 1024 ** 2
+
+
+def plan_tiles(blocks, block_frames, halo, number_of_frames, bytes_per_scan_frame, tile_budget=DEFAULT_TILE_BUDGET):
+    # blocks is [scan row][block] -> candidate, as from find_candidate_blocks. Returns
+    # [(scan rows, first frame, last frame)] where rows * frames * bytes_per_scan_frame stays within
+    # tile_budget; a scan that needs more than the budget on its own still gets a tile.
+    tiles = []
+    for row in numpy.nonzero(blocks.any(axis=1))[0]:
+        candidates = numpy.nonzero(blocks[row])[0]
+        first = max(candidates[0] * block_frames - halo, 0)
+        last = min((candidates[-1] + 1) * block_frames + halo, number_of_frames) - 1
+        if tiles:
+            rows, tile_first, tile_last = tiles[-1]
+            tile_first = min(first, tile_first)
+            tile_last = max(last, tile_last)
+            if rows[-1] + 1 == row and \
+                    (len(rows) + 1) * (tile_last - tile_first + 1) * bytes_per_scan_frame <= tile_budget:
+                tiles[-1] = (rows + [row], tile_first, tile_last)
+                continue
+        tiles.append(([row], first, last))
+    return tiles
@@ -0,0 +1,39 @@
+import numpy
+
+
+class ScanTimeAxis(object):
+    # Scan times (in seconds) kept in sorted order so that the scans inside a time window are
+    # always one contiguous run of positions, found by bisection.
+
+    def __init__(self, scan_times):
+        scan_times = numpy.asarray(scan_times, dtype=numpy.float64)
+        self.times = scan_times
+        self.order = numpy.argsort(scan_times, kind="stable")
+        self.sorted_times = scan_times[self.order]
+        # ranks[scan index] = position of that scan on the sorted axis
+        self.ranks = numpy.empty(len(scan_times), dtype=numpy.int64)
+        self.ranks[self.order] = numpy.arange(len(scan_times))
+
+    def __len__(self):
+        return len(self.sorted_times)
+
+    def join(self, times, max_time_differences):
+        # For every time, the [start, end) range of sorted positions within +/- its window.
+        times = numpy.asarray(times, dtype=numpy.float64)
+        starts = numpy.searchsorted(self.sorted_times, times - max_time_differences, side="left")
+        ends = numpy.searchsorted(self.sorted_times, times + max_time_differences, side="right")
+        return starts, ends
+
+    def in_range(self, scan_indices, start, end):
+        ranks = self.ranks[scan_indices]
+        return (ranks >= start) & (ranks < end)
+
+    def any_in_window(self, first_scan_index, last_scan_index, starts, ends):
+        # True for each window that contains at least one scan in [first_scan_index, last_scan_index].
+        # Scan times rise with the scan index in practice, but the ranks make no such assumption.
+        ranks = self.ranks[first_scan_index:last_scan_index + 1]
+        if len(ranks) == 0:
+            return numpy.zeros(len(starts), dtype=bool)
+        if numpy.all(ranks[1:] == ranks[:-1] + 1):
+            return (starts <= ranks[-1]) & (ends > ranks[0])
+        return numpy.array([numpy.any((ranks >= s) & (ranks < e)) for s, e in zip(starts, ends)], dtype=bool)